@@ -2,78 +2,106 @@
 This script defines a Flask application to fetch and update trending news data.
 """
 
-from flask import Flask, jsonify
-import pandas as pd
-from trending_news import TrendingNews
-from articles_text import ArticleText
-from articles_summary import ArticleSummary
-from articles_keywords import ArticleKeywords
-from articles_NER import ArticleNER
-import json
+from flask import Flask, Response, jsonify
+from serving import serving
+from jobs import RefreshJobRunner, JobAlreadyRunning
+from scheduler import RefreshScheduler
+from metrics import registry
+import multiprocessing
+import threading
 import warnings
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
 app = Flask(__name__)
+# /fetch_data and /fetch_delta, also served alone by serve.py
+app.register_blueprint(serving)
+job_runner = None
+init_lock = threading.Lock()
 
-@app.route('/fetch_data', methods=['GET'])
-def fetch_data():
+def get_job_runner():
     """
-    Fetches the current trending news data that is stored in the CSV file and returns it as JSON.
+    Returns the refresh job runner of the server process, created on first use. With refresh_interval_minutes set
+    it is the scheduler refreshing periodically, hottest stories first.
+    """
+    global job_runner
+    with init_lock:
+        if job_runner is None:
+            if float(os.getenv("refresh_interval_minutes", 0)) > 0:
+                job_runner = RefreshScheduler()
+                job_runner.start_schedule()
+            else:
+                job_runner = RefreshJobRunner()
+    return job_runner
+
+@app.route('/update_data')
+def update_data():
+    """
+    Starts a background job that updates the current trending news data by fetching new news, extracting text,
+    summarizing, extracting keywords, and performing named entity recognition (NER). The stories are published
+    as snapshots in the news store while the job runs. An interrupted job is resumed from its last finished story.
     
     Returns:
-        JSON response: Success status along with the fetched data if successful, otherwise a failure status.
+        JSON response: Success status with the job ID, otherwise a failure status with the ID of the job already running.
     """
     try:
-        data = pd.read_csv(f'{os.getenv("temp_folder")}/current_trending_news.csv')
-        # Convert data to JSON format
-        json_data = [json.loads(row) for row in data['all_info']]
-        resp = jsonify(success=True, data=json_data)
+        job_id, resumed = get_job_runner().start()
+        resp = jsonify(success=True, job_id=job_id, resumed=resumed)
+        resp.status_code = 202
+        return resp
+    except JobAlreadyRunning as e:
+        resp = jsonify(success=False, job_id=e.job_id, error=str(e))
+        resp.status_code = 409
         return resp
     except Exception as e:
         resp = jsonify(success=False)
         return resp
 
-@app.route('/update_data')
-def update_data():
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
     """
-    Updates the current trending news data by fetching new news, extracting text, summarizing,
-    extracting keywords, and performing named entity recognition (NER). The updated data is stored
-    in a CSV file.
+    Reports the status of a refresh job: its stage progress, per-stage counts and errors.
+    
+    Args:
+        job_id (str): ID returned by /update_data.
     
     Returns:
-        JSON response: Success status if the update is successful, otherwise a failure status.
+        JSON response: Success status with the job status, otherwise a failure status.
     """
-    try:
-        # Get trending news IDs
-        news = TrendingNews()
-        current_trending_ids = news.trending_ids
-        
-        # Extract text from articles
-        text = ArticleText(current_trending_ids)
-        
-        # Summarize articles
-        summary = ArticleSummary(text.trending_articles_with_text)
-        
-        # Extract keywords from articles
-        keywords = ArticleKeywords(summary.trending_articles_with_summary)
-        
-        # Perform NER on articles
-        NER = ArticleNER(keywords.trending_articles_with_keywords)
-        current_trending_ids = NER.trending_articles_with_NER
-        
-        # Store and save updated data into a CSV file
-        current_trending_news = pd.DataFrame(columns=['all_info'])
-        current_trending_news['all_info'] = current_trending_ids
-        current_trending_news['all_info'] = current_trending_news['all_info'].apply(json.dumps)
-        current_trending_news.to_csv(f'{os.getenv("temp_folder")}/current_trending_news.csv', index=False)
-        
-        resp = jsonify(success=True)
-        return resp
-    except Exception as e:
-        resp = jsonify(success=False)
+    status = get_job_runner().get_status(job_id)
+    if status is None:
+        resp = jsonify(success=False, error='Unknown job')
+        resp.status_code = 404
         return resp
+    return jsonify(success=True, job=status)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Exposes the metrics of the server process, including the update jobs it runs, in the Prometheus text format:
+    time per story of every stage, latency of the Trends, publisher and inference calls, retries, cold-start waits,
+    stories dropped per stage and reason, and cache lookups by result. Only this process runs the pipeline, so the
+    serving-only workers of serve.py do not expose them.
+    
+    Returns:
+        Response: Metrics in the Prometheus text exposition format.
+    """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+def start_schedule():
+    """
+    Starts the periodic refresh with the server rather than on the first request, if refresh_interval_minutes is set.
+    The region workers spawned by an update import this module again and do not start it.
+    """
+    if float(os.getenv("refresh_interval_minutes", 0)) > 0 and multiprocessing.parent_process() is None:
+        get_job_runner()
 
 if __name__ == '__main__':
+    # the debug reloader runs the server in a child process importing this module again, the parent only watches
+    # the files, so only the child starts the schedule
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_schedule()
     app.run(debug=True)
+else:
+    start_schedule()
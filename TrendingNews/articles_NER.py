@@ -3,19 +3,125 @@ This fetches the NER from article summary
 """
 
 import nltk
+from nltk.tag.perceptron import PerceptronTagger
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 import traceback
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+NER_LABELS = ['PERSON', 'GPE', 'ORGANIZATION', 'FACILITY', 'PRODUCT', 'EVENT']
+MULTICLASS_NE_CHUNKER = 'chunkers/maxent_ne_chunker/english_ace_multiclass.pickle'
+
+# tagger and chunker of the current process, loaded once instead of on every nltk.pos_tag call
+tagger = None
+chunker = None
+
+def load_tagger():
+    """
+    Loads the POS tagger and the NE chunker of the current process, also used as the initializer of the NER worker processes.
+    """
+    global tagger, chunker
+    if tagger is None:
+        tagger = PerceptronTagger()
+        chunker = nltk.data.load(MULTICLASS_NE_CHUNKER)
+
+def tag_named_entities(text):
+    """
+    Performs named entity recognition on the given text with the preloaded tagger and chunker.
+    Gives the same result as nltk.ne_chunk(nltk.pos_tag(nltk.word_tokenize(text))).
+
+    Args:
+        text (str): Input text.
+
+    Returns:
+        named_entitied (list): List of named entities.
+    """
+    load_tagger()
+    text = text.replace("<n>", " ")
+    tokens = nltk.word_tokenize(text)
+    tagged_tokens = tagger.tag(tokens)
+    ner_chunks = chunker.parse(tagged_tokens)
+    named_entities = []
+    for chunk in ner_chunks:
+        if hasattr(chunk, 'label') and (chunk.label() in NER_LABELS):
+            named_entities.append(' '.join(c[0] for c in chunk.leaves()))
+    return list(set(named_entities))
+
+def tag_named_entities_batch(texts):
+    """
+    Performs named entity recognition on a shard of summaries in a worker process.
+
+    Args:
+        texts (list): List of summaries.
+
+    Returns:
+        (list): List of named entity lists, [] for a summary that failed.
+    """
+    named_entities = []
+    for text in texts:
+        try:
+            named_entities.append(tag_named_entities(text))
+        except Exception as e:
+            traceback.print_exc()
+            named_entities.append([])
+    return named_entities
+
+def build_automaton(patterns):
+    """
+    Builds an Aho-Corasick automaton that finds every occurrence of the patterns in a single pass over a text.
+
+    Args:
+        patterns (iterable): Non-empty strings to find.
+
+    Returns:
+        (tuple): goto transitions and failure link of every state, the pattern ending at every state (None if there is
+            none) and the dictionary link of every state, i.e. the nearest state on its failure chain where a pattern ends (0 if none).
+    """
+    goto, fail, terminal = [dict()], [0], [None]
+    for pattern in patterns:
+        state = 0
+        for char in pattern:
+            next_state = goto[state].get(char)
+            if next_state is None:
+                next_state = len(goto)
+                goto.append(dict())
+                fail.append(0)
+                terminal.append(None)
+                goto[state][char] = next_state
+            state = next_state
+        terminal[state] = pattern
+
+    dictionary = [0] * len(goto)
+    # breadth first, so that the failure link of a state is computed before its children
+    states = deque(goto[0].values())
+    while states:
+        state = states.popleft()
+        for char, next_state in goto[state].items():
+            states.append(next_state)
+            link = fail[state]
+            while link != 0 and char not in goto[link]:
+                link = fail[link]
+            fail[next_state] = goto[link].get(char, 0)
+            dictionary[next_state] = fail[next_state] if terminal[fail[next_state]] is not None else dictionary[fail[next_state]]
+    return goto, fail, terminal, dictionary
 
 class ArticleNER:
-    def __init__(self, trending_articles):
+    def __init__(self, trending_articles, parallel=False):
         """
         Initializes the ArticleKeywords object with the provided dataframe of current trending articles and checks if NER is already present as keyword
-        
+
         Args:
             trending_articles (pandas df): dataframe of list of trending articles with summaries.
+            parallel (bool): Tag the summaries in a pool of ner_processes worker processes instead of the current thread.
         """
         self.trending_articles_with_NER = trending_articles
 
-        self.caller_function()
+        if parallel:
+            self.caller_function_parallel()
+        else:
+            self.caller_function()
 
     def caller_function(self):
       '''
@@ -23,47 +129,85 @@ class ArticleNER:
       '''
       for i in range(len(self.trending_articles_with_NER)):
           art_ner = self.tagging(self.trending_articles_with_NER[i]['article_summary'])
-          if len(art_ner) > 0:
-              self.trending_articles_with_NER[i]['NER'] = art_ner
-              self.trending_articles_with_NER[i]['NER'] = self.check_repeat_NER(
-                  self.trending_articles_with_NER[i]['NER'], self.trending_articles_with_NER[i]['all_articles_keywords'])
-          else:
-              self.trending_articles_with_NER[i]['NER'] = []
+          self.set_NER(self.trending_articles_with_NER[i], art_ner)
+
+    def caller_function_parallel(self):
+      '''
+      Shards the summaries over a process pool whose workers preload the tagger and chunker, then checks for duplicate keywords
+      '''
+      processes = int(os.getenv("ner_processes", os.cpu_count() or 1))
+      summaries = [article['article_summary'] for article in self.trending_articles_with_NER]
+      shard_size = max(1, -(-len(summaries) // (processes * 4)))
+      shards = [summaries[k:k+shard_size] for k in range(0, len(summaries), shard_size)]
+      with ProcessPoolExecutor(max_workers=processes, initializer=load_tagger) as executor:
+          all_ner = [art_ner for shard_ner in executor.map(tag_named_entities_batch, shards) for art_ner in shard_ner]
+      for article, art_ner in zip(self.trending_articles_with_NER, all_ner):
+          self.set_NER(article, art_ner)
+
+    def set_NER(self, article, art_ner):
+        """
+        Stores the named entities of a story that are not repeats of each other or of its keywords.
+
+        Args:
+            article (dict): Story dictionary.
+            art_ner (list): Named entities of the story summary.
+        """
+        if len(art_ner) > 0:
+            article['NER'] = self.check_repeat_NER(art_ner, article['all_articles_keywords'])
+        else:
+            article['NER'] = []
 
     def check_repeat_NER(self, ner, keywords):
         """
         Checks for repeated words in named entities and already present keywords and returns unique named entities.
-        
+        An Aho-Corasick automaton of the entities is run once over every entity and keyword, so the time is linear in
+        their total length and the number of entities removed, instead of comparing every pair.
+
         Args:
             ner (list): List of named entities.
             keywords (list): List of keywords.
-        
+
         Returns:
             list: List of unique named entities.
         """
-        words_to_remove_ner = [word1 for word1 in ner if any(word1 in word2 and word1 != word2 for word2 in ner)]
-        unique_ner = [word for word in ner if word not in words_to_remove_ner]
-        words_to_remove_keywords = [word1 for word1 in unique_ner if any(word1 in word2 or word1 == word2 for word2 in keywords)]
-        unique_ner_keywords = [word for word in unique_ner if word not in words_to_remove_keywords]
-        return unique_ner_keywords
+        keywords = keywords or []
+        entities = set(ner)
+        words_to_remove = set()
+        # the empty string is in every other string
+        if '' in entities and (len(entities) > 1 or len(keywords) > 0):
+            words_to_remove.add('')
+        goto, fail, terminal, dictionary = build_automaton(entity for entity in entities if entity != '')
+        # a marked state and every pattern state of its dictionary chain are already removed
+        marked = [False] * len(goto)
+
+        def remove_patterns(state):
+            while state != 0 and not marked[state]:
+                marked[state] = True
+                words_to_remove.add(terminal[state])
+                state = dictionary[state]
+
+        texts = [(entity, True) for entity in entities if entity != ''] + [(keyword, False) for keyword in keywords]
+        for text, is_entity in texts:
+            state = 0
+            for position, char in enumerate(text):
+                while state != 0 and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                # an entity is in itself only at its end, where the entity itself is not removed, its suffixes are
+                if terminal[state] is not None and not (is_entity and position == len(text) - 1):
+                    remove_patterns(state)
+                else:
+                    remove_patterns(dictionary[state])
+        return [word for word in ner if word not in words_to_remove]
 
     def tagging(self, text):
         """
         Performs named entity recognition on the given text and returns a list of named entities.
-        
+
         Args:
             text (str): Input text.
-        
+
         Returns:
             named_entitied (list): List of named entities.
         """
-        text = text.replace("<n>", " ")
-        tokens = nltk.word_tokenize(text)
-        tagged_tokens = nltk.pos_tag(tokens)
-        ner_chunks = nltk.ne_chunk(tagged_tokens)
-        named_entities = []
-        for chunk in ner_chunks:
-            if hasattr(chunk, 'label') and (chunk.label() in ['PERSON', 'GPE', 'ORGANIZATION', 'FACILITY', 'PRODUCT', 'EVENT']):
-                named_entities.append(' '.join(c[0] for c in chunk.leaves()))
-        return list(set(named_entities))
-
+        return tag_named_entities(text)
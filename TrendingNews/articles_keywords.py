@@ -2,30 +2,34 @@
 This script fetches the keywords from article text
 """
 
-import time
 import traceback
-import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
+from inference_cache import InferenceCache
+from inference_client import InferenceClient
 from dotenv import load_dotenv
 load_dotenv()
 
 #get the API of Deberta huggingface model
 API_URL = os.getenv("API_Deberta")
 headers = {"Authorization": "Bearer {}".format(os.getenv("deberta_authorisation_key"))}
+client = InferenceClient(API_URL, headers, name='deberta')
 
 class ArticleKeywords:
-    def __init__(self, trending_articles):
+    def __init__(self, trending_articles, cache=None):
         """
         Initializes the ArticleKeywords object with the provided dataframe of current trending articles
         
         Args:
             trending_articles (pandas df): dataframe of list of trending articles.
+            cache (InferenceCache): Cache of Deberta responses, a new one is opened if not given
         """
+        self.cache = cache or InferenceCache()
         self.trending_articles_with_keywords = self.get_keywords(trending_articles)
             
     def query(self, payload):
         """
-        Calls the Deberta API with the provided payload and returns the JSON response.
+        Calls the Deberta API through the shared inference client with the provided payload and returns the JSON response.
         
         Args:
             payload (dict): Payload for the POST request.
@@ -33,12 +37,12 @@ class ArticleKeywords:
         Returns:
             dict: JSON response from the API.
         """
-        response = requests.post(API_URL, headers=headers, json=payload)
-        return response.json()
+        return client.post(payload)
       
     def call_query(self, payloads):
         """
-        Recursively calls the Deberta model API by calling the "query" function until a successful response is received, handling errors and delays.
+        Returns the Deberta scores for the payload from the cache, calling 'query' on a miss.
+        The candidate labels are part of the cache key.
         
         Args:
             payloads (dict): Payloads for the POST request.
@@ -46,12 +50,15 @@ class ArticleKeywords:
         Returns:
             dict: JSON response from the API.
         """
+        key = self.cache.make_key(API_URL, payloads['inputs'], payloads.get('parameters'))
+        score = self.cache.get(key)
+        if score is not None:
+            return score
         score = self.query(payloads)
-        if 'error' in score and 'estimated_time' in score:
-            time.sleep(int(score['estimated_time']) + 5)
-            return self.call_query(payloads)
+        if 'scores' in score:
+            self.cache.set(key, score)
         return score
-      
+
     def get_keywords(self, current_articles):
         """
         Iterates through all articles and extracts keywords for each.
@@ -62,17 +69,30 @@ class ArticleKeywords:
         Returns:
             current_articles (df): dataframe of current articles with extracted keywords.
         """
-        for i in range(len(current_articles)):
-            current_articles[i]['final_keywords'] = ''
-            try:
-                score = self.call_query({
-                    "inputs": current_articles[i]['article_text'],
-                    "parameters": {"candidate_labels": current_articles[i]['all_articles_keywords'], "multi_label": True},
-                })
-                
-                if score['scores'][0] > 0.2:
-                    current_articles[i]['final_keywords'] = score['labels'][0:3]
-            except Exception as e:
-                traceback.print_exc()
-                pass
+        with ThreadPoolExecutor(max_workers=client.max_concurrency) as executor:
+            current_articles = list(executor.map(self.get_article_keywords, current_articles))
         return current_articles
+
+    def get_article_keywords(self, article):
+        """
+        Scores the story keywords against the article text and keeps the best three.
+        
+        Args:
+            article (dict): Story dictionary with the article text and all article keywords.
+        
+        Returns:
+            article (dict): The story with 'final_keywords' set, '' if no keyword scored high enough.
+        """
+        article['final_keywords'] = ''
+        try:
+            score = self.call_query({
+                "inputs": article['article_text'],
+                "parameters": {"candidate_labels": article['all_articles_keywords'], "multi_label": True},
+            })
+            
+            if score['scores'][0] > 0.2:
+                article['final_keywords'] = score['labels'][0:3]
+        except Exception as e:
+            traceback.print_exc()
+            pass
+        return article
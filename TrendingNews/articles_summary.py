@@ -1,27 +1,60 @@
 """
-This script generates a summary for each article text
+This script generates a summary for each article text, abstractive with the remote Pegasus model or extractive with a local TextRank
 """
 
 import re
-import requests
 import traceback
+import threading
 import os
-import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from inference_cache import InferenceCache
+from inference_client import InferenceClient, InferenceError
+from metrics import SUMMARY_ROUTES
 from dotenv import load_dotenv
 load_dotenv()
 
 #get the API of Pegasus huggingface model
 API_URL = os.getenv("API_pegasus")
 headers = {"Authorization": "Bearer {}".format(os.getenv("pegasus_authorisation_key"))}
+client = InferenceClient(API_URL, headers, name='pegasus')
+
+# token budget of a chunk and number of chunks sent in one request
+MAX_CHUNK_TOKENS = int(os.getenv("pegasus_max_tokens", 512))
+BATCH_SIZE = int(os.getenv("pegasus_batch_size", 8))
+# Pegasus' sentencepiece vocabulary splits English text into roughly 1.3 tokens per word
+TOKENS_PER_WORD = 1.3
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')\]])\s+|\n+')
+
+# remote: every article goes to Pegasus, local: none does, auto: only the long ones within the budget, the others
+# and the ones Pegasus fails on are summarized locally
+SUMMARY_MODE = os.getenv("summary_mode", "remote")
+LOCAL_SUMMARY_MAX_WORDS = int(os.getenv("local_summary_max_words", 250))
+LOCAL_SUMMARY_SENTENCES = int(os.getenv("local_summary_sentences", 3))
+# number of articles sent to Pegasus per update in auto mode, 0 for no limit
+REMOTE_SUMMARY_BUDGET = int(os.getenv("remote_summary_budget", 0))
+# TextRank damping factor and the shortest sentence worth extracting, in words
+DAMPING = 0.85
+MIN_SENTENCE_WORDS = 4
+WORD = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""a about after all also an and any are as at be been but by can could did do does for from had has have he her
+his how i if in into is it its just may more most no not of on or our out over said says she so some than that the their
+them then there these they this to up was we were what when which who will with would you""".split())
 
 class ArticleSummary:
-    def __init__(self, current_trending_articles):
+    def __init__(self, current_trending_articles, cache=None, mode=None):
         """
         Initializes the ArticleSummary object with the provided dataframe of current trending articles
         
         Args:
             current_trending_articles (pandas df): Dataframe containing list of current trending articles
+            cache (InferenceCache): Cache of Pegasus responses, a new one is opened if not given
+            mode (str): remote, local or auto routing of the articles, defaults to the summary_mode env variable or remote
         """
+        self.cache = cache or InferenceCache()
+        self.mode = mode or SUMMARY_MODE
+        self.remote_articles = 0
+        self.budget_lock = threading.Lock()
         self.trending_articles_with_summary = current_trending_articles
         self.get_all_article_summary()
     
@@ -29,21 +62,86 @@ class ArticleSummary:
         """
         Iterates through all articles and generates summaries for each
         """
-        for i in range(len(self.trending_articles_with_summary)):
-            try:
-                art_summ = self.text_summary_PEGASUS(self.trending_articles_with_summary[i]['article_text'])
-                
-                # drop the story if summary could not be generated
-                if len(art_summ) > 0:
-                    self.trending_articles_with_summary[i]['article_summary'] = art_summ
-                else:
-                    self.trending_articles_with_summary.drop(i, inplace=True)
-            except Exception as e:
-                traceback.print_exc()
+        with ThreadPoolExecutor(max_workers=client.max_concurrency) as executor:
+            summaries = list(executor.map(self.get_article_summary, self.trending_articles_with_summary))
+
+        # drop the story if summary could not be generated
+        for article, art_summ in zip(self.trending_articles_with_summary, summaries):
+            article['article_summary'] = art_summ
+        self.trending_articles_with_summary = [article for article in self.trending_articles_with_summary if len(article['article_summary']) > 0]
+
+    def get_article_summary(self, article):
+        """
+        Generates the summary of one article, errors are printed and give an empty summary
+        
+        Args:
+            article (dict): Story dictionary with the article text
+        
+        Returns:
+            (str): Generated summary, '' on failure
+        """
+        try:
+            return self.summarize(article['article_text'])
+        except Exception as e:
+            traceback.print_exc()
+            return ''
+
+    def summarize(self, article_text):
+        """
+        Summarizes an article locally or with Pegasus depending on the routing policy. In auto mode an article
+        Pegasus fails on, e.g. while its circuit is open, is summarized locally instead of being dropped.
+        
+        Args:
+            article_text (str): Raw article text
+        
+        Returns:
+            (str): Summary of the article
+        """
+        if self.get_route(article_text) == 'local':
+            SUMMARY_ROUTES.inc('local')
+            return self.text_summary_local(article_text)
+        try:
+            summary = self.text_summary_PEGASUS(article_text)
+        except InferenceError as e:
+            if self.mode != 'auto':
+                raise
+            traceback.print_exc()
+            SUMMARY_ROUTES.inc('fallback')
+            return self.text_summary_local(article_text)
+        SUMMARY_ROUTES.inc('remote')
+        return summary
+
+    def get_route(self, article_text):
+        """
+        Chooses where an article is summarized: in auto mode only the articles longer than local_summary_max_words
+        words, within remote_summary_budget articles per update, need the abstractive model.
+        
+        Args:
+            article_text (str): Raw article text
+        
+        Returns:
+            (str): 'local' or 'remote'
+        """
+        if self.mode in ('local', 'remote'):
+            return self.mode
+        if len(article_text.split()) <= LOCAL_SUMMARY_MAX_WORDS:
+            return 'local'
+        with self.budget_lock:
+            if REMOTE_SUMMARY_BUDGET > 0 and self.remote_articles >= REMOTE_SUMMARY_BUDGET:
+                return 'local'
+            self.remote_articles += 1
+        return 'remote'
+
+    def reset_budget(self):
+        """
+        Starts a new remote summary budget, called at the start of every update.
+        """
+        with self.budget_lock:
+            self.remote_articles = 0
   
     def query(self, payload):
         """
-        Calls Pegasus API with the provided payload and returns the JSON response, i.e summary.
+        Calls Pegasus API through the shared inference client with the provided payload and returns the JSON response, i.e summary.
         
         Args:
             payload (dict): Payload for the POST request
@@ -51,25 +149,70 @@ class ArticleSummary:
         Returns:
             dict: JSON response from the API
         """
-        response = requests.post(API_URL, headers=headers, json=payload)
-        return response.json()
+        return client.post(payload)
   
     def call_query(self, payloads):
         """
-        Recursively calls the Pegasus model API by calling 'query' function until a successful response is received, handling errors and delays.
+        Returns the Pegasus responses for the payload, serving every input from the cache when possible and
+        calling 'query' only for the inputs that are not cached.
         
         Args:
-            payloads (dict): Payloads for the POST request
+            payloads (dict): Payloads for the POST request, 'inputs' being one text or a list of texts
         
         Returns:
-            sub_article_summary (dict): JSON response from the API
+            sub_article_summary (dict or list): Response of the input as a dict, or one dict per input for a list of texts
+
+        Raises:
+            InferenceError: if the response is not a summary of every input, e.g. an error dict.
         """
-        sub_article_summary = self.query(payloads)
-        if 'error' in sub_article_summary and 'estimated_time' in sub_article_summary:
-            time.sleep(int(sub_article_summary['estimated_time']) + 5)
-            return self.call_query(payloads)
+        inputs = payloads['inputs']
+        batch = inputs if isinstance(inputs, list) else [inputs]
+        keys = [self.cache.make_key(API_URL, text, payloads.get('parameters')) for text in batch]
+        # entries cached before the responses were normalized may still be lists
+        responses = [self.normalize_response(self.cache.get(key)) for key in keys]
+        missing = [k for k in range(len(batch)) if responses[k] is None]
+        if len(missing) == 0:
+            return responses if isinstance(inputs, list) else responses[0]
+
+        if isinstance(inputs, list):
+            sub_article_summary = self.query(dict(payloads, inputs=[batch[k] for k in missing]))
+            if not isinstance(sub_article_summary, list) or len(sub_article_summary) != len(missing):
+                raise InferenceError("Unexpected Pegasus response for {} inputs: {!r}".format(len(missing), sub_article_summary)[:500])
+            for k, response in zip(missing, sub_article_summary):
+                responses[k] = self.check_response(self.normalize_response(response))
+                self.cache.set(keys[k], responses[k])
+            return responses
+
+        sub_article_summary = self.check_response(self.normalize_response(self.query(payloads)))
+        self.cache.set(keys[0], sub_article_summary)
         return sub_article_summary
-              
+
+    def check_response(self, response):
+        """
+        Returns the response of one input if it holds a summary.
+
+        Raises:
+            InferenceError: if it does not, e.g. an error dict answered with a 200 status.
+        """
+        if not isinstance(response, dict) or not isinstance(response.get('summary_text'), str):
+            raise InferenceError("Unexpected Pegasus response: {!r}".format(response)[:500])
+        return response
+
+    def normalize_response(self, response):
+        """
+        Returns the response of one input as a dict, the endpoint answering either one dict or a one element list
+        per input, so that the single and the batched calls share the cache entries.
+
+        Args:
+            response (dict or list): Response of one input, None if it is not cached.
+
+        Returns:
+            (dict): The response dict, None if there is no response.
+        """
+        if isinstance(response, list):
+            return response[0] if len(response) > 0 else {}
+        return response
+
     def text_summary_PEGASUS(self, article_text_raw):
         """
         Generates a summary for the given article text using the Pegasus API
@@ -80,24 +223,129 @@ class ArticleSummary:
         Returns:
             final_summary (str): Generated summary for the article
         """
-        summary = []
         article_text = self.remove_emojis(article_text_raw)
         if len(article_text.split(" ")) <= 60:
             return article_text  # if article has less than 60 words, return as is
-        elif len(article_text.split(" ")) > 1000:
-            j = 0
-            while j + 1000 < len(article_text):
-                sub_article_sum = self.call_query({"inputs": article_text[j:j+1000]})
-                if sub_article_sum[0]['summary_text'] is not None:
-                    summary.append(sub_article_sum[0]['summary_text'])
-                j += 1000
-            final_summary = ' '.join(summary)
-            final_summary = final_summary.replace("<n>", "")
-            return final_summary
-        article_sum = self.call_query({"inputs": article_text})
-        final_summary = article_sum[0]['summary_text'].replace("<n>", "")
+        chunks = self.chunk_sentences(article_text, MAX_CHUNK_TOKENS)
+        if len(chunks) == 1:
+            article_sum = self.call_query({"inputs": chunks[0]})
+            return article_sum['summary_text'].replace("<n>", "")
+
+        # long article, summarize the sentence aligned chunks in batched requests
+        summary = []
+        for j in range(0, len(chunks), BATCH_SIZE):
+            sub_article_sums = self.call_query({"inputs": chunks[j:j+BATCH_SIZE]})
+            for sub_article_sum in sub_article_sums:
+                if sub_article_sum.get('summary_text') is not None:
+                    summary.append(sub_article_sum['summary_text'])
+        final_summary = ' '.join(summary)
+        final_summary = final_summary.replace("<n>", "")
         return final_summary
 
+    def text_summary_local(self, article_text_raw):
+        """
+        Generates an extractive summary of the given article text: its LOCAL_SUMMARY_SENTENCES best ranked
+        sentences, in article order.
+        
+        Args:
+            article_text_raw (str): Raw article text
+        
+        Returns:
+            (str): Extracted summary of the article
+        """
+        article_text = self.remove_emojis(article_text_raw)
+        if len(article_text.split(" ")) <= 60:
+            return article_text  # if article has less than 60 words, return as is
+        sentences = [sentence.strip() for sentence in SENTENCE_END.split(article_text) if sentence.strip() != '']
+        sentences = [sentence for sentence in sentences if len(sentence.split()) >= MIN_SENTENCE_WORDS] or sentences
+        if len(sentences) <= LOCAL_SUMMARY_SENTENCES:
+            return ' '.join(sentences)
+        scores = self.text_rank(sentences)
+        best = sorted(np.argsort(-scores, kind='stable')[:LOCAL_SUMMARY_SENTENCES])
+        return ' '.join(sentences[k] for k in best)
+
+    def text_rank(self, sentences):
+        """
+        Ranks sentences with TextRank: PageRank over the graph of the cosine similarities of their TF-IDF vectors.
+        
+        Args:
+            sentences (list): Sentences of the article.
+        
+        Returns:
+            scores (numpy array): Score of every sentence, higher is more central.
+        """
+        vocabulary, rows, columns = dict(), [], []
+        for row, sentence in enumerate(sentences):
+            for word in WORD.findall(sentence.lower()):
+                if word not in STOP_WORDS:
+                    rows.append(row)
+                    columns.append(vocabulary.setdefault(word, len(vocabulary)))
+        n = len(sentences)
+        counts = np.zeros((n, max(1, len(vocabulary))))
+        np.add.at(counts, (np.array(rows, dtype=int), np.array(columns, dtype=int)), 1)
+
+        idf = np.log((1 + n) / (1 + (counts > 0).sum(axis=0))) + 1
+        vectors = counts * idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        similarity = vectors @ vectors.T
+        np.fill_diagonal(similarity, 0)
+
+        # a sentence sharing no word with the others links to every sentence
+        row_sums = similarity.sum(axis=1, keepdims=True)
+        transition = np.where(row_sums > 0, similarity / np.where(row_sums == 0, 1, row_sums), 1.0 / n)
+        scores = np.full(n, 1.0 / n)
+        for _ in range(100):
+            new_scores = (1 - DAMPING) / n + DAMPING * (transition.T @ scores)
+            converged = np.abs(new_scores - scores).sum() < 1e-6
+            scores = new_scores
+            if converged:
+                break
+        return scores
+
+    def count_tokens(self, text):
+        """
+        Estimates the number of model tokens in the given text.
+        
+        Args:
+            text (str): Input text.
+        
+        Returns:
+            (int): Estimated number of tokens.
+        """
+        return int(len(text.split()) * TOKENS_PER_WORD) + 1
+
+    def chunk_sentences(self, text, max_tokens):
+        """
+        Splits the text on sentence boundaries into chunks that fit in the token budget of the model.
+        A sentence longer than the budget on its own is split on word boundaries.
+        
+        Args:
+            text (str): Input text.
+            max_tokens (int): Token budget of one chunk.
+        
+        Returns:
+            chunks (list): List of text chunks, covering the whole text.
+        """
+        max_words = max(1, int(max_tokens / TOKENS_PER_WORD))
+        chunks, current, current_tokens = [], [], 0
+        for sentence in SENTENCE_END.split(text):
+            sentence = sentence.strip()
+            if sentence == '':
+                continue
+            words = sentence.split()
+            pieces = [' '.join(words[k:k+max_words]) for k in range(0, len(words), max_words)]
+            for piece in pieces:
+                piece_tokens = self.count_tokens(piece)
+                if current and current_tokens + piece_tokens > max_tokens:
+                    chunks.append(' '.join(current))
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += piece_tokens
+        if current:
+            chunks.append(' '.join(current))
+        return chunks
+
     def remove_emojis(self, text):
         """
         Removes emojis from the given text.
@@ -4,20 +4,72 @@ This script fetches the article texts from the news IDs
 
 from newspaper import Article
 from newspaper import Config
+from requests.adapters import HTTPAdapter
+import requests
+import lxml.html
+import lxml.etree
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from urllib.parse import urlparse
+import threading
 import traceback
 import time
 import random
+import re
+import os
+from metrics import EXTERNAL_SECONDS, EXTRACTIONS
+from http_cache import HttpCache
+from dotenv import load_dotenv
+load_dotenv()
+
+# politeness delay between two requests to the same host, in seconds
+MIN_DELAY = float(os.getenv("article_text_min_delay", 2))
+MAX_DELAY = float(os.getenv("article_text_max_delay", 5))
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:78.0) Gecko/20100101 Firefox/78.0'
+# time an article page is served from the HTTP cache without asking the publisher, in seconds
+ARTICLE_CACHE_TTL = float(os.getenv("article_cache_ttl_seconds", 24 * 3600))
+# fast: lean lxml extraction, newspaper only for pages where it finds too little text, newspaper: always the full newspaper parse
+EXTRACTION_MODE = os.getenv("article_extraction", "fast")
+# bytes of a page read at most, the main text comes long before the end of a huge page
+MAX_PAGE_BYTES = int(os.getenv("article_max_bytes", 2 * 1024 * 1024))
+# fewer words from the fast extractor fall back to newspaper
+MIN_FAST_WORDS = int(os.getenv("article_min_words", 80))
+MIN_PARAGRAPH_CHARS = 25
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+BOILERPLATE = '//script|//style|//noscript|//template|//svg|//nav|//header|//footer|//aside|//form|//iframe|//figure'
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
 
 class ArticleText:
-    def __init__(self, current_trendings_articles):
+    def __init__(self, current_trendings_articles, concurrent=False, http_cache=None):
         """
         Initializes the ArticleText object with the provided dataset of current trending articles.
         
         Args:
             current_trendings_articles (pandas dataset): Contains list of today/current trending article IDs.
+            concurrent (bool): Download the articles through a worker pool with per-host politeness instead of one by one.
+            http_cache (HttpCache): Cache of the article pages, a new one is opened unless http_cache_enabled is 0.
         """
+        self.http_cache = http_cache
+        if self.http_cache is None and os.getenv("http_cache_enabled", "1") != "0":
+            self.http_cache = HttpCache()
+        # one newspaper configuration for all the articles instead of one per URL
+        self.config = Config()
+        self.config.browser_user_agent = USER_AGENT
+        self.config.request_timeout = 25
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=int(os.getenv("article_text_workers", 8)))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.trending_articles_with_text = current_trendings_articles
-        self.get_all_article_text()
+        self.host_timings = dict()
+        self.host_timings_lock = threading.Lock()
+        self.host_locks = dict()
+        self.host_next_request = dict()
+        if concurrent:
+            self.get_all_article_text_concurrent()
+        else:
+            self.get_all_article_text()
            
     def get_all_article_text(self):
         """
@@ -25,7 +77,7 @@ class ArticleText:
         """
         for count in range(0, len(self.trending_articles_with_text)):
             try:
-                text = self.get_single_article_text(self.trending_articles_with_text[count]['stories'])
+                text, requested = self.fetch_article_text(self.trending_articles_with_text[count]['stories'])
 
                 #delete a story if text could not be fetched
                 if text == '':
@@ -33,14 +85,136 @@ class ArticleText:
                     continue
                 self.trending_articles_with_text[count]['article_text'] = text
 
-                if count != (len(self.trending_articles_with_text)-1):
+                # a page served from the HTTP cache asked nothing of its publisher
+                if requested and count != (len(self.trending_articles_with_text)-1):
                     self.sleep_for_seconds()
             except Exception as e:
                 traceback.print_exc()
 
+    def get_all_article_text_concurrent(self):
+        """
+        Downloads the article texts through a bounded worker pool.
+
+        Only one request is in flight per host at a time and every host waits a random 2 to 5 seconds
+        (article_text_min_delay to article_text_max_delay) between its own requests, so the total time depends on the
+        slowest publisher rather than on the sum of all of them. Stories whose text could not be fetched are dropped.
+        """
+        max_workers = int(os.getenv("article_text_workers", 8))
+
+        stories = self.interleave_by_host(self.trending_articles_with_text)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            texts = list(executor.map(self.get_polite_article_text, stories))
+
+        for story, text in zip(stories, texts):
+            if text != '':
+                story['article_text'] = text
+        self.trending_articles_with_text = [story for story in self.trending_articles_with_text if story.get('article_text', '') != '']
+        self.print_host_timings()
+
+    def interleave_by_host(self, stories):
+        """
+        Orders the stories round-robin over their hosts, so that workers do not queue up behind a single publisher.
+
+        Args:
+            stories (list): List of story dictionaries.
+
+        Returns:
+            interleaved (list): The same stories, interleaved by host.
+        """
+        by_host = defaultdict(list)
+        for story in stories:
+            by_host[self.get_host(story['stories'])].append(story)
+        interleaved = []
+        queues = list(by_host.values())
+        while queues:
+            interleaved.extend(queue.pop(0) for queue in queues)
+            queues = [queue for queue in queues if queue]
+        return interleaved
+
+    def get_polite_article_text(self, story):
+        """
+        Extracts the text of one story while respecting the rate limit and politeness delay of its host. Only a
+        request to the publisher delays the next one, not a page served from the HTTP cache.
+
+        Args:
+            story (dict): Story dictionary with the article information under 'stories'.
+
+        Returns:
+            text (str): Extracted text from the article, '' on failure.
+        """
+        host = self.get_host(story['stories'])
+        try:
+            # setdefault is atomic, so concurrent workers always share the same lock for a host
+            with self.host_locks.setdefault(host, threading.Lock()):
+                waits = []
+                start = time.monotonic()
+                text, requested = self.fetch_article_text(story['stories'], lambda: waits.append(self.wait_for_host(host)))
+                elapsed = time.monotonic() - start - sum(waits)
+                if requested:
+                    self.host_next_request[host] = time.monotonic() + random.uniform(MIN_DELAY, MAX_DELAY)
+            if requested:
+                self.record_host_timing(host, elapsed, text != '')
+            return text
+        except Exception as e:
+            traceback.print_exc()
+            return ''
+
+    def wait_for_host(self, host):
+        """
+        Sleeps until the politeness delay after the last request to a host has passed.
+
+        Args:
+            host (str): Host name of the next request.
+
+        Returns:
+            (float): Seconds slept.
+        """
+        wait = self.host_next_request.get(host, 0) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0.0
+
+    def get_host(self, article):
+        """
+        Returns the host name of an article URL, used as the politeness key.
+
+        Args:
+            article (dict): Information about the article- article title, ID, url, image.
+
+        Returns:
+            (str): Lower-cased host name, '' if the URL is missing.
+        """
+        return urlparse(article.get('url', '').strip()).netloc.lower()
+
+    def record_host_timing(self, host, elapsed, success):
+        """
+        Adds a download to the per-host timings.
+
+        Args:
+            host (str): Host name of the article.
+            elapsed (float): Download and parse time in seconds.
+            success (bool): Whether any text was extracted.
+        """
+        with self.host_timings_lock:
+            timing = self.host_timings.setdefault(host, {'requests': 0, 'failures': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            timing['requests'] += 1
+            timing['failures'] += 0 if success else 1
+            timing['total_seconds'] += elapsed
+            timing['max_seconds'] = max(timing['max_seconds'], elapsed)
+
+    def print_host_timings(self):
+        """
+        Prints the per-host timings, slowest host first.
+        """
+        for host, timing in sorted(self.host_timings.items(), key=lambda item: item[1]['total_seconds'], reverse=True):
+            print("{}: {} requests, {} failed, {:.1f}s total, {:.1f}s max".format(
+                host or '<no url>', timing['requests'], timing['failures'], timing['total_seconds'], timing['max_seconds']))
+
     def get_single_article_text(self, article):
         """
-        Extracts text from a single article.
+        Extracts text from a single article. In the fast extraction mode the lean lxml extractor is tried first and
+        the full newspaper parse only runs when it finds fewer than MIN_FAST_WORDS words.
         
         Args:
             article (dict): Information about the article- article title, ID, url, image.
@@ -48,22 +222,158 @@ class ArticleText:
         Returns:
             text (str): Extracted text from the article.
         """
-        text = ''
+        return self.fetch_article_text(article)[0]
+
+    def fetch_article_text(self, article, before_request=None):
+        """
+        Extracts text from a single article like get_single_article_text and tells whether the publisher was asked.
+        
+        Args:
+            article (dict): Information about the article- article title, ID, url, image.
+            before_request (callable): Called right before a request to the publisher, e.g. to wait for its politeness delay.
+        
+        Returns:
+            (tuple): (text, whether a request was sent to the publisher, also when it failed).
+        """
+        text, requested = '', False
         if article['url'] == '':
-            return text
+            return text, requested
         try:
-            user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:78.0) Gecko/20100101 Firefox/78.0'
-            config = Config()
-            config.browser_user_agent = user_agent
-            config.request_timeout = 25
-            article_info = Article(article['url'].strip(), config=config)
-            article_info.download()
+            requested = True
+            html, requested = self.fetch_html(article['url'].strip(), before_request)
+            if EXTRACTION_MODE == 'fast':
+                text = self.extract_main_text(html)
+                if len(text.split()) >= MIN_FAST_WORDS:
+                    EXTRACTIONS.inc('fast')
+                    return text, requested
+            article_info = Article(article['url'].strip(), config=self.config)
+            article_info.download(input_html=html)
             article_info.parse()
+            EXTRACTIONS.inc('newspaper' if EXTRACTION_MODE != 'fast' else 'fallback')
             text = article_info.text
         except:
             pass
-        return text
+        return text, requested
+
+    def extract_main_text(self, html):
+        """
+        Extracts the main text of a page without the full newspaper parse: after dropping the scripts, navigation
+        and other boilerplate, the element whose paragraphs hold the most text is taken as the article body.
+        
+        Args:
+            html (str): HTML of the page.
+        
+        Returns:
+            (str): Paragraphs of the article body separated by blank lines, '' if none was found.
+        """
+        try:
+            tree = lxml.html.fromstring(XML_DECLARATION.sub('', html, count=1))
+        except (lxml.etree.ParserError, ValueError):
+            return ''
+        for element in tree.xpath(BOILERPLATE):
+            if element.getparent() is not None:
+                element.drop_tree()
+
+        text_by_container = defaultdict(int)
+        for paragraph in tree.iter('p'):
+            length = len(' '.join(paragraph.text_content().split()))
+            if length >= MIN_PARAGRAPH_CHARS and paragraph.getparent() is not None:
+                text_by_container[paragraph.getparent()] += length
+        if len(text_by_container) == 0:
+            return ''
+        container = max(text_by_container, key=text_by_container.get)
+        paragraphs = [' '.join(paragraph.text_content().split()) for paragraph in container.iter('p')]
+        return '\n\n'.join(paragraph for paragraph in paragraphs if len(paragraph) >= MIN_PARAGRAPH_CHARS)
     
+    def fetch_html(self, url, before_request=None):
+        """
+        Returns the HTML of an article page: from the HTTP cache within ARTICLE_CACHE_TTL, otherwise downloaded,
+        with a conditional request if the page is cached so that an unchanged page is not transferred again.
+        The download is streamed and stops after MAX_PAGE_BYTES bytes, or right away if the page is not HTML.
+        
+        Args:
+            url (str): URL of the article.
+            before_request (callable): Called right before the request, not when the page is served from the cache.
+        
+        Returns:
+            (tuple): (HTML of the page, whether a request was sent to the publisher).
+        
+        Raises:
+            requests.RequestException: if the page could not be downloaded.
+            ValueError: if the page is not HTML, e.g. a PDF or a video.
+        """
+        cached = self.http_cache.get(url) if self.http_cache is not None else None
+        if cached is not None and self.http_cache.is_fresh(cached, ARTICLE_CACHE_TTL):
+            self.http_cache.record_lookup('fresh')
+            return self.decode_html(cached['body'], cached['content_type']), False
+
+        headers = self.http_cache.get_conditional_headers(cached) if cached is not None else {}
+        if before_request is not None:
+            before_request()
+        start = time.monotonic()
+        try:
+            with self.session.get(url, timeout=25, headers=headers, stream=True) as response:
+                if response.status_code == 304 and cached is not None:
+                    body = None
+                else:
+                    response.raise_for_status()
+                    content_type = response.headers.get('Content-Type', 'text/html')
+                    if not content_type.split(';')[0].strip().lower() in HTML_CONTENT_TYPES:
+                        raise ValueError("Not an HTML page: {} for url: {}".format(content_type, url))
+                    body = self.read_capped(response)
+        except requests.RequestException:
+            EXTERNAL_SECONDS.observe(time.monotonic() - start, 'publisher', 'error')
+            raise
+        EXTERNAL_SECONDS.observe(time.monotonic() - start, 'publisher', str(response.status_code))
+        if body is None:
+            self.http_cache.touch(url)
+            self.http_cache.record_lookup('revalidated')
+            return self.decode_html(cached['body'], cached['content_type']), True
+        if self.http_cache is not None:
+            self.http_cache.record_lookup('miss')
+            self.http_cache.set(url, body, response.headers)
+        return self.decode_html(body, response.headers.get('Content-Type')), True
+
+    def read_capped(self, response):
+        """
+        Reads a streamed response body up to MAX_PAGE_BYTES bytes, the rest of the page is never downloaded.
+        
+        Args:
+            response (requests.Response): Response opened with stream=True.
+        
+        Returns:
+            (bytes): The body, truncated to MAX_PAGE_BYTES.
+        """
+        chunks, size = [], 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= MAX_PAGE_BYTES:
+                break
+        return b''.join(chunks)[:MAX_PAGE_BYTES]
+
+    def decode_html(self, body, content_type):
+        """
+        Decodes an HTML body with the charset of its content type, UTF-8 or Latin-1 otherwise.
+        
+        Args:
+            body (bytes): Response body.
+            content_type (str): Content-Type header of the response, or None.
+        
+        Returns:
+            (str): Decoded HTML.
+        """
+        encoding = requests.utils.get_encoding_from_headers({'content-type': content_type}) if content_type else None
+        if encoding is not None and encoding.lower() != 'iso-8859-1':
+            try:
+                return body.decode(encoding, errors='replace')
+            except LookupError:
+                pass
+        try:
+            return body.decode('utf-8')
+        except UnicodeDecodeError:
+            return body.decode('iso-8859-1')
+
     def sleep_for_seconds(self):
         """
         Sleeps for a random duration between 2 and 5 seconds.
@@ -0,0 +1,208 @@
+"""
+This script benchmarks the update offline against the local stubs of benchmark_stubs.py: the full pipeline and every stage
+in isolation, reporting stories/sec, p50/p99 latency per stage and peak RSS, so that two commits can be compared
+
+Usage:
+    python benchmark.py --stories 200 --inference-latency-ms 300 --cold-start 5 --output before.json
+    python benchmark.py --stories 200 --inference-latency-ms 300 --cold-start 5 --baseline before.json
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import subprocess
+import argparse
+import resource
+import tempfile
+import queue
+import time
+import json
+import sys
+import os
+from benchmark_stubs import StubConfig, StubData, StubServer
+from metrics import get_percentile
+
+STAGES = ['fetch', 'text', 'dedup', 'summary', 'keywords', 'NER', 'render']
+SCENARIOS = ['pipeline'] + STAGES
+
+def get_peak_rss_mb():
+    '''
+    Returns the peak resident set size of this process and of its finished children, e.g. the NER workers, in MB.
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {'self': own / scale, 'children': children / scale}
+
+def get_stage_report(stage):
+    '''
+    Summarises the counters and latencies of a pipeline stage.
+    '''
+    return dict(stage.stats, p50=get_percentile(stage.latencies, 50), p99=get_percentile(stage.latencies, 99))
+
+def run_stage(stage, items):
+    '''
+    Streams a list of items through one stage alone and returns its output.
+    '''
+    from pipeline import STOP
+    input_queue, output_queue = queue.Queue(), queue.Queue()
+    for item in items:
+        input_queue.put(item)
+    input_queue.put(STOP)
+    threads = stage.start(input_queue, output_queue)
+    output = []
+    while True:
+        item = output_queue.get()
+        if item is STOP:
+            break
+        output.append(item)
+    for thread in threads:
+        thread.join()
+    return output
+
+def prepare_items(pipeline, story_ids, until):
+    '''
+    Runs the stages before the benchmarked one, untimed, to build its input.
+    '''
+    items = story_ids
+    for stage in pipeline.stages[:until]:
+        with ThreadPoolExecutor(max_workers=stage.workers) as executor:
+            items = [item for item in executor.map(stage.function, items) if item is not None]
+    return items
+
+def run_scenario(scenario):
+    '''
+    Runs one scenario in the current process, whose environment already points at the stubs.
+
+    Returns:
+        report (dict): stories, seconds, stories_per_second, per-stage counters and percentiles and peak_rss_mb.
+    '''
+    # imported here so that the environment is set before the modules read it
+    from pipeline import StreamingPipeline
+    from articles_NER import load_tagger
+
+    pipeline = StreamingPipeline()
+    if scenario == 'pipeline':
+        start = time.monotonic()
+        finished = pipeline.run(publish_every=0)
+        seconds = time.monotonic() - start
+        stages = pipeline.stages
+    else:
+        story_ids = pipeline.news.filter_story_ids(pipeline.news.get_trending_story_ids())
+        index = STAGES.index(scenario)
+        with ProcessPoolExecutor(max_workers=pipeline.ner_processes, initializer=load_tagger) as pipeline.ner_executor:
+            items = prepare_items(pipeline, story_ids, index)
+            start = time.monotonic()
+            finished = run_stage(pipeline.stages[index], items)
+            seconds = time.monotonic() - start
+        stages = [pipeline.stages[index]]
+
+    return {
+        'stories': len(finished),
+        'seconds': seconds,
+        'stories_per_second': len(finished) / seconds if seconds > 0 else None,
+        'stages': {stage.name: get_stage_report(stage) for stage in stages},
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+def run_scenario_process(scenario, args):
+    '''
+    Runs a scenario in a fresh interpreter against freshly started stubs, with empty caches and news store.
+
+    Returns:
+        report (dict): Report of the scenario, with the number of requests every stub received.
+    '''
+    data = StubData(args.stories, args.hosts, args.article_words, seed=args.seed, fixtures=args.fixtures)
+    server = StubServer(data,
+                        trends=StubConfig(args.trends_latency_ms, args.error_rate),
+                        publishers=StubConfig(args.publisher_latency_ms, args.error_rate),
+                        inference=StubConfig(args.inference_latency_ms, args.error_rate, args.cold_start)).start()
+    try:
+        with tempfile.TemporaryDirectory() as temp_folder:
+            env = dict(os.environ, **server.get_env())
+            env.update({
+                'temp_folder': temp_folder,
+                'trends_requests_per_second': str(args.trends_rps),
+                'article_text_min_delay': str(args.min_delay),
+                'article_text_max_delay': str(args.max_delay),
+            })
+            result_path = os.path.join(temp_folder, 'result.json')
+            command = [sys.executable, os.path.abspath(__file__), '--scenario', scenario, '--result', result_path]
+            completed = subprocess.run(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stdout=subprocess.DEVNULL if not args.verbose else None)
+            if completed.returncode != 0 or not os.path.exists(result_path):
+                return {'error': 'exit code {}'.format(completed.returncode)}
+            with open(result_path) as f:
+                report = json.load(f)
+    finally:
+        server.stop()
+    report['stub_requests'] = dict(server.requests)
+    return report
+
+def format_seconds(value):
+    return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+def format_change(value, baseline):
+    if value is None or not baseline:
+        return ''
+    return ' ({:+.0f}%)'.format((value - baseline) / baseline * 100)
+
+def print_report(reports, baselines):
+    '''
+    Prints the reports, with the relative change against the baseline reports if given.
+    '''
+    for scenario, report in reports.items():
+        baseline = baselines.get(scenario) or {}
+        if 'error' in report:
+            print("{}: failed, {}".format(scenario, report['error']))
+            continue
+        print("{}: {} stories in {:.2f}s, {:.2f} stories/s{}, peak RSS {:.0f} MB (+{:.0f} MB in children)".format(
+            scenario, report['stories'], report['seconds'], report['stories_per_second'] or 0,
+            format_change(report['stories_per_second'], baseline.get('stories_per_second')),
+            report['peak_rss_mb']['self'], report['peak_rss_mb']['children']))
+        for name, stage in report['stages'].items():
+            baseline_stage = baseline.get('stages', {}).get(name, {})
+            print("    {:<9} p50 {:>9}{:<7} p99 {:>9}{:<7} {} processed, {} dropped, {} failed".format(
+                name, format_seconds(stage['p50']), format_change(stage['p50'], baseline_stage.get('p50')),
+                format_seconds(stage['p99']), format_change(stage['p99'], baseline_stage.get('p99')),
+                stage['processed'], stage['dropped'], stage['failed']))
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the trending news update")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS, help="Scenarios to run, all by default")
+    parser.add_argument('--stories', type=int, default=100, help="Number of trending stories served by the Trends stub")
+    parser.add_argument('--hosts', type=int, default=10, help="Number of publisher hosts")
+    parser.add_argument('--article-words', type=int, default=800, help="Approximate length of an article")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the generated stories and articles")
+    parser.add_argument('--fixtures', help="Folder of recorded Trends JSON, article HTML and model responses replacing the generated stories and pages and the shipped model responses")
+    parser.add_argument('--trends-latency-ms', type=float, default=50, help="Latency of the Trends stub")
+    parser.add_argument('--publisher-latency-ms', type=float, default=200, help="Latency of the publisher stub")
+    parser.add_argument('--inference-latency-ms', type=float, default=300, help="Latency of the inference stubs")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of stub responses replaced by a 500 error")
+    parser.add_argument('--cold-start', type=float, default=0, help="Seconds the inference stubs answer that the model is loading")
+    parser.add_argument('--trends-rps', type=float, default=20, help="Trends request budget of the client")
+    parser.add_argument('--min-delay', type=float, default=0, help="Shortest politeness delay per publisher")
+    parser.add_argument('--max-delay', type=float, default=0, help="Longest politeness delay per publisher")
+    parser.add_argument('--output', help="Write the reports to this JSON file")
+    parser.add_argument('--baseline', help="JSON file written by an earlier --output, e.g. on another commit, to compare with")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the pipeline")
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_arguments()
+    if args.scenario is not None:
+        with open(args.result, 'w') as f:
+            json.dump(run_scenario(args.scenario), f)
+        sys.exit(0)
+
+    reports = {scenario: run_scenario_process(scenario, args) for scenario in args.scenarios}
+    baselines = dict()
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baselines = json.load(f)['reports']
+    print_report(reports, baselines)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': {key: value for key, value in vars(args).items() if key not in ('scenario', 'result')},
+                       'reports': reports}, f, indent=2)
@@ -0,0 +1,252 @@
+"""
+This script defines local stand-ins for Google Trends, the publisher sites and the huggingface inference APIs, used by benchmark.py
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import threading
+import hashlib
+import random
+import json
+import time
+import os
+
+WORDS = ["government", "minister", "election", "cricket", "match", "market", "shares", "company", "police", "court",
+         "city", "state", "country", "team", "players", "season", "budget", "policy", "report", "officials",
+         "announced", "said", "won", "lost", "launched", "reached", "visited", "approved", "rejected", "expected"]
+ENTITIES = ["Narendra Modi", "New Delhi", "Mumbai", "Reserve Bank", "Virat Kohli", "Supreme Court", "Tata Motors", "Kolkata"]
+TRENDS_PREFIX = ")]}',\n"
+# recorded model responses shipped with the benchmark, replayed when the fixtures given have none
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+
+class StubConfig:
+    '''
+    Behaviour of a stub server.
+    '''
+
+    def __init__(self, latency_ms=0, error_rate=0.0, cold_start_seconds=0):
+        '''
+        Args:
+        latency_ms: Added latency of every response
+        error_rate: Share of responses replaced by a 500 error
+        cold_start_seconds: Inference stubs answer with a loading model error and its estimated_time during this time after start
+        '''
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.cold_start_seconds = cold_start_seconds
+
+class StubData:
+    '''
+    Trends stories, article pages and model responses served by the stubs. The stories and pages are generated from a seed
+    or loaded from recorded fixtures, the model responses are always replayed from recorded ones.
+    '''
+
+    def __init__(self, num_stories, num_hosts, article_words, seed=0, fixtures=None):
+        '''
+        Args:
+        num_stories: Number of trending stories
+        num_hosts: Number of publisher hosts the articles are spread over
+        article_words: Approximate number of words of an article
+        seed: Seed of the generated text
+        fixtures: Optional folder with recorded realtimetrends.json, stories/<id>.json, articles/<n>.html and
+        models/pegasus.json, models/deberta.json files, the last two being lists of recorded response bodies
+        '''
+        self.num_hosts = num_hosts
+        self.article_words = article_words
+        self.seed = seed
+        self.fixtures = fixtures
+        self.story_ids = ['BENCH_lnk_{:05d}_en'.format(k) for k in range(num_stories)]
+        if fixtures is not None and os.path.exists(os.path.join(fixtures, 'realtimetrends.json')):
+            with open(os.path.join(fixtures, 'realtimetrends.json'), encoding='utf-8') as f:
+                self.story_ids = json.load(f)['trendingStoryIds']
+        self.summaries = json.loads(self.read_fixture('models', 'pegasus.json'))
+        self.classifications = json.loads(self.read_fixture('models', 'deberta.json'))
+
+    def get_host(self, number):
+        '''
+        Returns the loopback address of a publisher, every 127.0.0.x address reaching the same stub on Linux.
+        '''
+        return '127.0.0.{}'.format(1 + number % self.num_hosts)
+
+    def get_realtime_trends(self):
+        return {'trendingStoryIds': self.story_ids}
+
+    def get_story(self, id, publisher_port):
+        recorded = self.read_fixture('stories', id + '.json')
+        if recorded is not None:
+            return json.loads(recorded)
+        number = self.story_ids.index(id) if id in self.story_ids else 0
+        rng = random.Random('{}-{}'.format(self.seed, id))
+        keywords = rng.sample(ENTITIES, 2) + rng.sample(WORDS, 2)
+        article = {
+            'title': '{} {} {}'.format(keywords[0], rng.choice(WORDS), keywords[1]),
+            'url': 'http://{}:{}/article/{}'.format(self.get_host(number), publisher_port, number),
+            'source': 'Publisher {}'.format(number % self.num_hosts),
+            'imageUrl': 'http://{}:{}/image/{}.jpg'.format(self.get_host(number), publisher_port, number),
+        }
+        return {
+            'title': ', '.join(keywords),
+            'widgets': [{'articles': [article]}, {'barData': [{'articles': rng.randint(0, 5)} for _ in range(6)]}],
+        }
+
+    def get_article_html(self, number):
+        recorded = self.read_fixture('articles', '{}.html'.format(number))
+        if recorded is not None:
+            return recorded
+        rng = random.Random('{}-article-{}'.format(self.seed, number))
+        paragraphs, words = [], 0
+        while words < self.article_words:
+            sentences = []
+            for _ in range(rng.randint(3, 6)):
+                sentence = [rng.choice(ENTITIES)] + [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+                sentences.append(' '.join(sentence).capitalize() + '.')
+                words += len(sentence) + 1
+            paragraphs.append('<p>{}</p>'.format(' '.join(sentences)))
+        return ('<html><head><title>Article {0}</title></head><body><nav>Home News Sports</nav>'
+                '<article><h1>Article {0}</h1>{1}</article><footer>Copyright</footer></body></html>').format(number, ''.join(paragraphs))
+
+    def read_fixture(self, folder, name):
+        for fixtures in (self.fixtures, FIXTURES):
+            if fixtures is None:
+                continue
+            path = os.path.join(fixtures, folder, name)
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    return f.read()
+        return None
+
+    def get_recorded(self, responses, text):
+        '''
+        Picks the recorded response replayed for an input, always the same one for the same input.
+        '''
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        return responses[int.from_bytes(digest[:4], 'big') % len(responses)]
+
+    def get_summary(self, payload):
+        '''
+        Answers like Pegasus with recorded summaries, one per input of a batch.
+        '''
+        inputs = payload['inputs']
+        if not isinstance(inputs, list):
+            return self.get_recorded(self.summaries, inputs)
+        return [self.get_recorded(self.summaries, text)[0] for text in inputs]
+
+    def get_classification(self, payload):
+        '''
+        Answers like the Deberta zero-shot classifier with the scores of a recorded response, given to the candidate
+        labels by their frequency in the input. The input is sent back as the sequence, as the live endpoint does.
+        '''
+        text = payload['inputs']
+        labels = payload['parameters']['candidate_labels']
+        scores = sorted(self.get_recorded(self.classifications, text)['scores'], reverse=True)
+        scores += [scores[-1]] * (len(labels) - len(scores))
+        ranked = sorted(labels, key=lambda label: text.lower().count(label.lower()), reverse=True)
+        return {'sequence': text, 'labels': ranked, 'scores': scores[:len(labels)]}
+
+class StubServer:
+    '''
+    One threaded HTTP server answering the Trends, publisher and inference paths.
+    '''
+
+    def __init__(self, data, trends=None, publishers=None, inference=None):
+        '''
+        Args:
+        data: StubData served
+        trends: StubConfig of the Trends paths
+        publishers: StubConfig of the article pages
+        inference: StubConfig of the Pegasus and Deberta paths
+        '''
+        self.data = data
+        self.configs = {'trends': trends or StubConfig(), 'publishers': publishers or StubConfig(), 'inference': inference or StubConfig()}
+        self.requests = {'trends': 0, 'publishers': 0, 'inference': 0}
+        self.lock = threading.Lock()
+        self.started = None
+        # bound to all interfaces so that every 127.0.0.x publisher host reaches it
+        self.server = ThreadingHTTPServer(('0.0.0.0', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        self.started = time.monotonic()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_env(self):
+        '''
+        Returns the environment variables that point the pipeline at the stubs.
+        '''
+        base = 'http://127.0.0.1:{}'.format(self.port)
+        return {
+            'google_news_url': base + '/trends/api/realtimetrends?hl=en-US&tz=-330&geo=IN',
+            'google_trends_stories_url': base + '/trends/api/stories/',
+            'API_pegasus': base + '/models/pegasus',
+            'API_Deberta': base + '/models/deberta',
+            'pegasus_authorisation_key': 'benchmark',
+            'deberta_authorisation_key': 'benchmark',
+        }
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path.startswith('/trends/api/realtimetrends'):
+                    self.answer('trends', lambda: (200, TRENDS_PREFIX + json.dumps(stub.data.get_realtime_trends()), 'application/json'))
+                elif path.startswith('/trends/api/stories/'):
+                    id = path.rsplit('/', 1)[1]
+                    self.answer('trends', lambda: (200, TRENDS_PREFIX + json.dumps(stub.data.get_story(id, stub.port)), 'application/json'))
+                elif path.startswith('/article/'):
+                    number = int(path.rsplit('/', 1)[1])
+                    self.answer('publishers', lambda: (200, stub.data.get_article_html(number), 'text/html; charset=utf-8'))
+                else:
+                    self.send_body(404, 'not found', 'text/plain')
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                path = urlparse(self.path).path
+                if path == '/models/pegasus':
+                    self.answer('inference', lambda: (200, json.dumps(stub.data.get_summary(payload)), 'application/json'))
+                elif path == '/models/deberta':
+                    self.answer('inference', lambda: (200, json.dumps(stub.data.get_classification(payload)), 'application/json'))
+                else:
+                    self.send_body(404, 'not found', 'text/plain')
+
+            def answer(self, kind, respond):
+                config = stub.configs[kind]
+                with stub.lock:
+                    stub.requests[kind] += 1
+                time.sleep(config.latency_ms / 1000.0)
+                loading = config.cold_start_seconds - (time.monotonic() - stub.started)
+                if kind == 'inference' and loading > 0:
+                    self.send_body(503, json.dumps({'error': 'Model is currently loading', 'estimated_time': loading}), 'application/json')
+                elif random.random() < config.error_rate:
+                    self.send_body(500, json.dumps({'error': 'stub error'}), 'application/json')
+                else:
+                    self.send_body(*respond())
+
+            def send_body(self, status, body, content_type):
+                body = body.encode('utf-8')
+                if status == 200 and self.command == 'GET':
+                    # validators as sent by most publishers, so that conditional requests are answered 304
+                    etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+                    if self.headers.get('If-None-Match') == etag:
+                        status, body = 304, b''
+                self.send_response(status)
+                if self.command == 'GET' and status in (200, 304):
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
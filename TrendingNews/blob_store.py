@@ -0,0 +1,95 @@
+"""
+This script defines the on-disk store of the article bodies, one file per content hash shared by the stories with the
+same text, so that a refresh keeps only a handle to every article text in memory
+"""
+
+import hashlib
+import threading
+import shutil
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+class BlobStore:
+    def __init__(self, path=None):
+        """
+        Opens the store of the calling process, in its own folder so that region shards never remove each other's files.
+
+        Args:
+            path (str): Folder of the stores, defaults to the article_blob_path env variable or article_blobs in the temp folder.
+        """
+        root = path or os.getenv("article_blob_path") or f'{os.getenv("temp_folder")}/article_blobs'
+        self.path = os.path.join(root, str(os.getpid()))
+        os.makedirs(self.path, exist_ok=True)
+        # handle to the number of stories holding it, its file being removed when the last one releases it
+        self.references = dict()
+        self.lock = threading.Lock()
+
+    def get_path(self, handle):
+        """
+        Returns the file of a handle, spread over 256 sub-folders.
+        """
+        return os.path.join(self.path, handle[:2], handle)
+
+    def put(self, text):
+        """
+        Writes a text unless the same text is already stored, and adds a reference to it.
+
+        Args:
+            text (str): Article text.
+
+        Returns:
+            handle (str): SHA-1 of the text, used to read it back and to release it.
+        """
+        data = text.encode('utf-8')
+        handle = hashlib.sha1(data).hexdigest()
+        path = self.get_path(handle)
+        with self.lock:
+            self.references[handle] = self.references.get(handle, 0) + 1
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # written aside and renamed, so that a reader never sees a partial file
+                temp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+        return handle
+
+    def get(self, handle):
+        """
+        Reads a stored text.
+
+        Args:
+            handle (str): Handle returned by put.
+
+        Returns:
+            text (str): Article text.
+        """
+        with open(self.get_path(handle), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def release(self, handle):
+        """
+        Removes a reference to a stored text, and the text once no story holds it anymore.
+
+        Args:
+            handle (str): Handle returned by put.
+        """
+        with self.lock:
+            count = self.references.pop(handle, 0) - 1
+            if count > 0:
+                self.references[handle] = count
+                return
+            try:
+                os.remove(self.get_path(handle))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """
+        Removes every text of the store, e.g. the ones of stories dropped during a refresh.
+        """
+        with self.lock:
+            self.references.clear()
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
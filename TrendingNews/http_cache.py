@@ -0,0 +1,129 @@
+"""
+This script defines a persistent HTTP cache of the Trends feeds and article pages: their body, ETag and Last-Modified,
+so that unchanged resources are revalidated with a conditional request or, within their TTL, served locally
+"""
+
+import sqlite3
+import threading
+import zlib
+import time
+import os
+from metrics import CACHE_LOOKUPS
+from dotenv import load_dotenv
+load_dotenv()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    body BLOB,
+    etag TEXT,
+    last_modified TEXT,
+    content_type TEXT,
+    fetched_at REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at);
+'''
+
+class HttpCache:
+    def __init__(self, path=None, max_bytes=None):
+        """
+        Opens the cache, shared by all threads of the process.
+
+        Args:
+            path (str): Location of the SQLite database, defaults to the http_cache_path env variable or http_cache.db in the temp folder.
+            max_bytes (int): Size bound of the compressed bodies, the least recently fetched ones are evicted beyond it.
+                Defaults to http_cache_max_bytes or 200 MB.
+        """
+        self.path = path or os.getenv("http_cache_path") or f'{os.getenv("temp_folder")}/http_cache.db'
+        self.max_bytes = int(max_bytes or os.getenv("http_cache_max_bytes", 200 * 1024 * 1024))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(SCHEMA)
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    def get(self, url):
+        """
+        Returns the cached response of a URL.
+
+        Args:
+            url (str): Requested URL.
+
+        Returns:
+            (dict): body (bytes), etag, last_modified, content_type and fetched_at, None if the URL is not cached.
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT body, etag, last_modified, content_type, fetched_at FROM pages WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'body': zlib.decompress(row[0]), 'etag': row[1], 'last_modified': row[2], 'content_type': row[3], 'fetched_at': row[4]}
+
+    def is_fresh(self, entry, ttl):
+        """
+        Checks whether a cached response can be served without any request.
+
+        Args:
+            entry (dict): Cached response returned by get.
+            ttl (float): Time to live of the response in seconds, 0 to always revalidate.
+        """
+        return entry is not None and time.time() - entry['fetched_at'] < ttl
+
+    def get_conditional_headers(self, entry):
+        """
+        Returns the headers that make a request conditional on the cached response having changed.
+
+        Args:
+            entry (dict): Cached response returned by get, or None.
+
+        Returns:
+            headers (dict): If-None-Match and If-Modified-Since headers, empty if the response has no validator.
+        """
+        headers = dict()
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record_lookup(self, result):
+        """
+        Counts a lookup in the metrics: 'fresh' served locally, 'revalidated' answered 304, 'miss' downloaded again.
+        """
+        CACHE_LOOKUPS.inc('http', result)
+
+    def touch(self, url):
+        """
+        Marks the cached response of a URL as fetched now, after a 304 Not Modified answer.
+
+        Args:
+            url (str): Requested URL.
+        """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE pages SET fetched_at = ? WHERE url = ?', (time.time(), url))
+
+    def set(self, url, body, headers):
+        """
+        Stores a response and evicts the least recently fetched ones while the cache is over its size bound.
+
+        Args:
+            url (str): Requested URL.
+            body (bytes): Response body.
+            headers (Mapping): Response headers, ETag, Last-Modified and Content-Type are kept.
+        """
+        compressed = zlib.compress(body, 6)
+        size = len(compressed)
+        with self.lock, self.conn:
+            old = self.conn.execute('SELECT size FROM pages WHERE url = ?', (url,)).fetchone()
+            self.total_bytes -= old[0] if old is not None else 0
+            self.conn.execute('INSERT OR REPLACE INTO pages (url, body, etag, last_modified, content_type, fetched_at, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (url, compressed, headers.get('ETag'), headers.get('Last-Modified'), headers.get('Content-Type'), time.time(), size))
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                rows = self.conn.execute('SELECT url, size FROM pages ORDER BY fetched_at LIMIT 100').fetchall()
+                for evict_url, evict_size in rows:
+                    self.conn.execute('DELETE FROM pages WHERE url = ?', (evict_url,))
+                    self.total_bytes -= evict_size
+                    if self.total_bytes <= self.max_bytes:
+                        break
@@ -0,0 +1,115 @@
+"""
+This script defines a persistent, content addressed cache for the responses of the inference APIs
+"""
+
+import sqlite3
+import threading
+import hashlib
+import json
+import time
+import os
+from metrics import CACHE_LOOKUPS
+from dotenv import load_dotenv
+load_dotenv()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT,
+    size INTEGER,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+'''
+
+class InferenceCache:
+    def __init__(self, path=None, max_bytes=None):
+        """
+        Opens the cache, shared by all threads of the process.
+
+        Args:
+            path (str): Location of the SQLite database, defaults to the inference_cache_path env variable or inference_cache.db in the temp folder.
+            max_bytes (int): Size bound of the stored responses, the least recently used ones are evicted beyond it. Defaults to inference_cache_max_bytes or 100 MB.
+        """
+        self.path = path or os.getenv("inference_cache_path") or f'{os.getenv("temp_folder")}/inference_cache.db'
+        self.max_bytes = int(max_bytes or os.getenv("inference_cache_max_bytes", 100 * 1024 * 1024))
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(SCHEMA)
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def make_key(self, endpoint, inputs, parameters=None):
+        """
+        Builds the cache key from the cleaned input text, the model endpoint and the request parameters.
+
+        Args:
+            endpoint (str): URL of the model API.
+            inputs (str): Input text of the request.
+            parameters (dict): Request parameters, e.g. the candidate labels.
+
+        Returns:
+            (str): SHA-256 hex digest identifying the request.
+        """
+        cleaned = ' '.join(inputs.split())
+        content = json.dumps([endpoint, cleaned, parameters], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response of a request and marks it as recently used.
+
+        Args:
+            key (str): Key built by make_key.
+
+        Returns:
+            Cached JSON response, None on a miss.
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc('inference', 'miss')
+                return None
+            self.hits += 1
+            CACHE_LOOKUPS.inc('inference', 'hit')
+            self.conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, response):
+        """
+        Stores a response and evicts the least recently used ones while the cache is over its size bound.
+
+        Args:
+            key (str): Key built by make_key.
+            response: JSON serializable response of the API.
+        """
+        value = json.dumps(response)
+        size = len(value.encode('utf-8'))
+        with self.lock, self.conn:
+            old = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.total_bytes -= old[0] if old is not None else 0
+            self.conn.execute('INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)',
+                              (key, value, size, time.time()))
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                rows = self.conn.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 100').fetchall()
+                for evict_key, evict_size in rows:
+                    self.conn.execute('DELETE FROM responses WHERE key = ?', (evict_key,))
+                    self.total_bytes -= evict_size
+                    if self.total_bytes <= self.max_bytes:
+                        break
+
+    def get_stats(self):
+        """
+        Returns the hit and miss counters of this process and the stored size.
+
+        Returns:
+            (dict): hits, misses, hit_rate and size_bytes.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size_bytes': self.total_bytes}
@@ -0,0 +1,208 @@
+"""
+This script defines the client shared by the huggingface inference API stages (Pegasus summaries and Deberta keywords)
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import random
+import time
+import os
+from metrics import EXTERNAL_SECONDS, RETRIES, COLD_START_WAITS, COLD_START_SECONDS, CIRCUIT_REJECTIONS
+from dotenv import load_dotenv
+load_dotenv()
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class InferenceError(Exception):
+    """
+    Raised when the inference API does not return a usable response within the retry budget.
+    """
+
+class InferenceRequestError(InferenceError):
+    """
+    Raised when the inference API rejects the request itself with a 4xx response, which says nothing about the endpoint health.
+    """
+
+class CircuitOpenError(InferenceError):
+    """
+    Raised without calling the API while the circuit breaker is open.
+    """
+
+class InferenceClient:
+    def __init__(self, api_url, headers, max_concurrency=None, max_retries=None, max_warmup_seconds=None,
+                 failure_threshold=None, reset_seconds=None, name=None):
+        """
+        Initializes a pooled client for one model endpoint, shared by every article of a stage.
+
+        Args:
+            api_url (str): URL of the model API.
+            headers (dict): Request headers, i.e. the authorisation header.
+            max_concurrency (int): Maximum number of requests in flight, defaults to the inference_concurrency env variable or 4.
+            max_retries (int): Retry budget of one call for 429/5xx responses and connection errors, defaults to inference_max_retries or 4.
+            max_warmup_seconds (int): Longest total wait of one call for a cold model to load, defaults to inference_max_warmup_seconds or 600.
+            failure_threshold (int): Consecutive failed calls that open the circuit, defaults to inference_failure_threshold or 5.
+            reset_seconds (int): Time the circuit stays open before a trial call is let through, defaults to inference_reset_seconds or 120.
+            name (str): Name of the model in the metrics, defaults to the API URL.
+        """
+        self.api_url = api_url
+        self.name = name or api_url
+        self.max_concurrency = int(max_concurrency or os.getenv("inference_concurrency", 4))
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv("inference_max_retries", 4))
+        self.max_warmup_seconds = float(max_warmup_seconds or os.getenv("inference_max_warmup_seconds", 600))
+        self.failure_threshold = int(failure_threshold or os.getenv("inference_failure_threshold", 5))
+        self.reset_seconds = float(reset_seconds or os.getenv("inference_reset_seconds", 120))
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.slots = threading.BoundedSemaphore(self.max_concurrency)
+
+        # warm-up and circuit breaker state, shared by all threads
+        self.lock = threading.Lock()
+        self.ready_at = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        # requests sent to the API, the refresh scheduler budgets them
+        self.request_count = 0
+
+    def post(self, payload):
+        """
+        Posts a payload to the model API and returns its JSON response.
+
+        A cold model response makes every caller of this client wait for the same estimated load time, 429/5xx
+        responses are retried with exponential backoff and after failure_threshold failed calls in a row the
+        circuit opens and calls fail fast for reset_seconds. Only 429/5xx responses, timeouts and connection errors
+        count as failures, a 4xx response being an error of the caller.
+
+        Args:
+            payload (dict): Payload for the POST request.
+
+        Returns:
+            dict: JSON response from the API.
+
+        Raises:
+            CircuitOpenError: if the endpoint is considered down.
+            InferenceRequestError: if the API rejected the payload with a 4xx response.
+            InferenceError: if no usable response was received within the retry and warm-up budgets.
+        """
+        trial = self.before_call()
+        try:
+            response = self.post_with_retries(payload)
+        except InferenceRequestError:
+            self.record_result(None, trial)
+            raise
+        except InferenceError:
+            self.record_result(False, trial)
+            raise
+        except Exception:
+            self.record_result(None, trial)
+            raise
+        self.record_result(True, trial)
+        return response
+
+    def post_with_retries(self, payload):
+        """
+        Posts the payload, waiting for a cold model and retrying transient errors within the budgets.
+
+        Args:
+            payload (dict): Payload for the POST request.
+
+        Returns:
+            dict: JSON response from the API.
+        """
+        retries, warmup_waited = 0, 0.0
+        while True:
+            self.wait_until_ready()
+            response = None
+            try:
+                with self.slots:
+                    with self.lock:
+                        self.request_count += 1
+                    start = time.monotonic()
+                    response = self.session.post(self.api_url, json=payload, timeout=120)
+                    EXTERNAL_SECONDS.observe(time.monotonic() - start, self.name, str(response.status_code))
+                result = response.json() if response.content else {}
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                if response is None:
+                    # a connection error or timeout, an unparsable body was already timed
+                    EXTERNAL_SECONDS.observe(time.monotonic() - start, self.name, 'error')
+                response, result = None, {'error': str(e)}
+
+            if isinstance(result, dict) and 'error' in result and 'estimated_time' in result:
+                # the model is loading, hold back every caller until it is expected to be ready
+                wait = float(result['estimated_time']) + 5
+                if warmup_waited + wait > self.max_warmup_seconds:
+                    raise InferenceError("Model at {} did not load within {}s".format(self.api_url, self.max_warmup_seconds))
+                warmup_waited += wait
+                COLD_START_WAITS.inc(self.name)
+                COLD_START_SECONDS.inc(self.name, amount=wait)
+                with self.lock:
+                    self.ready_at = max(self.ready_at, time.monotonic() + wait)
+                continue
+
+            if response is not None and response.status_code < 400:
+                return result
+            if response is not None and response.status_code < 500 and response.status_code not in RETRY_STATUS_CODES:
+                raise InferenceRequestError("{} from {}: {}".format(response.status_code, self.api_url, result))
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                raise InferenceError("{} from {}: {}".format(response.status_code, self.api_url, result))
+            if retries == self.max_retries:
+                raise InferenceError("No response from {} after {} retries: {}".format(self.api_url, retries, result))
+            RETRIES.inc(self.name)
+            time.sleep(min(60, 2 ** retries) + random.uniform(0, 1))
+            retries += 1
+
+    def wait_until_ready(self):
+        """
+        Sleeps until the shared warm-up deadline set by a cold model response has passed.
+        """
+        while True:
+            with self.lock:
+                wait = self.ready_at - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def before_call(self):
+        """
+        Checks the circuit breaker, letting a single trial call through once the open period is over.
+
+        Returns:
+            trial (bool): True if the call is the trial call of the half-open circuit.
+
+        Raises:
+            CircuitOpenError: if the circuit is open.
+        """
+        with self.lock:
+            if self.consecutive_failures < self.failure_threshold:
+                return False
+            if time.monotonic() < self.open_until or self.trial_in_flight:
+                CIRCUIT_REJECTIONS.inc(self.name)
+                raise CircuitOpenError("Circuit open for {}".format(self.api_url))
+            self.trial_in_flight = True
+            return True
+
+    def record_result(self, success, trial=False):
+        """
+        Updates the circuit breaker with the outcome of a call.
+
+        Args:
+            success (bool): Whether the call returned a usable response, None if its outcome says nothing about the
+                endpoint health, e.g. a 4xx response.
+            trial (bool): Whether the call is the trial call, only the trial call ends the half-open state.
+        """
+        with self.lock:
+            if trial:
+                self.trial_in_flight = False
+            if success is None:
+                return
+            if success:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.reset_seconds
@@ -0,0 +1,179 @@
+"""
+This script runs the trending news refresh as a background job whose progress is kept in the news store
+"""
+
+import threading
+import traceback
+import os
+from news_store import NewsStore
+from metrics import RUNS
+from dotenv import load_dotenv
+load_dotenv()
+
+class JobAlreadyRunning(Exception):
+    """
+    Raised when a refresh is requested while another one is running.
+    """
+    def __init__(self, job_id):
+        super().__init__("Refresh job {} is already running".format(job_id))
+        self.job_id = job_id
+
+class RefreshJobRunner:
+    def __init__(self, store=None):
+        """
+        Initializes the runner of the background refresh jobs, one per server process.
+
+        Args:
+            store (NewsStore): Store holding the jobs, a new one is opened if not given.
+        """
+        self.store = store or NewsStore()
+        self.stale_seconds = float(os.getenv("job_stale_seconds", 600))
+        self.heartbeat_seconds = min(30.0, self.stale_seconds / 4)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.job_id = None
+        self.pipeline = None
+
+    def start(self):
+        """
+        Starts a refresh job in a background thread. An interrupted job is resumed instead of starting a new one.
+
+        Returns:
+            (tuple): (job id, True if an interrupted job was resumed)
+
+        Raises:
+            JobAlreadyRunning: if a refresh job is running in this or another server process.
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                raise JobAlreadyRunning(self.job_id)
+            job_id = self.store.claim_interrupted_job(self.stale_seconds)
+            resumed = job_id is not None
+            if not resumed:
+                job_id, running_id = self.store.create_job(self.stale_seconds)
+                if job_id is None:
+                    raise JobAlreadyRunning(running_id)
+            self.job_id = job_id
+            self.pipeline = None
+            self.thread = threading.Thread(target=self.run_job, args=(job_id,), name='refresh-{}'.format(job_id), daemon=True)
+            self.thread.start()
+        return job_id, resumed
+
+    def run_job(self, job_id):
+        """
+        Runs the update of a job while keeping its heartbeat and records how it ended.
+
+        Args:
+            job_id (str): ID of the job.
+        """
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self.beat, args=(job_id, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        try:
+            self.run_update(job_id)
+            self.store.update_job(job_id, status='completed', progress=self.get_progress())
+        except Exception as e:
+            traceback.print_exc()
+            RUNS.inc('failed')
+            self.store.update_job(job_id, status='failed', progress=self.get_progress(), error=traceback.format_exc())
+        finally:
+            stop_heartbeat.set()
+
+    def run_update(self, job_id):
+        """
+        Runs the update pipeline for a job, skipping the stories it finished before it was interrupted.
+
+        Args:
+            job_id (str): ID of the job.
+        """
+        # imported here so that serving requests does not load the pipeline modules
+        from pipeline import StreamingPipeline
+        from trending_news import get_regions
+        if len(get_regions()) > 0:
+            from sharded_ingestion import ShardedIngestion
+            self.pipeline = ShardedIngestion(self.store)
+            self.pipeline.run(job_id)
+            return
+
+        self.pipeline = StreamingPipeline(self.store)
+        job = self.store.get_job(job_id)
+        story_ids = job['story_ids']
+        if story_ids is None:
+            story_ids = self.pipeline.news.filter_story_ids(self.pipeline.news.get_trending_story_ids())
+            self.store.update_job(job_id, story_ids=story_ids)
+
+        finished = self.store.get_job_stories(job_id)
+        finished_ids = {story['id'] for story in finished}
+        remaining_ids = [id for id in story_ids if id not in finished_ids]
+        self.pipeline.run(remaining_ids, filter_seen=False, finished=finished, on_story=self.get_story_recorder(job_id))
+
+    def get_story_recorder(self, job_id):
+        """
+        Returns the callback that saves every finished story of a job, so that an interrupted job can resume.
+        """
+        def on_story(story):
+            self.store.add_job_story(job_id, story)
+            self.store.update_job(job_id, progress=self.get_progress())
+        return on_story
+
+    def beat(self, job_id, stop):
+        """
+        Refreshes the heartbeat of a running job, a job whose heartbeat stops is considered interrupted.
+
+        Args:
+            job_id (str): ID of the job.
+            stop (threading.Event): Set when the job ends.
+        """
+        while not stop.wait(self.heartbeat_seconds):
+            try:
+                self.store.update_job(job_id, progress=self.get_progress())
+            except Exception as e:
+                traceback.print_exc()
+
+    def get_progress(self):
+        """
+        Returns the live per-stage counts and errors of the running pipeline.
+
+        Returns:
+            (dict): stages and errors of the pipeline, None before the pipeline started.
+        """
+        if self.pipeline is None:
+            return None
+        return {'stages': self.pipeline.get_stats(), 'errors': self.pipeline.get_errors()}
+
+    def get_total(self, story_ids):
+        """
+        Returns the number of stories of a job, whose story_ids are a list or, for a sharded job, the lists of
+        story IDs trending in every region.
+        """
+        if story_ids is None:
+            return None
+        if isinstance(story_ids, dict):
+            return len({id for ids in story_ids.values() for id in ids})
+        return len(story_ids)
+
+    def get_status(self, job_id):
+        """
+        Returns the status of a job for the /jobs endpoint.
+
+        Args:
+            job_id (str): ID of the job.
+
+        Returns:
+            status (dict): id, status, created_at, total and completed story counts, per-stage progress and error, None if unknown.
+        """
+        job = self.store.get_job(job_id)
+        if job is None:
+            return None
+        progress = job['progress']
+        if job_id == self.job_id and job['status'] == 'running' and self.pipeline is not None:
+            progress = self.get_progress()
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'created_at': job['created_at'],
+            'total': self.get_total(job['story_ids']),
+            'completed': job['completed'],
+            'progress': progress,
+            'error': job['error'],
+        }
@@ -0,0 +1,263 @@
+"""
+This script defines the in-process metrics of the update: per-stage story timings and drops, external call latencies,
+retries, cold-start waits and cache hit rates, exposed in the Prometheus text format on /metrics
+"""
+
+import threading
+import bisect
+
+# seconds, from a cached lookup up to a cold model or a slow publisher
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def get_percentile(values, percentile):
+    '''
+    Returns the nearest-rank percentile of a list of values, None if it is empty.
+    '''
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(percentile / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+def format_labels(names, values, extra=()):
+    '''
+    Formats label names and values as a Prometheus label set, '' if there is none.
+    '''
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for name, value in pairs]
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+class Counter:
+    '''
+    Monotonic counter, one value per label set.
+    '''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        '''
+        Adds an amount to the value of a label set, labels given in the order of labelnames.
+        '''
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get_values(self):
+        '''
+        Returns the label sets and their values.
+        '''
+        with self.lock:
+            return dict(self.values)
+
+    def get_state(self):
+        '''
+        Returns the label sets and their values, see MetricsRegistry.get_state.
+        '''
+        return self.get_values()
+
+    def get_state_change(self, value, old):
+        '''
+        Returns the increase of the state of a label set since an old state, None if there is none.
+        '''
+        change = value - (old or 0)
+        return change if change != 0 else None
+
+    def add_state(self, labels, change):
+        '''
+        Adds the increase of a label set measured in another process.
+        '''
+        self.inc(*labels, amount=change)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        for labels, value in sorted(self.get_values().items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labelnames, labels), value))
+        return lines
+
+class Histogram:
+    '''
+    Histogram of durations, one set of cumulative buckets per label set.
+    '''
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        '''
+        Records a duration for a label set, labels given in the order of labelnames.
+        '''
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def get_values(self):
+        '''
+        Returns the label sets and their count and sum.
+        '''
+        with self.lock:
+            return {labels: {'count': sum(counts), 'sum': total} for labels, (counts, total) in self.values.items()}
+
+    def get_state(self):
+        '''
+        Returns the label sets and their bucket counts and sum, see MetricsRegistry.get_state.
+        '''
+        with self.lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+
+    def get_state_change(self, value, old):
+        '''
+        Returns the increase of the bucket counts and sum of a label set since an old state, None if there is none.
+        '''
+        counts, total = value
+        old_counts, old_total = old or ([0] * len(counts), 0.0)
+        if sum(counts) == sum(old_counts):
+            return None
+        return [count - old_count for count, old_count in zip(counts, old_counts)], total - old_total
+
+    def add_state(self, labels, change):
+        '''
+        Adds the increase of the bucket counts and sum of a label set measured in another process.
+        '''
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            self.values[labels] = ([count + added for count, added in zip(counts, change[0])], total + change[1])
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            values = sorted((labels, list(counts), total) for labels, (counts, total) in self.values.items())
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.labelnames, labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labelnames, labels), total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+class MetricsRegistry:
+    '''
+    The metrics of the process, shared by the pipeline running in the server and the /metrics endpoint.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''
+        Returns all the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def get_values(self):
+        '''
+        Returns the current value of every metric, keyed by metric name and comma joined labels.
+        '''
+        return {metric.name: {','.join(labels): value for labels, value in metric.get_values().items()} for metric in self.metrics}
+
+    def get_changes(self, before):
+        '''
+        Returns what changed since an earlier get_values, e.g. the activity of one update run.
+
+        Args:
+            before (dict): Result of an earlier get_values call.
+
+        Returns:
+            (dict): Metric name to label set to the increase of its value, or of its count and sum for a histogram.
+        '''
+        changes = dict()
+        for name, values in self.get_values().items():
+            for labels, value in values.items():
+                old = before.get(name, {}).get(labels)
+                if isinstance(value, dict):
+                    old = old or {'count': 0, 'sum': 0.0}
+                    change = {'count': value['count'] - old['count'], 'sum': value['sum'] - old['sum']}
+                    if change['count'] == 0:
+                        continue
+                else:
+                    change = value - (old or 0)
+                    if change == 0:
+                        continue
+                changes.setdefault(name, dict())[labels] = change
+        return changes
+
+    def get_state(self):
+        '''
+        Returns the raw state of every metric, keeping the histogram buckets, to measure the activity of a worker
+        process with get_state_changes.
+        '''
+        return {metric.name: metric.get_state() for metric in self.metrics}
+
+    def get_state_changes(self, before, after=None):
+        '''
+        Returns what changed since an earlier get_state, to be added to the registry of another process with add_state_changes.
+
+        Args:
+            before (dict): Result of an earlier get_state call.
+            after (dict): Result of a later get_state call, the current state if not given.
+
+        Returns:
+            (dict): Metric name to label set tuple to the increase of its state.
+        '''
+        after = after if after is not None else self.get_state()
+        changes = dict()
+        for metric in self.metrics:
+            old_state = before.get(metric.name, {})
+            for labels, value in after.get(metric.name, {}).items():
+                change = metric.get_state_change(value, old_state.get(labels))
+                if change is not None:
+                    changes.setdefault(metric.name, dict())[labels] = change
+        return changes
+
+    def add_state_changes(self, changes):
+        '''
+        Adds the changes of the metrics of another process, e.g. a worker of a sharded update.
+
+        Args:
+            changes (dict): Result of get_state_changes in the other process.
+        '''
+        metrics = {metric.name: metric for metric in self.metrics}
+        for name, values in changes.items():
+            if name in metrics:
+                for labels, change in values.items():
+                    metrics[name].add_state(labels, change)
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram('trending_news_stage_seconds', 'Time a pipeline stage spent on one story', ['stage'])
+STAGE_STORIES = registry.counter('trending_news_stage_stories_total', 'Stories processed by a pipeline stage', ['stage'])
+STORIES_DROPPED = registry.counter('trending_news_stories_dropped_total', 'Stories dropped by a pipeline stage', ['stage', 'reason'])
+EXTERNAL_SECONDS = registry.histogram('trending_news_external_request_seconds', 'Latency of one external HTTP request', ['service', 'outcome'])
+RETRIES = registry.counter('trending_news_retries_total', 'External requests retried after a 429/5xx or connection error', ['service'])
+COLD_START_WAITS = registry.counter('trending_news_cold_start_waits_total', 'Model loading responses that made the callers wait', ['service'])
+COLD_START_SECONDS = registry.counter('trending_news_cold_start_wait_seconds_total', 'Time announced by the model loading responses', ['service'])
+CIRCUIT_REJECTIONS = registry.counter('trending_news_circuit_rejections_total', 'Calls refused while the circuit breaker was open', ['service'])
+CACHE_LOOKUPS = registry.counter('trending_news_cache_lookups_total', 'Cache lookups by result', ['cache', 'result'])
+EXTRACTIONS = registry.counter('trending_news_article_extractions_total', 'Article texts by extractor: fast, newspaper or newspaper fallback after the fast one', ['method'])
+SUMMARY_ROUTES = registry.counter('trending_news_summary_routes_total', 'Summaries by route: local, remote or local fallback after a failed remote call', ['route'])
+RUNS = registry.counter('trending_news_runs_total', 'Finished update runs by status', ['status'])
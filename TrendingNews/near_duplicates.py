@@ -0,0 +1,242 @@
+"""
+This script detects near-duplicate stories from their article text with MinHash signatures and LSH banding, so that
+several trending IDs of the same event are summarized, scored and tagged only once
+"""
+
+from collections.abc import Mapping
+import numpy as np
+import threading
+import zlib
+import re
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# Mersenne prime of the universal hash functions, the products of 31 bit values fit in 64 bits
+PRIME = (1 << 31) - 1
+# fixed seed, so that the signatures stored in earlier refreshes stay comparable
+SEED = 7
+SHINGLE_WORDS = 5
+WORD = re.compile(r"\w+")
+
+class NearDuplicates:
+    def __init__(self, store, threshold=None, num_perm=None, bands=None):
+        """
+        Initializes the detector whose signatures are kept in the news store beside the lookup table.
+
+        Args:
+            store (NewsStore): Store of the signatures.
+            threshold (float): Estimated Jaccard similarity of the shingles above which two stories are duplicates,
+                defaults to the near_duplicate_threshold env variable or 0.7.
+            num_perm (int): Number of hash functions of a signature, defaults to minhash_permutations or 128.
+            bands (int): Number of LSH bands the signature is split into, defaults to lsh_bands or 32.
+        """
+        self.store = store
+        self.threshold = float(threshold or os.getenv("near_duplicate_threshold", 0.7))
+        self.num_perm = int(num_perm or os.getenv("minhash_permutations", 128))
+        self.bands = int(bands or os.getenv("lsh_bands", 32))
+        self.rows = self.num_perm // self.bands
+        random_state = np.random.RandomState(SEED)
+        self.a = random_state.randint(1, PRIME, size=self.num_perm, dtype=np.uint64)
+        self.b = random_state.randint(0, PRIME, size=self.num_perm, dtype=np.uint64)
+        self.lock = threading.Lock()
+        # copies of the fields of the stories of this update that duplicates are merged into, by story ID
+        self.run_stories = dict()
+        # signatures of the stories of this update that are not finished yet, stored only once they are
+        self.pending = dict()
+        self.duplicate_of = dict()
+
+    def start_run(self, stories=()):
+        """
+        Forgets the stories of the previous update, a duplicate of them is now dropped instead of merged.
+
+        Args:
+            stories (list): Stories already finished in this update, e.g. by an interrupted job, duplicates are merged into them.
+        """
+        with self.lock:
+            self.run_stories = {story['id']: self.get_merge_fields(story) for story in stories}
+            self.pending = dict()
+            self.duplicate_of = dict()
+
+    def get_merge_fields(self, story):
+        """
+        Returns a copy of the fields of a story that its duplicates are merged into.
+        """
+        return {'all_articles_keywords': list(story.get('all_articles_keywords') or []),
+                'duplicate_ids': list(story.get('duplicate_ids') or []),
+                'regions': list(story['regions']) if 'regions' in story else None}
+
+    def get_shingles(self, text):
+        """
+        Returns the hashes of the overlapping word SHINGLE_WORDS-grams of a text.
+
+        Args:
+            text (str): Article text.
+
+        Returns:
+            (numpy array): Distinct 31 bit shingle hashes.
+        """
+        words = WORD.findall(text.lower())
+        shingles = {' '.join(words[k:k + SHINGLE_WORDS]) for k in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+        return np.array([zlib.crc32(shingle.encode('utf-8')) % PRIME for shingle in shingles], dtype=np.uint64)
+
+    def get_signature(self, text):
+        """
+        Computes the MinHash signature of a text, the minimum of every hash function over its shingles.
+
+        Args:
+            text (str): Article text.
+
+        Returns:
+            (numpy array): num_perm 32 bit values.
+        """
+        shingles = self.get_shingles(text)
+        hashes = (self.a[:, None] * shingles[None, :] + self.b[:, None]) % PRIME
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def get_bands(self, signature):
+        """
+        Returns the LSH band keys of a signature, two stories sharing any band being compared.
+        The layout is part of the key so that signatures of another configuration never match.
+
+        Args:
+            signature (numpy array): MinHash signature.
+
+        Returns:
+            (list): Band keys.
+        """
+        return ['{}x{}:{}:{:08x}'.format(self.bands, self.rows, band, zlib.crc32(signature[band * self.rows:(band + 1) * self.rows].tobytes()))
+                for band in range(self.bands)]
+
+    def get_similarity(self, signature, other):
+        """
+        Estimates the Jaccard similarity of two stories from their signatures.
+        """
+        if len(other) != len(signature):
+            return 0.0
+        return float(np.mean(signature == other))
+
+    def find_duplicate(self, id, signature, candidates):
+        """
+        Returns the ID of the most similar candidate at or above the threshold, None if there is none.
+
+        Args:
+            id (str): ID of the story checked, never its own duplicate.
+            signature (numpy array): MinHash signature of the story.
+            candidates (list): (id, signature) pairs, the signatures as bytes or numpy arrays.
+        """
+        best_id, best_similarity = None, 0.0
+        for other_id, other in candidates:
+            if other_id == id:
+                continue
+            if isinstance(other, bytes):
+                other = np.frombuffer(other, dtype=np.uint32)
+            similarity = self.get_similarity(signature, other)
+            if similarity >= self.threshold and similarity > best_similarity:
+                best_id, best_similarity = other_id, similarity
+        return best_id
+
+    def check_story(self, story):
+        """
+        Checks a story with its article text against the stories seen in this and the earlier updates.
+
+        A duplicate of a story of this update is merged into it, see get_merged. A duplicate of a story of an earlier
+        update, or of another process sharing the store, is dropped and recorded in duplicate_of. The signature of a
+        new story is kept aside until finish stores it, so that a story that fails or is held back in a later stage
+        suppresses no copy of it.
+
+        Args:
+            story (dict): Story dictionary with the article text.
+
+        Returns:
+            story (dict): The story if it is new, None if it is a duplicate.
+        """
+        signature = self.get_signature(story['article_text'])
+        bands = self.get_bands(signature)
+        with self.lock:
+            candidates = self.store.get_story_signatures(bands)
+            candidates += [(id, pending[0]) for id, pending in self.pending.items()]
+            best_id = self.find_duplicate(story['id'], signature, candidates)
+            if best_id is None:
+                self.pending[story['id']] = (signature, bands)
+                self.run_stories[story['id']] = self.get_merge_fields(story)
+                return story
+
+            if best_id in self.run_stories:
+                self.merge(self.run_stories[best_id], story)
+            else:
+                self.duplicate_of[story['id']] = best_id
+            return None
+
+    def finish(self, story):
+        """
+        Stores the signature of a story that went through every stage, unless a copy of it was stored by another
+        process sharing the store in the meantime, e.g. a region shard, in which case the story is dropped.
+
+        Args:
+            story (dict): Finished story.
+
+        Returns:
+            story (dict): The story, None if it is a duplicate.
+        """
+        with self.lock:
+            pending = self.pending.pop(story['id'], None)
+            if pending is None:
+                return story
+            signature, bands = pending
+            best_id = self.store.check_story_signature(story['id'], signature.tobytes(), bands,
+                                                       lambda rows: self.find_duplicate(story['id'], signature, rows))
+            if best_id is None:
+                return story
+            fields = self.run_stories.pop(story['id'])
+            for id in [story['id']] + fields['duplicate_ids']:
+                self.duplicate_of[id] = best_id
+            return None
+
+    def discard(self, story):
+        """
+        Forgets a story dropped after check_story, e.g. failed or held back, so that its later copies are processed.
+
+        Args:
+            story: Story dictionary or ID dropped by a stage.
+        """
+        # a StoryRecord in disk mode, unhashable, rather than a dict
+        id = story['id'] if isinstance(story, Mapping) else story
+        with self.lock:
+            if self.pending.pop(id, None) is not None:
+                self.run_stories.pop(id, None)
+
+    def get_merged(self, story):
+        """
+        Returns the story with the duplicates merged into it: the union of their all_articles_keywords and regions
+        and their IDs in duplicate_ids. The merge goes into a copy, as the story may be in a later stage meanwhile.
+
+        Args:
+            story (dict): Story of this update.
+
+        Returns:
+            story (dict): A merged copy of the story, the story itself if nothing was merged into it.
+        """
+        with self.lock:
+            fields = self.run_stories.get(story['id'])
+            if fields is None or len(fields['duplicate_ids']) == len(story.get('duplicate_ids') or []):
+                return story
+            merged = dict(story, all_articles_keywords=list(fields['all_articles_keywords']), duplicate_ids=list(fields['duplicate_ids']))
+            if fields['regions'] is not None:
+                merged['regions'] = list(fields['regions'])
+            return merged
+
+    def merge(self, fields, duplicate):
+        """
+        Merges a duplicate into the copied fields of the original story.
+
+        Args:
+            fields (dict): Fields of the story kept, see get_merge_fields.
+            duplicate (dict): Story merged into it.
+        """
+        keywords = fields['all_articles_keywords']
+        keywords += [keyword for keyword in duplicate.get('all_articles_keywords') or [] if keyword not in keywords]
+        fields['duplicate_ids'].append(duplicate['id'])
+        if 'regions' in duplicate:
+            regions = fields['regions'] or []
+            fields['regions'] = regions + [region for region in duplicate['regions'] if region not in regions]
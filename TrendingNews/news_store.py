@@ -0,0 +1,588 @@
+"""
+This script defines the SQLite store for the trending IDs lookup table and the published news snapshots
+"""
+
+import sqlite3
+import threading
+import json
+import csv
+import time
+import uuid
+import sys
+import os
+from datetime import datetime
+from dotenv import load_dotenv
+from render_view import build_render_view
+load_dotenv()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trending_ids (
+    id TEXT PRIMARY KEY,
+    story TEXT,
+    first_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT,
+    story_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS snapshot_stories (
+    version INTEGER,
+    position INTEGER,
+    story_id TEXT,
+    info TEXT,
+    PRIMARY KEY (version, position)
+);
+CREATE INDEX IF NOT EXISTS snapshot_stories_story ON snapshot_stories (version, story_id);
+CREATE TABLE IF NOT EXISTS snapshot_terms (
+    version INTEGER,
+    kind TEXT,
+    term TEXT,
+    position INTEGER
+);
+CREATE INDEX IF NOT EXISTS snapshot_terms_lookup ON snapshot_terms (version, kind, term, position);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT,
+    created_at TEXT,
+    heartbeat REAL,
+    story_ids TEXT,
+    progress TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS job_stories (
+    job_id TEXT,
+    story_id TEXT,
+    info TEXT,
+    PRIMARY KEY (job_id, story_id)
+);
+CREATE TABLE IF NOT EXISTS story_signatures (
+    id TEXT PRIMARY KEY,
+    signature BLOB,
+    first_seen TEXT
+);
+CREATE TABLE IF NOT EXISTS signature_bands (
+    band TEXT,
+    id TEXT,
+    PRIMARY KEY (band, id)
+);
+CREATE TABLE IF NOT EXISTS pending_stories (
+    id TEXT PRIMARY KEY,
+    info TEXT,
+    first_seen REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+def encode_story(story):
+    """
+    Encodes a story dictionary, or a StoryRecord, as JSON.
+    """
+    return json.dumps(story if isinstance(story, dict) else dict(story))
+
+def get_default_store_path():
+    """
+    Returns the path of the store, the news_store_path env variable or trending_news.db in the temp folder.
+    """
+    return os.getenv("news_store_path") or f'{os.getenv("temp_folder")}/trending_news.db'
+
+class NewsStore:
+    def __init__(self, path=None, retain_versions=None):
+        """
+        Opens the store, creates the tables and migrates the old CSV files the first time.
+
+        Args:
+            path (str): Location of the SQLite database, defaults to get_default_store_path().
+            retain_versions (int): Number of snapshot versions kept for deltas and paging, defaults to the snapshot_retain_versions env variable or 10.
+        """
+        self.path = path or get_default_store_path()
+        self.retain_versions = max(1, int(retain_versions or os.getenv("snapshot_retain_versions", 10)))
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+        self.migrate_csv_files()
+        self.index_current_snapshot()
+        self.render_snapshots()
+
+    def connection(self):
+        """
+        Returns the SQLite connection of the calling thread, opening it in WAL mode on first use.
+
+        Returns:
+            conn (sqlite3.Connection): Connection of the current thread.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def get_meta(self, key, default=None):
+        """
+        Reads a value from the meta table.
+
+        Args:
+            key (str): Name of the value.
+            default: Returned when the key is not set.
+
+        Returns:
+            (str): Stored value or default.
+        """
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def has_seen(self, id):
+        """
+        Checks the lookup table for a trending ID.
+
+        Args:
+            id (str): Trending story ID.
+
+        Returns:
+            (bool): True if the ID was processed before.
+        """
+        return self.connection().execute('SELECT 1 FROM trending_ids WHERE id = ?', (id,)).fetchone() is not None
+
+    def add_trending_ids(self, rows):
+        """
+        Appends trending IDs to the lookup table, IDs already present are kept as they are.
+
+        Args:
+            rows (list): List of (id, story) pairs, story being the article information dictionary.
+        """
+        first_seen = datetime.now().isoformat(timespec='seconds')
+        with self.connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO trending_ids (id, story, first_seen) VALUES (?, ?, ?)',
+                             [(id, json.dumps(story), first_seen) for id, story in rows])
+
+    def get_story_signatures(self, bands):
+        """
+        Returns the near-duplicate signatures sharing at least one LSH band with a story.
+
+        Args:
+            bands (list): LSH band keys of the signature of the story.
+
+        Returns:
+            (list): (id, signature bytes) pairs.
+        """
+        placeholders = ','.join('?' * len(bands))
+        return self.connection().execute(
+            'SELECT id, signature FROM story_signatures WHERE id IN (SELECT id FROM signature_bands WHERE band IN ({}))'.format(placeholders),
+            bands).fetchall()
+
+    def check_story_signature(self, id, signature, bands, find_duplicate):
+        """
+        Looks up the near-duplicate signatures sharing at least one LSH band with a story and stores the signature of
+        the story unless one of them is a duplicate. The lookup and the insert are one transaction, so that processes
+        checking copies of the same story at the same time, e.g. region shards, keep only one of them.
+
+        Args:
+            id (str): Trending story ID.
+            signature (bytes): MinHash signature.
+            bands (list): LSH band keys of the signature.
+            find_duplicate (callable): Called with the list of (id, signature bytes) pairs sharing a band, returns the ID
+                of the story duplicated or None.
+
+        Returns:
+            (str): ID of the story duplicated, None if the signature was stored.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            placeholders = ','.join('?' * len(bands))
+            rows = conn.execute(
+                'SELECT id, signature FROM story_signatures WHERE id IN (SELECT id FROM signature_bands WHERE band IN ({}))'.format(placeholders),
+                bands).fetchall()
+            duplicate_id = find_duplicate(rows)
+            if duplicate_id is None:
+                first_seen = datetime.now().isoformat(timespec='seconds')
+                conn.execute('INSERT OR REPLACE INTO story_signatures (id, signature, first_seen) VALUES (?, ?, ?)', (id, signature, first_seen))
+                conn.executemany('INSERT OR IGNORE INTO signature_bands (band, id) VALUES (?, ?)', [(band, id) for band in bands])
+            conn.commit()
+            return duplicate_id
+        except Exception:
+            conn.rollback()
+            raise
+
+    def publish_snapshot(self, stories):
+        """
+        Atomically replaces the current news snapshot, readers see either the old or the new snapshot.
+        The last retain_versions versions are kept, so that clients can sync from them with a delta.
+
+        Args:
+            stories (list): List of story dictionaries.
+
+        Returns:
+            version (int): Version of the published snapshot.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute('INSERT INTO snapshots (created_at, story_count) VALUES (?, 0)',
+                                  (datetime.now().isoformat(timespec='seconds'),))
+            version = cursor.lastrowid
+            count = 0
+            for position, story in enumerate(stories):
+                if 'render' not in story:
+                    story = dict(story, render=build_render_view(story))
+                conn.execute('INSERT INTO snapshot_stories (version, position, story_id, info) VALUES (?, ?, ?, ?)',
+                             (version, position, story.get('id'), encode_story(story)))
+                conn.executemany('INSERT INTO snapshot_terms (version, kind, term, position) VALUES (?, ?, ?, ?)',
+                                 [(version, kind, term, position) for kind, term in self.get_story_terms(story)])
+                count += 1
+            conn.execute('UPDATE snapshots SET story_count = ? WHERE version = ?', (count, version))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('current_version', ?)", (str(version),))
+            oldest = version - self.retain_versions + 1
+            conn.execute('DELETE FROM snapshot_stories WHERE version < ?', (oldest,))
+            conn.execute('DELETE FROM snapshot_terms WHERE version < ?', (oldest,))
+            conn.execute('DELETE FROM snapshots WHERE version < ?', (oldest,))
+        return version
+
+    def get_story_terms(self, story):
+        """
+        Returns the inverted index terms of a story: its named entities, its keywords, its source and its date.
+
+        Args:
+            story (dict): Story dictionary.
+
+        Returns:
+            terms (set): Set of (kind, term) pairs, the terms being lower-cased except for the date.
+        """
+        terms = set()
+        for entity in story.get('NER') or []:
+            terms.add(('entity', entity.strip().lower()))
+        for keyword in (story.get('final_keywords') or []) + (story.get('all_articles_keywords') or []):
+            terms.add(('keyword', keyword.strip().lower()))
+        article = story.get('stories') or {}
+        if article.get('source'):
+            terms.add(('source', article['source'].strip().lower()))
+        if article.get('date'):
+            terms.add(('date', article['date']))
+        return terms
+
+    def index_current_snapshot(self):
+        """
+        Builds the inverted index of the current snapshot once, for snapshots published before the index existed.
+        """
+        if self.get_meta('terms_indexed') is not None:
+            return
+        with self.connection() as conn:
+            version = self.get_current_version()
+            rows = conn.execute('SELECT position, info FROM snapshot_stories WHERE version = ?', (version,)).fetchall()
+            conn.execute('DELETE FROM snapshot_terms WHERE version = ?', (version,))
+            for position, info in rows:
+                conn.executemany('INSERT INTO snapshot_terms (version, kind, term, position) VALUES (?, ?, ?, ?)',
+                                 [(version, kind, term, position) for kind, term in self.get_story_terms(json.loads(info))])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('terms_indexed', ?)",
+                         (datetime.now().isoformat(timespec='seconds'),))
+
+    def render_snapshots(self):
+        """
+        Adds the render-ready view to the stories of the retained snapshots once, for snapshots published before the
+        pipeline built it, so that every served story has one.
+        """
+        if self.get_meta('stories_rendered') is not None:
+            return
+        with self.connection() as conn:
+            rows = conn.execute('SELECT version, position, info FROM snapshot_stories').fetchall()
+            for version, position, info in rows:
+                story = json.loads(info)
+                if 'render' not in story:
+                    story['render'] = build_render_view(story)
+                    conn.execute('UPDATE snapshot_stories SET info = ? WHERE version = ? AND position = ?',
+                                 (encode_story(story), version, position))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('stories_rendered', ?)",
+                         (datetime.now().isoformat(timespec='seconds'),))
+
+    def query_snapshot_json(self, version=None, filters=(), since=None, start=0, limit=None, offset=0):
+        """
+        Returns a page of the stories of a snapshot matching all the filters, served from the inverted index.
+
+        Args:
+            version (int): Snapshot version, the current one if not given.
+            filters (list): List of (kind, term) pairs the stories must all have, kind being entity, keyword or source.
+            since (str): Only stories dated on or after this YYYY-MM-DD date.
+            start (int): Position in the snapshot to start from, as returned for the next page.
+            limit (int): Maximum number of stories, all if not given.
+            offset (int): Number of matching stories from start to skip.
+
+        Returns:
+            (tuple): (version, list of story JSON strings, position of the next page or None), version being None if the snapshot does not exist.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            version = version if version is not None else self.get_current_version()
+            if conn.execute('SELECT 1 FROM snapshots WHERE version = ?', (version,)).fetchone() is None:
+                return None, [], None
+            sql = 'SELECT position, info FROM snapshot_stories WHERE version = ? AND position >= ?'
+            params = [version, start]
+            for kind, term in filters:
+                sql += ' AND position IN (SELECT position FROM snapshot_terms WHERE version = ? AND kind = ? AND term = ?)'
+                params += [version, kind, term.strip().lower()]
+            if since is not None:
+                sql += " AND position IN (SELECT position FROM snapshot_terms WHERE version = ? AND kind = 'date' AND term >= ?)"
+                params += [version, since]
+            # the offset counts the matching stories, not the positions in the snapshot
+            sql += ' ORDER BY position LIMIT ? OFFSET ?'
+            # one more row tells whether there is a next page
+            params += [limit + 1 if limit is not None else -1, offset]
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.rollback()
+        next_start = None
+        if limit is not None and len(rows) > limit:
+            next_start = rows[limit][0]
+            rows = rows[:limit]
+        return version, [row[1] for row in rows], next_start
+
+    def get_snapshot_delta(self, since_version):
+        """
+        Returns the changes from a retained snapshot version to the current one, read in one transaction.
+
+        Args:
+            since_version (int): Version the client has.
+
+        Returns:
+            delta (dict): version, added and changed story JSON strings, removed story IDs and the order of the story IDs
+                in the current version, None if since_version is not retained.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            version = self.get_current_version()
+            if version is None or since_version > version or \
+                    conn.execute('SELECT 1 FROM snapshots WHERE version = ?', (since_version,)).fetchone() is None:
+                return None
+            rows = conn.execute('''SELECT new.info, old.info IS NULL FROM snapshot_stories new
+                                   LEFT JOIN snapshot_stories old ON old.version = ? AND old.story_id = new.story_id
+                                   WHERE new.version = ? AND (old.info IS NULL OR old.info != new.info)
+                                   ORDER BY new.position''', (since_version, version)).fetchall()
+            removed = conn.execute('''SELECT story_id FROM snapshot_stories WHERE version = ? AND story_id NOT IN
+                                      (SELECT story_id FROM snapshot_stories WHERE version = ?) ORDER BY position''',
+                                   (since_version, version)).fetchall()
+            order = conn.execute('SELECT story_id FROM snapshot_stories WHERE version = ? ORDER BY position', (version,)).fetchall()
+        finally:
+            conn.rollback()
+        return {
+            'version': version,
+            'added': [info for info, added in rows if added],
+            'changed': [info for info, added in rows if not added],
+            'removed': [row[0] for row in removed],
+            'order': [row[0] for row in order],
+        }
+
+    def get_current_version(self):
+        """
+        Returns the version of the current snapshot, None if nothing was published yet.
+        """
+        version = self.get_meta('current_version')
+        return int(version) if version is not None else None
+
+    def get_current_stories(self):
+        """
+        Returns the stories of the current snapshot in their published order.
+
+        Returns:
+            stories (list): List of story dictionaries.
+        """
+        rows = self.connection().execute(
+            "SELECT info FROM snapshot_stories WHERE version = (SELECT CAST(value AS INTEGER) FROM meta WHERE key = 'current_version') ORDER BY position").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def add_pending_stories(self, stories):
+        """
+        Queues fetched stories for the refresh scheduler, a story already queued keeps the time it was first seen.
+
+        Args:
+            stories (list): List of story dictionaries with their first_seen timestamp.
+        """
+        with self.connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO pending_stories (id, info, first_seen) VALUES (?, ?, ?)',
+                             [(story['id'], encode_story(story), story['first_seen']) for story in stories])
+
+    def get_pending_stories(self, max_age_seconds):
+        """
+        Returns the stories queued for the refresh scheduler, dropping the ones queued for longer than max_age_seconds.
+
+        Args:
+            max_age_seconds (float): Age after which a story that was never processed is given up.
+
+        Returns:
+            stories (list): List of story dictionaries, oldest first.
+        """
+        with self.connection() as conn:
+            conn.execute('DELETE FROM pending_stories WHERE first_seen < ?', (time.time() - max_age_seconds,))
+            rows = conn.execute('SELECT info FROM pending_stories ORDER BY first_seen').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def remove_pending_stories(self, ids):
+        """
+        Removes processed stories from the scheduler queue.
+
+        Args:
+            ids (list): IDs of the stories.
+        """
+        with self.connection() as conn:
+            conn.executemany('DELETE FROM pending_stories WHERE id = ?', [(id,) for id in ids])
+
+    def get_current_snapshot_json(self):
+        """
+        Returns the current snapshot with the stories as their stored JSON text, read in one transaction so that
+        the version and the stories always match.
+
+        Returns:
+            (tuple): (version, list of story JSON strings), version being None if nothing was published yet.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            version = self.get_current_version()
+            rows = conn.execute('SELECT info FROM snapshot_stories WHERE version = ? ORDER BY position', (version,)).fetchall()
+        finally:
+            conn.rollback()
+        return version, [row[0] for row in rows]
+
+    def create_job(self, stale_seconds):
+        """
+        Creates a new refresh job unless another one is running, the check and the insert being one transaction
+        so that two processes cannot both start a refresh.
+
+        Args:
+            stale_seconds (float): A running job without heartbeat for this long is considered interrupted.
+
+        Returns:
+            (tuple): (job id, None) for the new job, or (None, running job id) if a job is already running.
+        """
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'running' AND heartbeat >= ?",
+                               (time.time() - stale_seconds,)).fetchone()
+            if row is not None:
+                conn.rollback()
+                return None, row[0]
+            job_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO jobs (id, status, created_at, heartbeat) VALUES (?, 'running', ?, ?)",
+                         (job_id, datetime.now().isoformat(timespec='seconds'), time.time()))
+            conn.commit()
+            return job_id, None
+        except Exception:
+            conn.rollback()
+            raise
+
+    def claim_interrupted_job(self, stale_seconds):
+        """
+        Takes over the most recent running job whose heartbeat stopped, e.g. because the server restarted.
+
+        Args:
+            stale_seconds (float): A running job without heartbeat for this long is considered interrupted.
+
+        Returns:
+            job_id (str): ID of the claimed job, None if there is no interrupted job.
+        """
+        with self.connection() as conn:
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'running' AND heartbeat < ? ORDER BY created_at DESC LIMIT 1",
+                               (time.time() - stale_seconds,)).fetchone()
+            if row is None:
+                return None
+            # the heartbeat condition makes the claim fail if another process claimed the job first
+            cursor = conn.execute("UPDATE jobs SET heartbeat = ?, error = NULL WHERE id = ? AND heartbeat < ?",
+                                  (time.time(), row[0], time.time() - stale_seconds))
+        return row[0] if cursor.rowcount == 1 else None
+
+    def update_job(self, job_id, status=None, story_ids=None, progress=None, error=None):
+        """
+        Updates the fields of a job that are given and its heartbeat.
+
+        Args:
+            job_id (str): ID of the job.
+            status (str): running, completed or failed.
+            story_ids (list): Story IDs the job processes, or region geo to story IDs for a sharded job.
+            progress (dict): Per-stage progress of the job.
+            error (str): Error that stopped the job.
+        """
+        fields = {'heartbeat': time.time()}
+        if status is not None:
+            fields['status'] = status
+        if story_ids is not None:
+            fields['story_ids'] = json.dumps(story_ids)
+        if progress is not None:
+            fields['progress'] = json.dumps(progress)
+        if error is not None:
+            fields['error'] = error
+        with self.connection() as conn:
+            conn.execute('UPDATE jobs SET {} WHERE id = ?'.format(', '.join('{} = ?'.format(name) for name in fields)),
+                         list(fields.values()) + [job_id])
+
+    def get_job(self, job_id):
+        """
+        Returns a job as a dictionary.
+
+        Args:
+            job_id (str): ID of the job.
+
+        Returns:
+            job (dict): id, status, created_at, heartbeat, story_ids, progress, error and completed story count, None if unknown.
+        """
+        row = self.connection().execute(
+            'SELECT id, status, created_at, heartbeat, story_ids, progress, error FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(['id', 'status', 'created_at', 'heartbeat', 'story_ids', 'progress', 'error'], row))
+        job['story_ids'] = json.loads(job['story_ids']) if job['story_ids'] is not None else None
+        job['progress'] = json.loads(job['progress']) if job['progress'] is not None else None
+        job['completed'] = self.connection().execute('SELECT COUNT(*) FROM job_stories WHERE job_id = ?', (job_id,)).fetchone()[0]
+        return job
+
+    def add_job_story(self, job_id, story):
+        """
+        Saves a story finished by a job, so that the job can resume after it.
+
+        Args:
+            job_id (str): ID of the job.
+            story (dict): Finished story dictionary.
+        """
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO job_stories (job_id, story_id, info) VALUES (?, ?, ?)',
+                         (job_id, story['id'], encode_story(story)))
+            conn.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (time.time(), job_id))
+
+    def get_job_stories(self, job_id):
+        """
+        Returns the stories finished by a job, in order of completion.
+
+        Args:
+            job_id (str): ID of the job.
+
+        Returns:
+            stories (list): List of story dictionaries.
+        """
+        rows = self.connection().execute('SELECT info FROM job_stories WHERE job_id = ? ORDER BY rowid', (job_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def migrate_csv_files(self):
+        """
+        Imports all_trending_ids.csv and current_trending_news.csv from the temp folder once.
+        """
+        if self.get_meta('csv_migrated') is not None:
+            return
+        csv.field_size_limit(sys.maxsize)
+        temp_folder = os.getenv("temp_folder")
+        ids_path = f'{temp_folder}/all_trending_ids.csv'
+        news_path = f'{temp_folder}/current_trending_news.csv'
+        if os.path.exists(ids_path):
+            with open(ids_path, newline='', encoding='utf-8') as f, self.connection() as conn:
+                # the old lookup table stored the story dictionary as its Python representation
+                conn.executemany('INSERT OR IGNORE INTO trending_ids (id, story, first_seen) VALUES (?, ?, NULL)',
+                                 ((row['id'], row['story']) for row in csv.DictReader(f)))
+        if os.path.exists(news_path) and self.get_current_version() is None:
+            with open(news_path, newline='', encoding='utf-8') as f:
+                self.publish_snapshot(json.loads(row['all_info']) for row in csv.DictReader(f))
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_migrated', ?)",
+                         (datetime.now().isoformat(timespec='seconds'),))
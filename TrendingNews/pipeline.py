@@ -0,0 +1,542 @@
+"""
+This script runs the update as a streaming pipeline: every story flows through fetch -> text -> dedup -> summary -> keywords -> NER -> render
+as soon as its input is ready, the stages being connected by bounded queues
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from collections.abc import Mapping
+import threading
+import traceback
+import queue
+import json
+import time
+import os
+from trending_news import TrendingNews
+from articles_text import ArticleText
+from articles_summary import ArticleSummary
+from articles_keywords import ArticleKeywords
+from articles_NER import ArticleNER, load_tagger, tag_named_entities
+from inference_cache import InferenceCache
+from news_store import NewsStore
+from render_view import build_render_view
+from near_duplicates import NearDuplicates
+from blob_store import BlobStore
+from story_record import StoryRecord
+from metrics import registry, get_percentile, STAGE_SECONDS, STAGE_STORIES, STORIES_DROPPED, RUNS
+from dotenv import load_dotenv
+load_dotenv()
+
+# marks the end of the stream in a queue
+STOP = object()
+# returned by a stage function for a story held back because the budget of the run is spent
+DEFERRED = object()
+
+class PipelineError(Exception):
+    """
+    Raised when too many stories of a run failed, the run not replacing the current snapshot.
+    """
+
+class PipelineStage:
+    def __init__(self, name, function, workers, drop_reason='empty', on_drop=None):
+        """
+        Initializes a stage that applies a function to every story of its input queue with a number of worker threads.
+
+        Args:
+            name (str): Name of the stage, used in the statistics.
+            function (callable): Function processing one item, returning the item for the next stage, None to drop it or DEFERRED to hold it back.
+            workers (int): Number of worker threads of the stage.
+            drop_reason (str): Reason recorded in the metrics when the function drops an item, 'error' being used when it raises.
+            on_drop (callable): Called with every item the stage drops, for whatever reason.
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, int(workers))
+        self.drop_reason = drop_reason
+        self.on_drop = on_drop
+        self.running = self.workers
+        self.stats = {'processed': 0, 'dropped': 0, 'failed': 0, 'seconds': 0.0}
+        self.errors = []
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def start(self, input_queue, output_queue):
+        """
+        Starts the worker threads of the stage.
+
+        Args:
+            input_queue (queue.Queue): Queue the stage reads from.
+            output_queue (queue.Queue): Queue the stage writes the processed items to.
+
+        Returns:
+            threads (list): The started worker threads.
+        """
+        self.running = self.workers
+        self.stats = {'processed': 0, 'dropped': 0, 'failed': 0, 'seconds': 0.0}
+        self.errors = []
+        self.latencies = []
+        threads = [threading.Thread(target=self.work, args=(input_queue, output_queue), name='{}-{}'.format(self.name, k), daemon=True)
+                   for k in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def work(self, input_queue, output_queue):
+        """
+        Processes items until the end of the stream, the last worker to finish forwards the end of the stream, also
+        when a worker stops on an unexpected error, so that the run never waits for it.
+
+        Args:
+            input_queue (queue.Queue): Queue the stage reads from.
+            output_queue (queue.Queue): Queue the stage writes the processed items to.
+        """
+        try:
+            while True:
+                item = input_queue.get()
+                if item is STOP:
+                    # put it back for the sibling workers
+                    input_queue.put(STOP)
+                    return
+                try:
+                    self.process(item, output_queue)
+                except Exception as e:
+                    # e.g. of the metrics, the worker goes on with the next item
+                    traceback.print_exc()
+                    self.record_error(item, e)
+                    with self.lock:
+                        self.stats['failed'] += 1
+        finally:
+            with self.lock:
+                self.running -= 1
+                last = self.running == 0
+            if last:
+                output_queue.put(STOP)
+
+    def process(self, item, output_queue):
+        """
+        Applies the function to one item and forwards the result. An error of the function or of the on_drop hook
+        counts the item as failed and drops it.
+
+        Args:
+            item: Story ID or story dictionary.
+            output_queue (queue.Queue): Queue the stage writes the processed item to.
+        """
+        start = time.monotonic()
+        failed, result = False, None
+        try:
+            result = self.function(item)
+        except Exception as e:
+            traceback.print_exc()
+            failed = True
+            self.record_error(item, e)
+        elapsed = time.monotonic() - start
+        reason = 'error' if failed else self.drop_reason
+        if result is DEFERRED:
+            result, reason = None, 'deferred'
+        if result is None and self.on_drop is not None:
+            try:
+                self.on_drop(item)
+            except Exception as e:
+                traceback.print_exc()
+                if not failed:
+                    failed, reason = True, 'error'
+                    self.record_error(item, e)
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.stats['seconds'] += elapsed
+            self.stats['processed'] += 1
+            self.stats['failed'] += 1 if failed else 0
+            self.stats['dropped'] += 1 if result is None else 0
+        STAGE_SECONDS.observe(elapsed, self.name)
+        STAGE_STORIES.inc(self.name)
+        if result is None:
+            STORIES_DROPPED.inc(self.name, reason)
+        else:
+            output_queue.put(result)
+
+    def record_error(self, item, error):
+        """
+        Keeps the latest errors of the stage for the job status.
+
+        Args:
+            item: Story ID or story dictionary that failed.
+            error (Exception): Raised exception.
+        """
+        id = item.get('id') if isinstance(item, Mapping) else item
+        with self.lock:
+            self.errors.append("{}: {!r}".format(id, error))
+            del self.errors[:-20]
+
+class StreamingPipeline:
+    def __init__(self, store=None, cache=None, region=None):
+        """
+        Initializes the stages of the update pipeline.
+
+        Args:
+            store (NewsStore): Store holding the lookup table and the snapshots, a new one is opened if not given.
+            cache (InferenceCache): Cache of the inference responses, a new one is opened if not given.
+            region (dict): Trends region of the stories, see trending_news.get_regions, the google_news_url feed if not given.
+        """
+        self.store = store or NewsStore()
+        cache = cache or InferenceCache()
+        self.news = TrendingNews(self.store, run=False, region=region)
+        self.text = ArticleText([])
+        self.summary = ArticleSummary([], cache)
+        self.keywords = ArticleKeywords([], cache)
+        self.ner = ArticleNER([])
+        self.duplicates = NearDuplicates(self.store)
+        # in disk mode the article texts are kept in a blob store and the stories in slotted records
+        self.blobs = BlobStore() if os.getenv("article_text_storage", "memory") == "disk" else None
+        self.admit = None
+        self.started = set()
+        self.deferred = set()
+        self.lock = threading.Lock()
+
+        self.queue_size = int(os.getenv("pipeline_queue_size", 32))
+        self.ner_processes = int(os.getenv("ner_processes", os.cpu_count() or 1))
+        self.ner_max_restarts = int(os.getenv("ner_max_restarts", 3))
+        self.max_failure_ratio = float(os.getenv("pipeline_max_failure_ratio", 0.5))
+        self.ner_executor = None
+        self.ner_restarts = 0
+        self.stages = [
+            PipelineStage('fetch', self.fetch_story, os.getenv("pipeline_fetch_workers", self.news.client.max_workers), 'not_trending'),
+            PipelineStage('text', self.fetch_text, os.getenv("pipeline_text_workers", os.getenv("article_text_workers", 8)), 'no_text'),
+            PipelineStage('dedup', self.deduplicate, 1, 'duplicate'),
+            # a story dropped after dedup does not suppress its later copies
+            PipelineStage('summary', self.summarize, os.getenv("pipeline_summary_workers", os.getenv("inference_concurrency", 4)), 'no_summary', self.duplicates.discard),
+            PipelineStage('keywords', self.score_keywords, os.getenv("pipeline_keywords_workers", os.getenv("inference_concurrency", 4)), on_drop=self.duplicates.discard),
+            PipelineStage('NER', self.tag_NER, os.getenv("pipeline_ner_workers", self.ner_processes), on_drop=self.duplicates.discard),
+            PipelineStage('render', self.render, 1, 'duplicate', self.duplicates.discard),
+        ]
+
+    def run(self, story_ids=None, publish_every=None, filter_seen=True, finished=None, on_story=None, admit=None, publish_key=None, publish=True):
+        """
+        Streams the stories through all the stages and publishes the finished ones as the current snapshot.
+        While the run goes on, the finished stories are published together with the stories of the snapshot it
+        started from, which the finished ones replace only at the end. A run that finished no story, or in which
+        more than pipeline_max_failure_ratio of the stories failed, keeps the current snapshot.
+        A structured report of the run is written beside the news store if pipeline_run_report is set.
+
+        Args:
+            story_ids (list): Trending story IDs to process in this order, or story dictionaries already fetched, the current trending IDs if not given.
+            publish_every (int): Publish the finished stories every this many stories, defaults to pipeline_publish_every or 10, 0 publishes only at the end.
+            filter_seen (bool): Skip the IDs of the lookup table and the non English ones, False when the IDs were filtered before, e.g. by a resumed job.
+            finished (list): Stories finished by an earlier, interrupted run, published together with the new ones.
+            on_story (callable): Called with every finished story.
+            admit (callable): Checked before a story enters the pipeline and before its summary, returns False once the budget
+                of the run is spent. The stories held back are listed in self.deferred and those started in self.started.
+            publish_key (callable): Sort key of the published stories, in order of completion if not given.
+            publish (bool): Publish the finished stories as snapshots, False when the caller merges them, e.g. a region shard.
+
+        Returns:
+            finished (list): List of finished story dictionaries, in order of completion.
+
+        Raises:
+            PipelineError: if more than pipeline_max_failure_ratio of the stories failed.
+        """
+        publish_every = int(publish_every if publish_every is not None else os.getenv("pipeline_publish_every", 10))
+        started_at, start, metrics_before = datetime.now().isoformat(timespec='seconds'), time.monotonic(), registry.get_values()
+        self.summary.reset_budget()
+        self.duplicates.start_run(finished or [])
+        self.admit, self.started, self.deferred = admit, set(), set()
+        if self.blobs is not None:
+            self.blobs.clear()
+        if story_ids is None:
+            story_ids = self.news.get_trending_story_ids()
+        if filter_seen:
+            # filter on the lookup table and the language first, so skipped IDs cost no request
+            story_ids = self.news.filter_story_ids(story_ids)
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        finished = list(finished or [])
+        resumed = len(finished)
+        previous = self.store.get_current_stories() if publish else []
+        self.ner_restarts = 0
+        self.start_ner_executor()
+        try:
+            threads = [threading.Thread(target=self.produce, args=(story_ids, queues[0]), daemon=True)]
+            threads[0].start()
+            for k, stage in enumerate(self.stages):
+                threads.extend(stage.start(queues[k], queues[k + 1]))
+
+            while True:
+                story = queues[-1].get()
+                if story is STOP:
+                    break
+                finished.append(story)
+                if on_story is not None:
+                    try:
+                        on_story(story)
+                    except Exception as e:
+                        traceback.print_exc()
+                if publish and publish_every > 0 and len(finished) % publish_every == 0:
+                    self.publish(self.merge_previous(self.get_merged(finished), previous), publish_key)
+            for thread in threads:
+                thread.join()
+        finally:
+            with self.lock:
+                executor, self.ner_executor = self.ner_executor, None
+            if executor is not None:
+                executor.shutdown()
+        if self.blobs is not None:
+            # the texts of the stories dropped on the way
+            self.blobs.clear()
+
+        self.print_stats()
+        failed = sum(stage.stats['failed'] for stage in self.stages)
+        if failed > self.max_failure_ratio * (len(finished) - resumed + failed):
+            raise PipelineError("{} stories failed and {} finished, the current snapshot is kept".format(failed, len(finished) - resumed))
+        finished = self.get_merged(finished)
+        version = self.publish(finished, publish_key) if publish and len(finished) > 0 else None
+        RUNS.inc('completed')
+        if version is not None and os.getenv("pipeline_run_report", "0").lower() in ("1", "true", "yes"):
+            report = self.get_run_report(version, started_at, time.monotonic() - start, len(finished), metrics_before)
+            self.write_run_report(report)
+        return finished
+
+    def get_merged(self, finished):
+        """
+        Returns the finished stories with the near-duplicates merged into them, the view of a merged story built again.
+
+        Args:
+            finished (list): Stories finished so far.
+        """
+        stories = []
+        for story in finished:
+            merged = self.duplicates.get_merged(story)
+            if merged is not story:
+                merged['render'] = build_render_view(merged)
+            stories.append(merged)
+        return stories
+
+    def merge_previous(self, finished, previous):
+        """
+        Returns the finished stories followed by the stories of the previous snapshot they do not replace.
+
+        Args:
+            finished (list): Stories finished so far.
+            previous (list): Stories of the snapshot the run started from.
+        """
+        replaced = set()
+        for story in finished:
+            replaced.add(story['id'])
+            replaced.update(story.get('duplicate_ids') or [])
+        return list(finished) + [story for story in previous if story['id'] not in replaced]
+
+    def publish(self, finished, key=None):
+        """
+        Publishes the finished stories as the current snapshot, sorted by key if given.
+
+        Returns:
+            version (int): Version of the published snapshot.
+        """
+        return self.store.publish_snapshot(sorted(finished, key=key) if key is not None else finished)
+
+    def produce(self, story_ids, output_queue):
+        """
+        Feeds the story IDs into the first stage, blocking while its queue is full, until the budget of the run is spent.
+
+        Args:
+            story_ids (list): Trending story IDs or fetched story dictionaries.
+            output_queue (queue.Queue): Input queue of the fetch stage.
+        """
+        for item in story_ids:
+            id = item['id'] if isinstance(item, dict) else item
+            if self.admit is not None and not self.admit():
+                with self.lock:
+                    self.deferred.add(id)
+                continue
+            with self.lock:
+                self.started.add(id)
+            output_queue.put(item)
+        output_queue.put(STOP)
+
+    def fetch_story(self, id):
+        """
+        Fetches the information of a story ID and adds it to the lookup table. A story fetched before, e.g. by the
+        scheduler to rank it, is passed through. In disk mode the story continues as a StoryRecord.
+        """
+        if isinstance(id, dict):
+            story = id
+        else:
+            story = self.news.get_story(id)
+            if story is not None:
+                self.store.add_trending_ids([(story['id'], story['stories'])])
+        if story is not None and self.blobs is not None:
+            story = StoryRecord(story, self.blobs)
+        return story
+
+    def fetch_text(self, story):
+        """
+        Downloads the article text of a story, respecting the politeness delay of its host. Drops the story without text.
+        """
+        text = self.text.get_polite_article_text(story)
+        if text == '':
+            return None
+        story['article_text'] = text
+        return story
+
+    def deduplicate(self, story):
+        """
+        Drops a near-duplicate of a story of this or an earlier update before any inference call, merging its keywords
+        into the story of this update once that one is published.
+        """
+        return self.duplicates.check_story(story)
+
+    def summarize(self, story):
+        """
+        Generates the summary of a story, drops the story if no summary could be generated. The story is held back
+        instead once the budget of the run is spent, so that it costs no inference call.
+        """
+        if self.admit is not None and not self.admit():
+            with self.lock:
+                self.deferred.add(story['id'])
+            return DEFERRED
+        art_summ = self.summary.get_article_summary(story)
+        if len(art_summ) == 0:
+            return None
+        story['article_summary'] = art_summ
+        return story
+
+    def score_keywords(self, story):
+        """
+        Scores the keywords of a story against its article text. In disk mode the text is released afterwards,
+        no later stage needing it.
+        """
+        story = self.keywords.get_article_keywords(story)
+        if self.blobs is not None:
+            story.release_text()
+        return story
+
+    def start_ner_executor(self, broken=None):
+        """
+        Starts the NER process pool, or replaces a broken one, e.g. after a worker crashed or its initializer failed.
+        At most ner_max_restarts pools are replaced in a run, so that a pool that can never start is not retried for every story.
+
+        Args:
+            broken (ProcessPoolExecutor): Pool found broken, None to start the first pool of the run.
+
+        Returns:
+            executor (ProcessPoolExecutor): Pool to use, None once the restarts are exhausted.
+        """
+        with self.lock:
+            if broken is not None:
+                if self.ner_executor is not broken:
+                    # already replaced by another worker
+                    return self.ner_executor
+                broken.shutdown(wait=False)
+                self.ner_executor = None
+                if self.ner_restarts >= self.ner_max_restarts:
+                    return None
+                self.ner_restarts += 1
+            self.ner_executor = ProcessPoolExecutor(max_workers=self.ner_processes, initializer=load_tagger)
+            return self.ner_executor
+
+    def tag_NER(self, story):
+        """
+        Tags the named entities of a story summary in the NER process pool. The summary and keywords being paid for,
+        a story whose tagging fails is kept without named entities, a broken pool being replaced.
+        """
+        executor, art_ner = self.ner_executor, []
+        for attempt in range(2):
+            if executor is None:
+                break
+            try:
+                art_ner = executor.submit(tag_named_entities, story['article_summary']).result()
+                break
+            except BrokenProcessPool as e:
+                traceback.print_exc()
+                executor = self.start_ner_executor(broken=executor)
+            except Exception as e:
+                traceback.print_exc()
+                break
+        self.ner.set_NER(story, art_ner)
+        return story
+
+    def render(self, story):
+        """
+        Adds the render-ready view of the story, so that the frontend does not compute it for every viewer, and
+        stores its near-duplicate signature now that it is finished.
+        """
+        story['render'] = build_render_view(story)
+        return self.duplicates.finish(story)
+
+    def get_stats(self):
+        """
+        Returns the statistics of every stage.
+
+        Returns:
+            (dict): Stage name to processed, dropped, failed and seconds counters.
+        """
+        return {stage.name: dict(stage.stats) for stage in self.stages}
+
+    def get_latencies(self):
+        """
+        Returns the time every stage took for each story of the last run.
+
+        Returns:
+            (dict): Stage name to list of seconds.
+        """
+        return {stage.name: list(stage.latencies) for stage in self.stages}
+
+    def get_run_report(self, version, started_at, seconds, stories, metrics_before):
+        """
+        Builds the structured report of a run: throughput, per-stage counters and latency percentiles, latest errors
+        and the change of every metric during the run, i.e. external call latencies, retries, cold-start waits,
+        drop reasons and cache lookups.
+
+        Args:
+            version (int): Version of the snapshot published by the run.
+            started_at (str): Start time of the run.
+            seconds (float): Duration of the run.
+            stories (int): Number of published stories.
+            metrics_before (dict): Metric values at the start of the run.
+
+        Returns:
+            report (dict): Report of the run, JSON serializable.
+        """
+        stages = dict()
+        for stage in self.stages:
+            stages[stage.name] = dict(stage.stats, p50=get_percentile(stage.latencies, 50), p99=get_percentile(stage.latencies, 99))
+        return {
+            'version': version,
+            'started_at': started_at,
+            'seconds': seconds,
+            'stories': stories,
+            'stories_per_second': stories / seconds if seconds > 0 else None,
+            'stages': stages,
+            'errors': self.get_errors(),
+            'metrics': registry.get_changes(metrics_before),
+        }
+
+    def write_run_report(self, report):
+        """
+        Writes the report of a run as run_report_<version>.json in the folder of the news store.
+
+        Args:
+            report (dict): Report built by get_run_report.
+        """
+        path = os.path.join(os.path.dirname(os.path.abspath(self.store.path)), 'run_report_{}.json'.format(report['version']))
+        try:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+        except OSError as e:
+            traceback.print_exc()
+
+    def get_errors(self):
+        """
+        Returns the latest errors of every stage.
+
+        Returns:
+            (dict): Stage name to list of error messages.
+        """
+        return {stage.name: list(stage.errors) for stage in self.stages}
+
+    def print_stats(self):
+        """
+        Prints the statistics of every stage.
+        """
+        for name, stats in self.get_stats().items():
+            print("{}: {} processed, {} dropped, {} failed, {:.1f}s".format(
+                name, stats['processed'], stats['dropped'], stats['failed'], stats['seconds']))
@@ -0,0 +1,140 @@
+"""
+This script builds the render-ready view of a story once per update: deterministic topic numbers, stable colours
+and the summary already split into plain and annotated parts, so that the frontend only lays it out
+"""
+
+import hashlib
+import re
+
+COLORS = ["#FFFFFF", "#FFFF00", "#FF0000", "#008000", "#0000FF", "#800080", "#FFA500", "#FFC0CB", "#008080", "#E6E6FA", "#FFD700", "#C0C0C0", "#40E0D0", "#FF00FF", "#00FF00", "#800000", "#00FFFF", "#DDA0DD", "#FFBF00"]
+# number of topics shown as headers, the others are only annotated in the summary
+MAX_HEADER_TOPICS = 4
+
+def get_stable_color(term, used_colors):
+    """
+    Picks the colour of a term from its hash, avoiding the colours already used in the story while more than 3 are left.
+
+    Args:
+        term (str): Topic or named entity.
+        used_colors (list): Colours already given to the other terms of the story.
+
+    Returns:
+        (str): Hex colour.
+    """
+    colors = list(COLORS)
+    for used_color in used_colors:
+        if (used_color in colors) and (len(colors) > 3):
+            colors.remove(used_color)
+    digest = hashlib.sha1(term.encode('utf-8')).digest()
+    return colors[int.from_bytes(digest[:4], 'big') % len(colors)]
+
+def get_topic_number_and_color(story):
+    """
+    Numbers the topics and named entities of a story and assigns their colours, the same input always giving the same result.
+
+    Args:
+        story (dict): Story dictionary with NER and all_articles_keywords.
+
+    Returns:
+        topic_description (dict): Term to its topic_number and color.
+    """
+    topic_description, used_colors = dict(), list()
+    ners, topics = story.get("NER") or [], story.get("all_articles_keywords") or []
+    total_topics = max(MAX_HEADER_TOPICS, len(topics))
+    for count, topic in enumerate(topics):
+        color = get_stable_color(topic, used_colors)
+        topic_description[topic] = {'topic_number': count + 1, 'color': color}
+        used_colors.append(color)
+    for ner in ners:
+        if ner in topic_description:
+            continue
+        color = get_stable_color(ner, used_colors)
+        topic_description[ner] = {'topic_number': total_topics, 'color': color}
+        used_colors.append(color)
+        total_topics += 1
+    return topic_description
+
+def get_trie_regex(node):
+    """
+    Converts a character trie into a regular expression, the longest term matching at a position winning.
+
+    Args:
+        node (dict): Trie node, '' marking the end of a term.
+
+    Returns:
+        (str): Regular expression of the terms below the node.
+    """
+    branches = [re.escape(char) + get_trie_regex(child) for char, child in sorted(node.items()) if char != '']
+    if len(branches) == 0:
+        return ''
+    regex = branches[0] if len(branches) == 1 else '(?:{})'.format('|'.join(branches))
+    return '(?:{})?'.format(regex) if '' in node else regex
+
+def get_annotation_pattern(terms):
+    """
+    Compiles the terms into one pattern that finds all of them in a single pass, only as whole words, so that
+    'US' is not matched inside 'USA'.
+
+    Args:
+        terms (iterable): Terms to annotate.
+
+    Returns:
+        (re.Pattern): Compiled pattern, None if there is no term.
+    """
+    trie = dict()
+    for term in terms:
+        if term == '':
+            continue
+        node = trie
+        for char in term:
+            node = node.setdefault(char, dict())
+        node[''] = True
+    return re.compile(r'(?<!\w)(?:{})(?!\w)'.format(get_trie_regex(trie))) if len(trie) > 0 else None
+
+def get_annotation(term, topic_description):
+    """
+    Returns the render-ready annotation of a term.
+    """
+    return {'text': term, 'label': str(topic_description[term]['topic_number']), 'color': topic_description[term]['color']}
+
+def get_summary_parts(summary, topic_description):
+    """
+    Splits the summary into plain text and annotated entity or keyword parts in a single pass.
+
+    Args:
+        summary (str): Article summary.
+        topic_description (dict): Term to its topic_number and color.
+
+    Returns:
+        parts (list): Plain strings and annotation dictionaries, in summary order.
+    """
+    pattern = get_annotation_pattern(topic_description)
+    if pattern is None:
+        return [summary]
+    parts, last = [], 0
+    for match in pattern.finditer(summary):
+        if match.start() > last:
+            parts.append(summary[last:match.start()])
+        parts.append(get_annotation(match.group(0), topic_description))
+        last = match.end()
+    if last < len(summary):
+        parts.append(summary[last:])
+    return parts
+
+def build_render_view(story):
+    """
+    Builds the render-ready view of a story.
+
+    Args:
+        story (dict): Story dictionary after NER.
+
+    Returns:
+        (dict): title, header topics and summary parts of the story card.
+    """
+    topic_description = get_topic_number_and_color(story)
+    topics = (story.get("all_articles_keywords") or [])[:MAX_HEADER_TOPICS]
+    return {
+        'title': (story.get('stories') or {}).get('title', '').replace('\n', ' '),
+        'topics': [get_annotation(topic, topic_description) for topic in topics],
+        'summary_parts': get_summary_parts(story.get('article_summary', ''), topic_description),
+    }
@@ -0,0 +1,176 @@
+"""
+This script runs the refresh periodically: the hottest trending stories are processed first within a wall-clock or
+inference call budget, and the stories left over are carried over to the next cycle
+"""
+
+import threading
+import traceback
+import time
+import os
+from jobs import RefreshJobRunner, JobAlreadyRunning
+from dotenv import load_dotenv
+load_dotenv()
+
+class RefreshBudget:
+    def __init__(self, seconds, inference_calls, count_calls):
+        """
+        Initializes the budget of one refresh cycle, starting now.
+
+        Args:
+            seconds (float): Wall-clock budget of the cycle, 0 for no limit.
+            inference_calls (int): Number of inference requests the cycle may send, 0 for no limit.
+            count_calls (callable): Returns the number of inference requests sent so far by the process.
+        """
+        self.deadline = time.monotonic() + seconds if seconds > 0 else None
+        self.inference_calls = inference_calls
+        self.count_calls = count_calls
+        self.start_calls = count_calls()
+
+    def admit(self):
+        """
+        Checks whether another story may go on, i.e. neither budget is spent. The stories already past the check
+        finish, so a cycle may overrun its budget by the stories in flight.
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return False
+        if self.inference_calls > 0 and self.count_calls() - self.start_calls >= self.inference_calls:
+            return False
+        return True
+
+class RefreshScheduler(RefreshJobRunner):
+    def __init__(self, store=None):
+        """
+        Initializes the periodic refresh. Every cycle is a refresh job, so it never overlaps a refresh started on
+        /update_data or by another server process.
+
+        Args:
+            store (NewsStore): Store holding the jobs and the pending stories, a new one is opened if not given.
+        """
+        super().__init__(store)
+        self.interval_seconds = float(os.getenv("refresh_interval_minutes", 0)) * 60
+        self.time_budget_seconds = float(os.getenv("refresh_time_budget_seconds", self.interval_seconds))
+        self.inference_budget = int(os.getenv("refresh_inference_budget", 0))
+        self.half_life_hours = float(os.getenv("trend_half_life_hours", 6))
+        self.max_age_seconds = float(os.getenv("pending_max_age_hours", 24)) * 3600
+        self.carry_stories = int(os.getenv("snapshot_carry_stories", 100))
+        self.stop_event = threading.Event()
+        self.schedule_thread = None
+
+    def start_schedule(self):
+        """
+        Starts the cycles in a background thread, the first one right away.
+        """
+        if self.schedule_thread is None:
+            self.schedule_thread = threading.Thread(target=self.loop, name='refresh-scheduler', daemon=True)
+            self.schedule_thread.start()
+
+    def stop_schedule(self):
+        """
+        Stops starting new cycles, a running cycle finishes.
+        """
+        self.stop_event.set()
+
+    def loop(self):
+        """
+        Starts a refresh every interval_seconds, skipping the cycle while the previous refresh still runs.
+        """
+        while True:
+            try:
+                self.start()
+            except JobAlreadyRunning as e:
+                print("Scheduled refresh skipped: {}".format(e))
+            except Exception as e:
+                traceback.print_exc()
+            if self.stop_event.wait(self.interval_seconds):
+                return
+
+    def get_priority(self, story, now):
+        """
+        Returns the trend score of a story: its number of latest articles, halved every half_life_hours since it was
+        first seen, so that a story carried over for long gives way to new ones.
+
+        Args:
+            story (dict): Story dictionary with num_latest_articles and first_seen.
+            now (float): Current timestamp.
+
+        Returns:
+            (float): Priority of the story, 0 for a story without trend score.
+        """
+        age_hours = max(0.0, now - story.get('first_seen', now)) / 3600
+        return (story.get('num_latest_articles') or 0) * 0.5 ** (age_hours / self.half_life_hours)
+
+    def get_new_stories(self):
+        """
+        Fetches the new trending stories of every region of trends_regions, of the google_news_url feed if none is set.
+        A story trending in several regions is fetched once and lists the geos of all of them under regions.
+
+        Returns:
+            stories (list): List of story dictionaries.
+        """
+        from trending_news import TrendingNews, get_regions
+        stories, regions_by_id = dict(), dict()
+        for region in get_regions() or [None]:
+            news = TrendingNews(self.store, run=False, region=region)
+            try:
+                story_ids = news.get_trending_story_ids()
+                if region is not None:
+                    for id in story_ids:
+                        regions_by_id.setdefault(id, []).append(region['geo'])
+                for story in news.get_story_ids([id for id in story_ids if id not in stories]):
+                    stories[story['id']] = story
+            except Exception as e:
+                traceback.print_exc()
+        for id, story in stories.items():
+            if id in regions_by_id:
+                story['regions'] = list(dict.fromkeys(regions_by_id[id]))
+        return list(stories.values())
+
+    def run_update(self, job_id):
+        """
+        Runs one cycle: queues the new trending stories of every region with the ones left over by the earlier cycles, processes them
+        by decreasing trend score until the budget is spent and publishes them together with the stories of the
+        current snapshot, hottest first. The stories not processed stay queued for the next cycle.
+
+        Args:
+            job_id (str): ID of the job of the cycle.
+        """
+        # imported here so that serving requests does not load the pipeline modules
+        from pipeline import StreamingPipeline
+        import articles_summary, articles_keywords
+        self.pipeline = StreamingPipeline(self.store)
+        budget = RefreshBudget(self.time_budget_seconds, self.inference_budget,
+                               lambda: articles_summary.client.request_count + articles_keywords.client.request_count)
+        now = time.time()
+        stories = self.get_new_stories()
+        for story in stories:
+            story['first_seen'] = now
+        self.store.add_pending_stories(stories)
+
+        pending = sorted(self.store.get_pending_stories(self.max_age_seconds), key=lambda story: self.get_priority(story, now), reverse=True)
+        self.store.update_job(job_id, story_ids=[story['id'] for story in pending])
+        # stories finished before this cycle was interrupted, and the earlier stories kept in the snapshot
+        finished = self.store.get_job_stories(job_id)
+        skipped_ids = {story['id'] for story in pending + finished}
+        current = [story for story in self.store.get_current_stories() if story['id'] not in skipped_ids]
+        current = sorted(current, key=lambda story: self.get_priority(story, now), reverse=True)[:self.carry_stories]
+
+        record_story = self.get_story_recorder(job_id)
+        def on_story(story):
+            record_story(story)
+            self.store.remove_pending_stories([story['id']])
+
+        self.pipeline.run(pending, filter_seen=False, finished=current + finished, on_story=on_story, admit=budget.admit,
+                          publish_key=lambda story: -self.get_priority(story, now))
+        # the stories dropped on the way, e.g. without text or duplicates, are not tried again
+        self.store.remove_pending_stories(self.pipeline.started - self.pipeline.deferred)
+        print("{} stories carried over to the next refresh".format(len(self.pipeline.deferred)))
+
+    def get_progress(self):
+        """
+        Returns the live per-stage counts and errors of the running pipeline, with the number of stories deferred
+        to the next cycle.
+        """
+        progress = super().get_progress()
+        if progress is not None:
+            progress['deferred'] = len(self.pipeline.deferred)
+        return progress
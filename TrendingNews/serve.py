@@ -0,0 +1,19 @@
+"""
+This script is the serving-only entry point of the trending news API: it answers /fetch_data and /fetch_delta from the
+news store without importing the update pipeline, so that serving workers start fast and stay small.
+Updates are run, and their metrics exposed on /metrics, by the full server, app.py.
+
+Usage:
+    gunicorn --workers 4 serve:app
+"""
+
+from flask import Flask
+from serving import serving
+from dotenv import load_dotenv
+load_dotenv()
+
+app = Flask(__name__)
+app.register_blueprint(serving)
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,133 @@
+"""
+This script defines the read-only API of the trending news server: /fetch_data and /fetch_delta. It is shared by the full
+server app.py and the serving-only entry point serve.py, and imports none of the update pipeline modules
+"""
+
+from flask import Blueprint, Response, jsonify, request
+from news_store import NewsStore
+from snapshot_cache import SnapshotCache, EncodedSnapshot
+import threading
+import json
+
+serving = Blueprint('serving', __name__)
+init_lock = threading.Lock()
+snapshot_cache = None
+
+def get_snapshot_cache():
+    """
+    Returns the in-memory cache of the current snapshot, created on first use.
+    """
+    global snapshot_cache
+    with init_lock:
+        if snapshot_cache is None:
+            snapshot_cache = SnapshotCache(NewsStore())
+    return snapshot_cache
+
+QUERY_PARAMETERS = ('limit', 'cursor', 'offset', 'since', 'source', 'entity', 'keyword')
+
+@serving.route('/fetch_data', methods=['GET'])
+def fetch_data():
+    """
+    Fetches the current trending news snapshot and returns it as JSON. The response is encoded once per snapshot
+    version and served from memory, gzipped if the client accepts it, with an ETag so that unchanged data is
+    answered with 304 Not Modified.
+
+    With any of the query parameters limit, cursor or offset, since (YYYY-MM-DD), source, entity and keyword
+    (entity, keyword and source can be repeated) only the matching page is returned, see fetch_data_page.
+    
+    Returns:
+        JSON response: Success status along with the fetched data if successful, otherwise a failure status.
+    """
+    if any(name in request.args for name in QUERY_PARAMETERS):
+        return fetch_data_page()
+    try:
+        return get_encoded_response(get_snapshot_cache().get())
+    except Exception as e:
+        resp = jsonify(success=False)
+        return resp
+
+def get_encoded_response(snapshot):
+    """
+    Returns the response of a pre-encoded body, gzipped if the client accepts it, 304 if the client has it already.
+
+    Args:
+        snapshot (EncodedSnapshot): Encoded snapshot or delta.
+
+    Returns:
+        Response: The response with its ETag.
+    """
+    if request.if_none_match.contains(snapshot.etag):
+        resp = Response(status=304)
+    elif request.accept_encodings['gzip']:
+        resp = Response(snapshot.gzip_body, mimetype='application/json')
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = Response(snapshot.body, mimetype='application/json')
+    resp.set_etag(snapshot.etag)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@serving.route('/fetch_delta', methods=['GET'])
+def fetch_delta():
+    """
+    Returns the changes of the current snapshot since the version a client has, which it got from the version field
+    of /fetch_data or of an earlier delta: the added and changed stories, the IDs of the removed ones and the order of
+    the story IDs in the current version. Only the last snapshot_retain_versions versions can be synced from.
+
+    Returns:
+        JSON response: Success status with the delta, 400 without a valid since_version, 410 if that version is
+        no longer retained and the client has to fetch /fetch_data again.
+    """
+    since_version = request.args.get('since_version', type=int)
+    if since_version is None:
+        resp = jsonify(success=False, error='since_version is required')
+        resp.status_code = 400
+        return resp
+    try:
+        delta = get_snapshot_cache().get_delta(since_version)
+        if delta is None:
+            resp = jsonify(success=False, error='Version no longer available, fetch /fetch_data again')
+            resp.status_code = 410
+            return resp
+        return get_encoded_response(delta)
+    except Exception as e:
+        resp = jsonify(success=False)
+        return resp
+
+def fetch_data_page():
+    """
+    Returns the page of stories of the current snapshot matching the query parameters. The filters are served by the
+    inverted index built when the snapshot was published and next_cursor, if set, fetches the following page of
+    the same snapshot. The page is gzipped and tagged like /fetch_data.
+    
+    Returns:
+        JSON response: Success status along with the page, the snapshot version and next_cursor, 400 for invalid
+        parameters, otherwise a failure status.
+    """
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        offset = int(request.args['offset']) if 'offset' in request.args else 0
+        version, start = None, 0
+        if 'cursor' in request.args:
+            version, start = [int(part) for part in request.args['cursor'].split('-')]
+        filters = [(kind, term) for kind in ('entity', 'keyword', 'source') for term in request.args.getlist(kind)]
+        if (limit is not None and limit < 0) or offset < 0 or start < 0:
+            raise ValueError('limit and offset must not be negative')
+    except ValueError as e:
+        resp = jsonify(success=False, error='Invalid query parameters')
+        resp.status_code = 400
+        return resp
+    try:
+        # the store of the snapshot cache, so that no connection is opened and no schema checked per request
+        version, stories, next_start = get_snapshot_cache().store.query_snapshot_json(version, filters, request.args.get('since'), start, limit, offset)
+        if version is None:
+            resp = jsonify(success=False, error='Snapshot no longer available, restart from the first page')
+            resp.status_code = 410
+            return resp
+        next_cursor = '{}-{}'.format(version, next_start) if next_start is not None else None
+        body = '{{"data":[{}],"next_cursor":{},"success":true,"version":{}}}'.format(','.join(stories), json.dumps(next_cursor), version)
+        return get_encoded_response(EncodedSnapshot(version, body.encode('utf-8')))
+    except Exception as e:
+        resp = jsonify(success=False)
+        return resp
@@ -0,0 +1,301 @@
+"""
+This script runs the update for several Google Trends regions and languages at once, one worker process per region,
+each with its own rate limits. The workers share the news store, i.e. the lookup table and the near-duplicate index,
+so a story trending in several regions is processed once, and their stories are merged into one snapshot labelled by region
+"""
+
+from concurrent.futures import ProcessPoolExecutor, wait
+import multiprocessing
+import threading
+import traceback
+import queue
+import os
+from trending_news import TrendingNews, get_regions
+from news_store import NewsStore
+from pipeline import StreamingPipeline, PipelineError
+from metrics import registry, RUNS
+from dotenv import load_dotenv
+load_dotenv()
+
+# seconds between two reports of the stage counters of a worker
+PROGRESS_SECONDS = float(os.getenv("ingestion_progress_seconds", 2))
+
+def ingest_region(region, story_ids, store_path, job_id=None, finished=None, updates=None):
+    """
+    Runs the pipeline for the stories of one region in a worker process, without publishing them. Every finished
+    story and, every PROGRESS_SECONDS, the counters of the stages and the changes of the metrics of the worker are
+    sent to the parent process on the updates queue.
+
+    Args:
+        region (dict): Region of the stories, see trending_news.get_regions.
+        story_ids (list): Story IDs assigned to the region and not finished yet.
+        store_path (str): Location of the news store shared by the workers.
+        job_id (str): Refresh job the finished stories are saved to, if any.
+        finished (list): Stories of the region finished by the job before it was interrupted.
+        updates (queue.Queue): Queue of the parent, receiving ('story', geo, story) and ('stats', geo, stats, errors, metric changes) tuples.
+
+    Returns:
+        (dict): finished stories, duplicate_of (ID of a dropped story to the ID of the story it duplicates), stats and errors of the stages.
+    """
+    geo = region['geo']
+    store = NewsStore(store_path)
+    pipeline = StreamingPipeline(store, region=region)
+
+    def on_story(story):
+        if job_id is not None:
+            store.add_job_story(job_id, story)
+        if updates is not None:
+            updates.put(('story', geo, dict(story)))
+
+    def send_stats():
+        # a pool process may run several regions, so only the changes since the last report are sent
+        with lock:
+            state = registry.get_state()
+            changes = registry.get_state_changes(metrics_state[0], state)
+            metrics_state[0] = state
+        # the parent counts the sharded run itself
+        changes.pop(RUNS.name, None)
+        updates.put(('stats', geo, pipeline.get_stats(), pipeline.get_errors(), changes))
+
+    def report():
+        while not stop.wait(PROGRESS_SECONDS):
+            send_stats()
+
+    lock, metrics_state = threading.Lock(), [registry.get_state()]
+    stop = threading.Event()
+    if updates is not None:
+        threading.Thread(target=report, daemon=True).start()
+    try:
+        finished = pipeline.run(story_ids, filter_seen=False, finished=finished, on_story=on_story, publish=False)
+    finally:
+        stop.set()
+        if updates is not None:
+            send_stats()
+    return {'finished': finished, 'duplicate_of': dict(pipeline.duplicates.duplicate_of),
+            'stats': pipeline.get_stats(), 'errors': pipeline.get_errors()}
+
+class ShardedIngestion:
+    def __init__(self, store=None, regions=None, workers=None):
+        """
+        Initializes the ingestion of several regions.
+
+        Args:
+            store (NewsStore): Store shared by the workers, a new one is opened if not given.
+            regions (list): Regions to ingest, defaults to the trends_regions env variable.
+            workers (int): Number of worker processes, defaults to ingestion_workers or one per region.
+        """
+        self.store = store or NewsStore()
+        self.regions = regions or get_regions()
+        self.workers = int(workers or os.getenv("ingestion_workers", len(self.regions) or 1))
+        self.publish_every = int(os.getenv("pipeline_publish_every", 10))
+        self.max_failure_ratio = float(os.getenv("pipeline_max_failure_ratio", 0.5))
+        self.lock = threading.Lock()
+        self.stats = dict()
+        # errors of the feeds and of the worker processes, and the stage errors last reported by the workers
+        self.errors = dict()
+        self.stage_errors = dict()
+
+    def get_story_ids(self):
+        """
+        Fetches the feed of every region and keeps its new story IDs.
+
+        Returns:
+            (dict): Region geo to the list of new story IDs trending in it, in feed order.
+        """
+        trending = dict()
+        for region in self.regions:
+            news = TrendingNews(self.store, run=False, region=region)
+            try:
+                trending[region['geo']] = news.filter_story_ids(news.get_trending_story_ids())
+            except Exception as e:
+                traceback.print_exc()
+                self.errors[region['geo']] = ["feed: {!r}".format(e)]
+        return trending
+
+    def assign_story_ids(self, trending):
+        """
+        Assigns each story ID to the first region it trends in.
+
+        Args:
+            trending (dict): Region geo to list of story IDs, see get_story_ids.
+
+        Returns:
+            (tuple): (region geo to list of assigned story IDs, story ID to the geos of every region it trends in)
+        """
+        assigned, regions_by_id = dict(), dict()
+        for region in self.regions:
+            story_ids = trending.get(region['geo'])
+            if story_ids is None:
+                continue
+            assigned[region['geo']] = [id for id in story_ids if id not in regions_by_id]
+            for id in story_ids:
+                regions_by_id.setdefault(id, []).append(region['geo'])
+        return assigned, regions_by_id
+
+    def run(self, job_id=None):
+        """
+        Runs the regions in the worker processes and publishes their stories as one snapshot, by decreasing number of
+        latest articles. While the workers run, the stories finished so far are published every pipeline_publish_every
+        stories together with the stories of the snapshot the run started from. Every story lists in regions the geos
+        it trends in, including those of its duplicates dropped by other workers. The stories of a region whose worker
+        failed are kept from the snapshot the run started from, and if more than pipeline_max_failure_ratio of the
+        stories failed, counting the unfinished stories of the failed regions, the current snapshot is kept.
+
+        Args:
+            job_id (str): Refresh job of the run. The story IDs of every region are saved on it before any is
+                processed, and the workers save the finished stories to it, so that an interrupted job resumes with
+                the same stories and publishes the ones it finished before.
+
+        Returns:
+            stories (list): List of published story dictionaries.
+
+        Raises:
+            PipelineError: if more than pipeline_max_failure_ratio of the stories failed.
+        """
+        job = self.store.get_job(job_id) if job_id is not None else None
+        trending = job['story_ids'] if job is not None and isinstance(job['story_ids'], dict) else None
+        if trending is None:
+            trending = self.get_story_ids()
+            if job_id is not None:
+                self.store.update_job(job_id, story_ids=trending)
+        assigned, regions_by_id = self.assign_story_ids(trending)
+
+        finished = {story['id']: story for story in self.store.get_job_stories(job_id)} if job_id is not None else dict()
+        resumed = len(finished)
+        previous = self.store.get_current_stories()
+        duplicate_of, failed_geos = dict(), set()
+        # spawned rather than forked, the server process running threads whose locks a fork would copy
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager, ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+            updates = manager.Queue()
+            futures = dict()
+            for region in self.regions:
+                geo = region['geo']
+                if geo not in assigned:
+                    continue
+                assigned_ids = set(assigned[geo])
+                region_finished = [story for id, story in finished.items() if id in assigned_ids]
+                remaining_ids = [id for id in assigned[geo] if id not in finished]
+                futures[executor.submit(ingest_region, region, remaining_ids, self.store.path, job_id, region_finished, updates)] = geo
+
+            running, published = set(futures), len(finished)
+            while running:
+                done, running = wait(running, timeout=PROGRESS_SECONDS)
+                self.receive_updates(updates, finished)
+                for future in done:
+                    geo = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        traceback.print_exc()
+                        failed_geos.add(geo)
+                        with self.lock:
+                            self.errors.setdefault(geo, []).append("worker: {!r}".format(e))
+                        continue
+                    # the stories with the near-duplicates merged into them by the worker
+                    finished.update((story['id'], dict(story)) for story in result['finished'])
+                    duplicate_of.update(result['duplicate_of'])
+                    with self.lock:
+                        self.stats[geo] = result['stats']
+                        self.stage_errors[geo] = result['errors']
+                if self.publish_every > 0 and len(finished) - published >= self.publish_every:
+                    published = len(finished)
+                    self.store.publish_snapshot(self.merge_previous(self.get_labelled(finished, regions_by_id, duplicate_of), previous))
+            self.receive_updates(updates, finished)
+
+        with self.lock:
+            failed = sum(counters['failed'] for geo, stats in self.stats.items() if geo not in failed_geos for counters in stats.values())
+        failed += sum(1 for geo in failed_geos for id in assigned[geo] if id not in finished)
+        if failed > self.max_failure_ratio * (len(finished) - resumed + failed):
+            raise PipelineError("{} stories failed and {} finished, the current snapshot is kept".format(failed, len(finished) - resumed))
+        stories = self.get_labelled(finished, regions_by_id, duplicate_of)
+        # a failed region keeps its stories of the previous snapshot rather than disappearing from it
+        stories = self.merge_previous(stories, [story for story in previous if failed_geos.intersection(story.get('regions') or [])])
+        if len(stories) > 0:
+            self.store.publish_snapshot(stories)
+        RUNS.inc('completed')
+        return stories
+
+    def receive_updates(self, updates, finished):
+        """
+        Takes the stories, stage counters and metric changes the workers sent so far.
+
+        Args:
+            updates (queue.Queue): Queue the workers send to.
+            finished (dict): Story ID to finished story, completed with the stories received.
+        """
+        while True:
+            try:
+                update = updates.get_nowait()
+            except queue.Empty:
+                return
+            if update[0] == 'story':
+                finished.setdefault(update[2]['id'], update[2])
+            else:
+                _, geo, stats, errors, changes = update
+                # the metrics of the workers are exposed on /metrics of the server with its own
+                registry.add_state_changes(changes)
+                with self.lock:
+                    self.stats[geo] = stats
+                    self.stage_errors[geo] = errors
+
+    def get_labelled(self, finished, regions_by_id, duplicate_of):
+        """
+        Returns copies of the finished stories listing every region they trend in, by decreasing number of latest articles.
+
+        Args:
+            finished (dict): Story ID to finished story.
+            regions_by_id (dict): Story ID to the geos of every region it trends in.
+            duplicate_of (dict): ID of a story dropped by a worker to the ID of the story it duplicates.
+        """
+        labels = {id: list(geos) for id, geos in regions_by_id.items()}
+        for id, original_id in duplicate_of.items():
+            if original_id in finished:
+                labels.setdefault(original_id, []).extend(regions_by_id.get(id, []))
+        stories = []
+        for id, story in finished.items():
+            regions = list(story.get('regions') or [])
+            for geo in labels.get(id, []):
+                if geo not in regions:
+                    regions.append(geo)
+            stories.append(dict(story, regions=regions))
+        return sorted(stories, key=lambda story: -(story.get('num_latest_articles') or 0))
+
+    def merge_previous(self, stories, previous):
+        """
+        Returns the stories followed by the stories of the previous snapshot they do not replace.
+        """
+        replaced = set()
+        for story in stories:
+            replaced.add(story['id'])
+            replaced.update(story.get('duplicate_ids') or [])
+        return stories + [story for story in previous if story['id'] not in replaced]
+
+    def get_stats(self):
+        """
+        Returns the statistics of every stage summed over the regions, as last reported by their workers.
+
+        Returns:
+            (dict): Stage name to processed, dropped, failed and seconds counters.
+        """
+        totals = dict()
+        with self.lock:
+            for stats in self.stats.values():
+                for name, counters in stats.items():
+                    total = totals.setdefault(name, dict.fromkeys(counters, 0))
+                    for key, value in counters.items():
+                        total[key] += value
+        return totals
+
+    def get_errors(self):
+        """
+        Returns the latest errors of every region.
+
+        Returns:
+            (dict): Region geo to list of error messages.
+        """
+        with self.lock:
+            errors = {geo: list(messages) for geo, messages in self.errors.items()}
+            for geo, stage_errors in self.stage_errors.items():
+                errors.setdefault(geo, []).extend(error for messages in stage_errors.values() for error in messages)
+        return {geo: messages[-20:] for geo, messages in errors.items()}
@@ -0,0 +1,103 @@
+"""
+This script keeps the current news snapshot in memory as pre-encoded and pre-gzipped JSON for the /fetch_data API,
+together with the deltas to it requested on /fetch_delta
+"""
+
+import threading
+import hashlib
+import gzip
+import json
+from metrics import CACHE_LOOKUPS
+
+class EncodedSnapshot:
+    '''
+    The /fetch_data response body of one snapshot version.
+    '''
+    __slots__ = ('version', 'body', 'gzip_body', 'etag')
+
+    def __init__(self, version, body):
+        '''
+        Args:
+        version: Version of the snapshot
+        body: JSON response body as bytes
+        '''
+        self.version = version
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+        self.etag = 'v{}-{}'.format(version, hashlib.sha1(body).hexdigest()[:16])
+
+class SnapshotCache:
+    '''
+    Serves the current snapshot from memory, encoding it again only when a new snapshot version is published.
+    '''
+
+    def __init__(self, store):
+        '''
+        Args:
+        store: NewsStore the snapshots are published to
+        '''
+        self.store = store
+        self.snapshot = None
+        self.deltas = dict()
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''
+        Returns the encoded current snapshot, checking the published version on every call.
+
+        Returns:
+        snapshot: EncodedSnapshot of the current version
+        '''
+        version = self.store.get_current_version()
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == version:
+            CACHE_LOOKUPS.inc('snapshot', 'hit')
+            return snapshot
+        with self.lock:
+            if self.snapshot is None or self.snapshot.version != version:
+                CACHE_LOOKUPS.inc('snapshot', 'miss')
+                self.snapshot = self.encode()
+            else:
+                CACHE_LOOKUPS.inc('snapshot', 'hit')
+            return self.snapshot
+
+    def get_delta(self, since_version):
+        '''
+        Returns the encoded delta from a version to the current one, each delta being encoded once per current version.
+
+        Args:
+        since_version: Version the client has
+
+        Returns:
+        delta: EncodedSnapshot of the delta, tagged with the current version, None if since_version is no longer retained
+        '''
+        version = self.store.get_current_version()
+        with self.lock:
+            if any(delta.version != version for delta in self.deltas.values()):
+                self.deltas = dict()
+            if since_version in self.deltas:
+                CACHE_LOOKUPS.inc('delta', 'hit')
+                return self.deltas[since_version]
+        CACHE_LOOKUPS.inc('delta', 'miss')
+        delta = self.store.get_snapshot_delta(since_version)
+        if delta is None:
+            return None
+        body = '{{"added":[{}],"changed":[{}],"from_version":{},"order":{},"removed":{},"success":true,"version":{}}}'.format(
+            ','.join(delta['added']), ','.join(delta['changed']), since_version, json.dumps(delta['order']),
+            json.dumps(delta['removed']), delta['version']).encode('utf-8')
+        encoded = EncodedSnapshot(delta['version'], body)
+        with self.lock:
+            if delta['version'] == version:
+                self.deltas[since_version] = encoded
+        return encoded
+
+    def encode(self):
+        '''
+        Builds the response body from the stored story JSON without decoding it.
+
+        Returns:
+        snapshot: EncodedSnapshot of the current version
+        '''
+        version, stories = self.store.get_current_snapshot_json()
+        body = '{{"data":[{}],"success":true,"version":{}}}'.format(','.join(stories), json.dumps(version)).encode('utf-8')
+        return EncodedSnapshot(version, body)
@@ -0,0 +1,95 @@
+"""
+This script defines the compact record of a story flowing through the pipeline: a slotted object with the mapping
+interface of the story dictionaries, whose article text lives in a BlobStore
+"""
+
+from collections.abc import MutableMapping
+
+# keys every story may have, kept in slots rather than in a per-story dictionary
+FIELDS = ('id', 'stories', 'all_articles_keywords', 'num_latest_articles', 'first_seen', 'regions',
+          'article_summary', 'final_keywords', 'NER', 'render', 'duplicate_ids')
+
+class StoryRecord(MutableMapping):
+    '''
+    Story read and written like a dictionary. 'article_text' is written to the blob store and read back from it
+    on access, other keys than FIELDS are kept in a small dictionary.
+    '''
+    __slots__ = FIELDS + ('article_handle', 'blobs', 'extra')
+
+    def __init__(self, story, blobs):
+        '''
+        Args:
+        story: Story dictionary to copy
+        blobs: BlobStore of the article text
+        '''
+        self.article_handle = None
+        self.blobs = blobs
+        self.extra = None
+        self.update(story)
+
+    def __getitem__(self, key):
+        if key == 'article_text':
+            if self.article_handle is None:
+                raise KeyError(key)
+            return self.blobs.get(self.article_handle)
+        if key in FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key == 'article_text':
+            self.release_text()
+            self.article_handle = self.blobs.put(value)
+        elif key in FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = dict()
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key == 'article_text':
+            if self.article_handle is None:
+                raise KeyError(key)
+            self.release_text()
+        elif key in FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.article_handle is not None:
+            yield 'article_text'
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __reduce__(self):
+        # sent to another process as a plain dictionary, e.g. by a region shard
+        return (dict, (dict(self),))
+
+    def __repr__(self):
+        return 'StoryRecord({!r})'.format(self.get('id'))
+
+    def release_text(self):
+        '''
+        Removes the article text from the blob store once no stage needs it.
+        '''
+        if self.article_handle is not None:
+            self.blobs.release(self.article_handle)
+            self.article_handle = None
@@ -0,0 +1,37 @@
+"""
+Randomized comparison of the named entity de-duplication with the original pairwise implementation
+"""
+
+import random
+from articles_NER import ArticleNER
+
+def check_repeat_NER_pairwise(ner, keywords):
+    """
+    The original quadratic implementation of ArticleNER.check_repeat_NER, kept as the reference.
+    """
+    words_to_remove_ner = [word1 for word1 in ner if any(word1 in word2 and word1 != word2 for word2 in ner)]
+    unique_ner = [word for word in ner if word not in words_to_remove_ner]
+    words_to_remove_keywords = [word1 for word1 in unique_ner if any(word1 in word2 or word1 == word2 for word2 in keywords)]
+    return [word for word in unique_ner if word not in words_to_remove_keywords]
+
+def random_words(rng, count, alphabet, max_length):
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, max_length))) for _ in range(count)]
+
+def test_check_repeat_NER_matches_pairwise():
+    ner_tagger = ArticleNER([])
+    rng = random.Random(0)
+    for trial in range(3000):
+        # small alphabets make entities contained in each other, repeated and equal to keywords
+        alphabet = rng.choice(['ab', 'abc', 'ab ', 'abcdefgh '])
+        ner = random_words(rng, rng.randint(0, 12), alphabet, rng.randint(1, 8))
+        keywords = random_words(rng, rng.randint(0, 4), alphabet, rng.randint(1, 10))
+        if rng.random() < 0.3:
+            # entities cut out of other entities
+            ner += [word[rng.randint(0, len(word)):] for word in ner if len(word) > 0]
+        rng.shuffle(ner)
+        assert ner_tagger.check_repeat_NER(ner, keywords) == check_repeat_NER_pairwise(ner, keywords), (ner, keywords)
+
+def test_check_repeat_NER_examples():
+    ner_tagger = ArticleNER([])
+    ner = ['Modi', 'Narendra Modi', 'India', 'New Delhi', 'Delhi', 'India']
+    assert ner_tagger.check_repeat_NER(ner, ['India cricket']) == ['Narendra Modi', 'New Delhi']
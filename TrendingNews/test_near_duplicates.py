@@ -0,0 +1,59 @@
+"""
+Tests of the near-duplicate detection of the pipeline with the story records and article blobs of the disk mode
+"""
+
+import queue
+from news_store import NewsStore
+from near_duplicates import NearDuplicates
+from blob_store import BlobStore
+from story_record import StoryRecord
+from pipeline import PipelineStage, STOP
+
+TEXT = ' '.join('word{}'.format(number) for number in range(200))
+
+def make_record(id, blobs, text=TEXT, keywords=()):
+    return StoryRecord({'id': id, 'stories': {'title': id}, 'all_articles_keywords': list(keywords), 'article_text': text}, blobs)
+
+def make_duplicates(tmp_path):
+    duplicates = NearDuplicates(NewsStore(str(tmp_path / 'news.db')))
+    duplicates.start_run()
+    return duplicates
+
+def test_discarded_record_lets_its_copy_through(tmp_path):
+    blobs = BlobStore(str(tmp_path / 'blobs'))
+    duplicates = make_duplicates(tmp_path)
+    assert duplicates.check_story(make_record('A', blobs)) is not None
+    duplicates.discard(make_record('A', blobs))
+    assert duplicates.pending == {} and duplicates.run_stories == {}
+    assert duplicates.check_story(make_record('B', blobs)) is not None
+
+def test_stage_dropping_a_record_after_dedup_forwards_the_end(tmp_path):
+    blobs = BlobStore(str(tmp_path / 'blobs'))
+    duplicates = make_duplicates(tmp_path)
+    stage = PipelineStage('summary', lambda story: None, 2, on_drop=duplicates.discard)
+    input_queue, output_queue = queue.Queue(), queue.Queue()
+    input_queue.put(duplicates.check_story(make_record('A', blobs)))
+    input_queue.put(STOP)
+    for thread in stage.start(input_queue, output_queue):
+        thread.join(timeout=5)
+    assert output_queue.get(timeout=5) is STOP
+    assert stage.stats['dropped'] == 1 and stage.stats['failed'] == 0
+    assert duplicates.pending == {}
+
+def test_duplicate_is_merged_into_a_copy(tmp_path):
+    blobs = BlobStore(str(tmp_path / 'blobs'))
+    duplicates = make_duplicates(tmp_path)
+    original = duplicates.check_story(make_record('A', blobs, keywords=['a']))
+    assert duplicates.check_story(make_record('B', blobs, keywords=['b'])) is None
+    merged = duplicates.get_merged(original)
+    assert merged['duplicate_ids'] == ['B'] and merged['all_articles_keywords'] == ['a', 'b']
+    assert 'duplicate_ids' not in original
+    assert duplicates.finish(original) is original
+
+def test_shared_text_outlives_the_first_release(tmp_path):
+    blobs = BlobStore(str(tmp_path / 'blobs'))
+    first, second = make_record('A', blobs), make_record('B', blobs)
+    first.release_text()
+    assert second['article_text'] == TEXT
+    second.release_text()
+    assert blobs.references == {}
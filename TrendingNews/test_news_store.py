@@ -0,0 +1,47 @@
+"""
+Tests of the paging and filtering of the snapshots of the news store
+"""
+
+import json
+from news_store import NewsStore
+
+def make_story(number, source):
+    return {'id': 'S{}'.format(number), 'stories': {'title': 'Story {}'.format(number), 'source': source, 'date': '2024-01-0{}'.format(number % 9 + 1)},
+            'NER': ['Entity {}'.format(number % 2)], 'all_articles_keywords': ['keyword']}
+
+def make_store(tmp_path):
+    store = NewsStore(str(tmp_path / 'news.db'))
+    sources = ['BBC', 'CNN', 'BBC', 'BBC', 'CNN', 'BBC', 'Reuters']
+    store.publish_snapshot([make_story(number, source) for number, source in enumerate(sources)])
+    return store
+
+def get_ids(stories):
+    return [json.loads(story)['id'] for story in stories]
+
+def test_offset_skips_filtered_stories(tmp_path):
+    store = make_store(tmp_path)
+    pages = [get_ids(store.query_snapshot_json(filters=[('source', 'BBC')], limit=1, offset=offset)[1]) for offset in range(5)]
+    assert pages == [['S0'], ['S2'], ['S3'], ['S5'], []]
+
+def test_cursor_pages_through_filtered_stories(tmp_path):
+    store = make_store(tmp_path)
+    version, start, ids = None, 0, []
+    while start is not None:
+        version, stories, start = store.query_snapshot_json(version, [('source', 'BBC')], start=start, limit=2)
+        ids += get_ids(stories)
+    assert ids == ['S0', 'S2', 'S3', 'S5']
+
+def test_filters_are_combined(tmp_path):
+    store = make_store(tmp_path)
+    _, stories, next_start = store.query_snapshot_json(filters=[('source', 'bbc'), ('entity', 'Entity 1')])
+    assert get_ids(stories) == ['S3', 'S5']
+    assert next_start is None
+
+def test_unknown_version(tmp_path):
+    store = make_store(tmp_path)
+    assert store.query_snapshot_json(version=12345) == (None, [], None)
+
+def test_published_stories_have_a_render_view(tmp_path):
+    store = make_store(tmp_path)
+    _, stories, _ = store.query_snapshot_json(limit=1)
+    assert json.loads(stories[0])['render']['title'] == 'Story 0'
@@ -0,0 +1,42 @@
+"""
+Tests of the drop and failure handling of the pipeline stages
+"""
+
+import queue
+from pipeline import PipelineStage, STOP
+
+def run_stage(stage, items):
+    input_queue, output_queue = queue.Queue(), queue.Queue()
+    for item in items:
+        input_queue.put(item)
+    input_queue.put(STOP)
+    for thread in stage.start(input_queue, output_queue):
+        thread.join(timeout=5)
+    output = []
+    while True:
+        item = output_queue.get(timeout=5)
+        if item is STOP:
+            return output
+        output.append(item)
+
+def process(item):
+    if item % 3 == 0:
+        raise ValueError(item)
+    return item if item % 3 == 1 else None
+
+def test_stage_counts_processed_dropped_and_failed_items():
+    dropped = []
+    stage = PipelineStage('text', process, 3, on_drop=dropped.append)
+    assert sorted(run_stage(stage, range(9))) == [1, 4, 7]
+    # every item is processed, and the failed ones are dropped too
+    assert (stage.stats['processed'], stage.stats['dropped'], stage.stats['failed']) == (9, 6, 3)
+    assert sorted(dropped) == [0, 2, 3, 5, 6, 8]
+    assert len(stage.errors) == 3
+
+def test_raising_drop_hook_counts_a_failure_and_forwards_the_end():
+    def on_drop(item):
+        raise RuntimeError(item)
+    stage = PipelineStage('summary', lambda item: None, 2, on_drop=on_drop)
+    assert run_stage(stage, range(5)) == []
+    assert stage.stats['failed'] == 5
+    assert stage.running == 0
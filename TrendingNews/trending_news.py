@@ -1,41 +1,90 @@
 # -*- coding: utf-8 -*-
 """Scraping the trending IDs, typically 300, filter them based on english language and latest number of articles pulished within"""
 
-import requests
-import time
-import json
-import pandas as pd
 import traceback
 from datetime import date
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from trends_client import TrendsClient
+from news_store import NewsStore
 import os
 from dotenv import load_dotenv
 load_dotenv()
 #nltk.download('punkt')
 
+STORIES_URL = os.getenv("google_trends_stories_url", "https://trends.google.com/trends/api/stories/")
+
+def get_regions():
+    '''
+    Reads the Trends regions to ingest from the trends_regions env variable, e.g. "IN:en-US,US:en-US,DE:de", every region
+    being a geo, the language of the feed and optionally the language suffix of the story IDs kept, e.g. "CH:fr-CH:fr".
+
+    Returns:
+    regions: List of dictionaries with geo, hl and language, empty if trends_regions is not set
+    '''
+    regions = []
+    for entry in os.getenv("trends_regions", "").split(","):
+        if entry.strip() == "":
+            continue
+        parts = [part.strip() for part in entry.split(":")]
+        geo = parts[0].upper()
+        hl = parts[1] if len(parts) > 1 and parts[1] else "en-US"
+        language = parts[2] if len(parts) > 2 and parts[2] else hl.split("-")[0].lower()
+        regions.append({'geo': geo, 'hl': hl, 'language': language})
+    return regions
+
 class TrendingNews:
     '''
     Class to scrap the trending news IDs, article title, article text from Google Trends.
     '''
 
-    def __init__(self):
+    def __init__(self, store=None, run=True, region=None):
         '''
-        Fetches the trending news data by calling other functions, processes it, and saves it to files.
+        Fetches the trending news data by calling other functions, processes it, and saves the new IDs to the lookup table.
+
+        Args:
+        store: NewsStore holding the lookup table, a new one is opened if not given
+        run: Fetch the stories right away, set to False when the stories are fetched one by one, e.g. by the streaming pipeline
+        region: Region returned by get_regions, its geo labels the stories; the google_news_url feed and English stories if not given
 
         Class global variables:
-        all_trending_ids - stores the trending article ids in a lookup table, so that no article is processed repeatedly
+        store - stores the trending article ids in a lookup table, so that no article is processed repeatedly
         trending_ids - Stores the information regarding the articles scraped in a day
+        client - Pooled, rate limited client shared by all Trends requests
         '''
-        # Create a soup of the Google trending news app
-        json_content = self.get_soup(os.getenv("google_news_url"))
-        all_story_ids = json_content['trendingStoryIds']
+        self.client = TrendsClient()
+        self.store = store or NewsStore()
+        self.region = region
+        self.hl = region['hl'] if region is not None else 'en-US'
+        self.language = region['language'] if region is not None else 'en'
 
-        self.initialize_all_trending_ids()
+        if run:
+            all_story_ids = self.get_trending_story_ids()
 
-        # Store the trending ids and other information of a story into a dataset
-        self.trending_ids = self.get_story_ids(all_story_ids)
-        
-        # Save the trending news IDs to the lookup table
-        self.all_trending_ids.to_csv(f'{os.getenv("temp_folder")}/all_trending_ids.csv', index=False)
+            # Store the trending ids and other information of a story into a dataset, new IDs are appended to the lookup table
+            self.trending_ids = self.get_story_ids(all_story_ids)
+
+    def get_trending_story_ids(self):
+        '''
+        Fetches the IDs of all the stories currently trending.
+
+        Returns:
+        all_story_ids: List of all trending story IDs scrapped from google news
+        '''
+        # Create a soup of the Google trending news app
+        json_content = self.get_soup(self.get_feed_url())
+        return json_content['trendingStoryIds']
+
+    def get_feed_url(self):
+        '''
+        Returns the URL of the trending stories feed, google_news_url with the geo and language of the region.
+        '''
+        url = os.getenv("google_news_url")
+        if self.region is None:
+            return url
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        query.update(geo=self.region['geo'], hl=self.hl)
+        return urlunsplit(parts._replace(query=urlencode(query)))
 
     def get_soup(self, url):
         '''
@@ -48,23 +97,34 @@ class TrendingNews:
         content_json: JSON content of the webpage
         '''
         try:
-            user_agent = "'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'"
-            html = requests.get(url, headers={'User-Agent': user_agent}).text
-            time.sleep(5)
-            content_json = json.loads(html[5:])
-            return content_json
+            return self.client.get_json(url)
         except Exception as e:
             print("Error fetching content:", e)
             return ""
 
-    def initialize_all_trending_ids(self):
+    def filter_story_ids(self, all_story_ids):
         '''
-        Initializes the lookup table for storing trending IDs
+        Keeps the story IDs of the region language, English by default, that are not in the lookup table, without any network call.
+
+        Args:
+        all_story_ids: List of all trending story IDs scrapped from google news
+
+        Returns:
+        candidate_ids: List of story IDs to fetch, without duplicates
         '''
-        try:
-            self.all_trending_ids = pd.read_csv(f'{os.getenv("temp_folder")}/all_trending_ids.csv')
-        except FileNotFoundError:
-            self.all_trending_ids = pd.DataFrame(columns=['id', 'story'])
+        candidate_ids, candidate_set = [], set()
+        for id in all_story_ids:
+            # fetch the information for an ID if it is not processed already
+            if self.store.has_seen(id) or id in candidate_set:
+                continue
+            
+            #Capture the stories of the region language only
+            if id[-len(self.language):] != self.language:
+                continue
+
+            candidate_ids.append(id)
+            candidate_set.add(id)
+        return candidate_ids
 
     def get_story_ids(self, all_story_ids):
         '''
@@ -76,36 +136,42 @@ class TrendingNews:
         Returns:
         current_trending_articles: List of dictionaries containing ID, stories of all the trending articles pf that day
         '''
-        current_trending_articles = []
-        for id in all_story_ids:
-            article_dict = dict()
+        # filter on the lookup table and the language first, so skipped IDs cost no request
+        candidate_ids = self.filter_story_ids(all_story_ids)
 
-            # fetch the information for an ID if it is not processed already
-            if self.all_trending_ids['id'].eq(id).any():
-                continue
-            
-            #Capture the English stories only
-            if id[-2:] != 'en':
-                continue
-            
-            article_dict['id'] = id
+        #calling the get_story function concurrently to fetch information regarding every story ID
+        all_stories = self.client.map(self.get_story, candidate_ids)
 
-            #calling the get_latest_article function to fetch information regarding a story ID
-            num_latest_articles, article_dict['stories'], article_dict['all_articles_keywords'] = self.get_latest_articles(id)
-            
-            if article_dict['all_articles_keywords'] is not None:
-                article_dict['all_articles_keywords'] = article_dict['all_articles_keywords'].split(", ")
-            
-            # if number of articles regarding an ID is less than 2 means it is a less trending story, then skip that story and related articles
-            if num_latest_articles is not None:
-                if num_latest_articles < 2:
-                    continue
-                
-                current_trending_articles.append(article_dict)
-                self.all_trending_ids.loc[len(self.all_trending_ids)] = [id, article_dict['stories']]
-                
+        current_trending_articles = [article_dict for article_dict in all_stories if article_dict is not None]
+        self.store.add_trending_ids([(article_dict['id'], article_dict['stories']) for article_dict in current_trending_articles])
         return current_trending_articles
 
+    def get_story(self, id):
+        '''
+        Fetches the information of one story ID by calling get_latest_article function
+
+        Args:
+        id: ID of the story
+
+        Returns:
+        article_dict: Dictionary containing ID, stories, keywords and number of latest articles of the story, None if it is not trending enough
+        '''
+        article_dict = dict()
+        article_dict['id'] = id
+        num_latest_articles, article_dict['stories'], article_dict['all_articles_keywords'] = self.get_latest_articles(id)
+        
+        if article_dict['all_articles_keywords'] is not None:
+            article_dict['all_articles_keywords'] = article_dict['all_articles_keywords'].split(", ")
+        
+        # if number of articles regarding an ID is less than 2 means it is a less trending story, then skip that story and related articles
+        if num_latest_articles is None or num_latest_articles < 2:
+            return None
+        # kept as the trend score the refresh scheduler ranks the stories by
+        article_dict['num_latest_articles'] = num_latest_articles
+        if self.region is not None:
+            article_dict['regions'] = [self.region['geo']]
+        return article_dict
+
     def get_latest_articles(self, id):
         '''
         Extracts latest articles for a given story ID.
@@ -119,7 +185,7 @@ class TrendingNews:
         - story_keywords: Keywords related to the story
         '''
         temp_dict = dict()
-        story_url = "https://trends.google.com/trends/api/stories/"+id+"?hl=en-US&tz=-330"
+        story_url = STORIES_URL+id+"?hl="+self.hl+"&tz=-330"
         barflag, artflag = 0, 0
         all_stories_content = []
         story_content_json = self.get_soup(story_url)
@@ -0,0 +1,151 @@
+"""
+This script defines a pooled, rate limited client for the Google Trends API
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import random
+import time
+import json
+import os
+from metrics import EXTERNAL_SECONDS, RETRIES
+from http_cache import HttpCache
+from dotenv import load_dotenv
+load_dotenv()
+
+USER_AGENT = "'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    '''
+    Thread safe token bucket, every request takes one token and tokens are refilled at a fixed rate.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        '''
+        Args:
+        rate: Number of tokens added per second
+        capacity: Maximum number of tokens that can be saved up for a burst, defaults to the rate
+        '''
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a token is available and takes it.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class TrendsClient:
+    '''
+    Fetches Google Trends JSON over a shared keep-alive session within a requests-per-second budget.
+    '''
+
+    def __init__(self, requests_per_second=None, max_workers=None, max_retries=None, http_cache=None):
+        '''
+        Args:
+        requests_per_second: Request budget shared by all threads, defaults to the trends_requests_per_second env variable or 1
+        max_workers: Number of concurrent requests used by map, defaults to trends_max_workers or 4
+        max_retries: Number of retries of a 429/5xx response or a connection error, defaults to trends_max_retries or 4
+        http_cache: HttpCache revalidating the responses with conditional requests, a new one is opened unless http_cache_enabled is 0
+        '''
+        self.requests_per_second = float(requests_per_second or os.getenv("trends_requests_per_second", 1))
+        self.max_workers = int(max_workers or os.getenv("trends_max_workers", 4))
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv("trends_max_retries", 4))
+        self.bucket = TokenBucket(self.requests_per_second)
+        self.http_cache = http_cache
+        if self.http_cache is None and os.getenv("http_cache_enabled", "1") != "0":
+            self.http_cache = HttpCache()
+
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_json(self, url):
+        '''
+        Fetches a Trends URL and returns its JSON content, retrying 429/5xx responses with exponential backoff.
+        A response that was cached with an ETag or Last-Modified header is only downloaded again if it changed.
+
+        Args:
+        url: URL of the Trends API
+
+        Returns:
+        content_json: JSON content of the response
+
+        Raises:
+        requests.RequestException: if the request still fails after all retries
+        '''
+        cached = self.http_cache.get(url) if self.http_cache is not None else None
+        headers = self.http_cache.get_conditional_headers(cached) if cached is not None else {}
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, timeout=30, headers=headers)
+                EXTERNAL_SECONDS.observe(time.monotonic() - start, 'trends', str(response.status_code))
+                if response.status_code == 304 and cached is not None:
+                    self.http_cache.touch(url)
+                    self.http_cache.record_lookup('revalidated')
+                    return json.loads(cached['body'].decode('utf-8')[5:])
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    if self.http_cache is not None:
+                        self.http_cache.record_lookup('miss')
+                        if 'ETag' in response.headers or 'Last-Modified' in response.headers:
+                            self.http_cache.set(url, response.content, response.headers)
+                    # Trends prefixes its JSON with ")]}'," to prevent JSON hijacking
+                    return json.loads(response.text[5:])
+                error = requests.HTTPError("{} for url: {}".format(response.status_code, url), response=response)
+                retry_after = response.headers.get('Retry-After')
+            except (requests.ConnectionError, requests.Timeout) as e:
+                EXTERNAL_SECONDS.observe(time.monotonic() - start, 'trends', 'error')
+                error, retry_after = e, None
+            if attempt == self.max_retries:
+                raise error
+            RETRIES.inc('trends')
+            time.sleep(self.get_backoff(attempt, retry_after))
+
+    def get_backoff(self, attempt, retry_after=None):
+        '''
+        Returns the number of seconds to wait before the next retry.
+
+        Args:
+        attempt: Number of the failed attempt, starting at 0
+        retry_after: Value of the Retry-After header of the response, if any
+
+        Returns:
+        seconds: Server requested delay if given, otherwise exponential backoff with jitter
+        '''
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        return min(60, 2 ** attempt) + random.uniform(0, 1)
+
+    def map(self, function, items):
+        '''
+        Runs a fetching function over many items concurrently, the requests it makes share the requests-per-second budget.
+
+        Args:
+        function: Function that fetches through this client, e.g. TrendingNews.get_latest_articles
+        items: List of arguments for the function
+
+        Returns:
+        results: List of results in the order of the items
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(function, items))
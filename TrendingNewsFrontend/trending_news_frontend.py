@@ -1,82 +1,90 @@
 import requests
-import random
+import re
 import streamlit as st
 from annotated_text import annotated_text
 from annotated_text import annotation
 import feedparser
+import threading
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
-def get_random_colour_for_text_highlight(last_colors):
-    colors = ["#FFFFFF", "#FFFF00", "#FF0000", "#008000", "#0000FF", "#800080", "#FFA500", "#FFC0CB", "#008080", "#E6E6FA", "#FFD700", "#C0C0C0", "#40E0D0", "#FF00FF", "#00FF00", "#800000", "#00FFFF", "#DDA0DD", "#FFBF00"]
-    if len(last_colors)>0:
-        for last_color in last_colors:
-            if (last_color in colors) & (len(colors)>3):
-                colors.remove(last_color)
-    return random.choice(colors)
-
-def get_annotated_topics(keywords, topic_description, max_number_topics):
-    annotation_text = ''
-    for count, keyword in enumerate(keywords):
-        if count >= max_number_topics:
-            break
-        annotation_text += ''', annotation("{}", "{}", color='{}')'''.format(keyword, topic_description[keyword]['topic_number'], topic_description[keyword]['color'])
-    return annotation_text
-
-def get_description_of_topic(used_colors, topic_number):
-    description = dict()
-    color = get_random_colour_for_text_highlight(used_colors)
-    description['color'] = color
-    description['topic_number'] = topic_number
-    used_colors.append(color)
-    return description, used_colors
-
-def get_topic_number_and_color(data):
-    topic_description, used_colors = dict(), list()
-    ners, topics = data["NER"], data["all_articles_keywords"]
-    # show 4 topics as headers and others inside
-    total_topics = max(4,len(topics))
-    for count, topic in enumerate(topics):
-        description, used_colors = get_description_of_topic(used_colors, count+1)
-        topic_description[topic] = description
-    for ner in ners:
-        if ner in topics:
-            continue
-        description, used_colors = get_description_of_topic(used_colors, total_topics)
-        total_topics+=1
-        topic_description[ner] = description
-    return topic_description
-
-def get_summary_with_annotated_ners(data, topic_description):
-    ners = data['NER']
-    summary_text = data["article_summary"]
-    for entity in ners:
-        summary_text =  summary_text.replace(entity, '''""", annotation('{}', '{}', color='{}'), """'''.format(entity, topic_description[entity]['topic_number'], topic_description[entity]['color']))
-    summary_text = '"""{}"""'.format(summary_text)
-    return summary_text
+FETCH_TTL_SECONDS = int(os.getenv("fetch_data_ttl", 60))
+STORIES_PER_PAGE = int(os.getenv("stories_per_page", 10))
+THUMBNAIL_WIDTH = int(os.getenv("thumbnail_width", 600))
 
+def get_render_annotations(parts):
+    return [part if isinstance(part, str) else annotation(part['text'], part['label'], color=part['color']) for part in parts]
 
 def news_card(data):
     if data is not None:
         with st.container():
-            st.subheader(data["stories"]["title"].replace('\n',' '))
+            render = data["render"]
+            st.subheader(render["title"])
             st.text(data["stories"]["source"])
             st.text(data["stories"]["date"])
-            topic_description = get_topic_number_and_color(data)
-            st.image(data["stories"]["image_url"], width=600, use_column_width=True)
-            eval('''annotated_text("Topics: " {})'''.format(get_annotated_topics(data["all_articles_keywords"], topic_description, max_number_topics=4)))
+            st.image(get_thumbnail_url(data["stories"]["image_url"], THUMBNAIL_WIDTH), width=THUMBNAIL_WIDTH)
+            # topic numbers, colours and summary annotations are precomputed by the backend
+            annotated_text("Topics: ", *get_render_annotations(render["topics"]))
             st.markdown(" ")
-            summary_text = get_summary_with_annotated_ners(data, topic_description)
-            eval('annotated_text({})'.format(summary_text))
+            annotated_text(*get_render_annotations(render["summary_parts"]))
             # st.markdown(summ)
             st.markdown("[Read More](" + data["stories"]["url"] + ")")
 
+def get_thumbnail_url(image_url, width):
+    # Google image hosts resize on the server when the size is part of the URL
+    if re.search(r'\.(googleusercontent|ggpht)\.com/', image_url):
+        return re.sub(r'=[swh]\d+[^/]*$', '', image_url) + '=w{}'.format(width)
+    return image_url
+
+@st.cache_resource
+def get_backend_cache():
+    # shared by all sessions: the stories of the last synced snapshot version, by ID and in order, and the ETags of
+    # the last full and delta responses of the backend
+    return {'version': None, 'stories': dict(), 'order': [], 'etag': None, 'delta_etag': None, 'lock': threading.Lock()}
+
+def get_delta_api():
+    return os.getenv("fetch_delta_api") or os.getenv("fetch_data_api").rsplit('/fetch_data', 1)[0] + '/fetch_delta'
+
+def get_revalidation_headers(etag):
+    return {'If-None-Match': etag} if etag is not None else {}
+
+def apply_delta(cache, delta):
+    for story in delta['added'] + delta['changed']:
+        cache['stories'][story['id']] = story
+    for id in delta['removed']:
+        cache['stories'].pop(id, None)
+    cache['version'], cache['order'] = delta['version'], delta['order']
+
+@st.cache_data(ttl=FETCH_TTL_SECONDS, show_spinner=False)
 def get_data():
-    response = requests.get(url=os.getenv("fetch_data_api")).json()
-    if response['success']:
-        return response['data']
-    return None
+    cache = get_backend_cache()
+    with cache['lock']:
+        # only the stories changed since the synced version are transferred, and nothing while it is still current
+        if cache['version'] is not None:
+            response = requests.get(url=get_delta_api(), params={'since_version': cache['version']},
+                                    headers=get_revalidation_headers(cache['delta_etag']))
+            if response.status_code == 304:
+                return [cache['stories'][id] for id in cache['order']]
+            if response.status_code == 200 and response.json()['success']:
+                apply_delta(cache, response.json())
+                cache['delta_etag'] = response.headers.get('ETag')
+                return [cache['stories'][id] for id in cache['order']]
+        # first sync, or the synced version is no longer retained by the backend
+        response = requests.get(url=os.getenv("fetch_data_api"), headers=get_revalidation_headers(cache['etag']))
+        if response.status_code == 304:
+            return [cache['stories'][id] for id in cache['order']]
+        body = response.json()
+        if not body['success']:
+            return None
+        cache['version'], cache['etag'], cache['delta_etag'] = body.get('version'), response.headers.get('ETag'), None
+        cache['stories'] = {story['id']: story for story in body['data']}
+        cache['order'] = [story['id'] for story in body['data']]
+        return body['data']
+
+def get_page(data, page):
+    start = (page - 1) * STORIES_PER_PAGE
+    return data[start:start + STORIES_PER_PAGE]
 
 
 if __name__ == "__main__":
@@ -86,6 +94,9 @@ if __name__ == "__main__":
     if data is None:
         st.subheader("Error loading news")
     else:
-        for _ in data:
+        number_of_pages = max(1, -(-len(data) // STORIES_PER_PAGE))
+        page = st.number_input("Page", min_value=1, max_value=number_of_pages, value=1, step=1)
+        # only the cards of the selected page are rendered
+        for _ in get_page(data, page):
             news_card(_)
-    
\ No newline at end of file
+        st.caption("Page {} of {}".format(page, number_of_pages))